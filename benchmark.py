@@ -0,0 +1,459 @@
+from datetime import date, datetime, timedelta
+from sqlalchemy import insert, select
+from config import app, MANUAL_MEME_RANK
+from db_handler import DBHandler
+from fakes import FakeBot, FakeBucket, MediaOrigin, synthetic_image
+from fanout import FanoutSender
+from image_optimizer import ImageOptimizer
+from logging_config import configure_logging
+from media_cache import MediaCache
+from scoring import score_queue
+from telegram_sender import TelegramSender
+from types import SimpleNamespace
+from video_render import render_overlay_batch
+import argparse
+import itertools
+import json
+import logging
+import main as meme_bot
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Offline benchmarks of the hot paths: queue selection, cleanup, posting and rendering.
+# Telegram, Firebase and the media origin are replaced by the local fakes in fakes.py,
+# and the database is a SQLite copy of reddit_items.db scaled to the requested size.
+# Every run writes a JSON report that a later run can be compared against
+
+BENCHMARKS = ('selection', 'cleanup', 'posting', 'render')
+
+# Share of generated memes that were uploaded manually and are kept in Firebase storage
+MANUAL_SHARE = 0.001
+
+# Share of generated memes in each state: waiting in the queue, rejected, posted, unchecked
+STATE_WEIGHTS = {'queued': 0.5, 'rejected': 0.2, 'posted': 0.2, 'unchecked': 0.1}
+
+
+def load_templates(source_path):
+    # Rank, comment count, author and age of the memes in the bundled database, used as
+    # the distribution the synthetic memes are drawn from
+    try:
+        with sqlite3.connect(source_path) as connection:
+            rows = connection.execute(
+                'SELECT rank, comments, posted_by, posted_when FROM reddit_items WHERE rank IS NOT NULL'
+            ).fetchall()
+    except sqlite3.Error as e:
+        logging.warning(f"Could not read templates from {source_path}: {e}")
+        rows = []
+
+    return rows or [(100, 10, 'bench', 5)]
+
+
+def manual_blob_name(meme_id):
+    return f'manual/{meme_id}.jpg'
+
+
+def build_database(path, rows, source_path, seed, origin_url, chunk_size=10000):
+    db_handler = DBHandler(f'sqlite:///{path}', manual_meme_rank=MANUAL_MEME_RANK)
+    db_handler.metadata.create_all(db_handler.engine)
+    db_handler.migrate()
+
+    templates = load_templates(source_path)
+    generator = random.Random(seed)
+    states = list(STATE_WEIGHTS)
+    weights = list(STATE_WEIGHTS.values())
+    today = date.today()
+
+    def meme(meme_id):
+        rank, comments, posted_by, posted_when = generator.choice(templates)
+        state = generator.choices(states, weights)[0]
+        manual = generator.random() < MANUAL_SHARE
+
+        # Spread authors out so the scale of the author diversity penalty matches production
+        author = f'{posted_by}{generator.randrange(max(rows // 50, 1))}'
+
+        return {
+            'id': meme_id,
+            'rank': MANUAL_MEME_RANK if manual else max(int((rank or 0) * generator.uniform(0.5, 1.5)), 0),
+            'comments': comments or 0,
+            'load_order': meme_id,
+            'url': None if manual else origin_url(meme_id),
+            'file_id': manual_blob_name(meme_id) if manual else None,
+            'signature': f'bench-{meme_id}',
+            'posted_by': author,
+            'posted_when': posted_when or 0,
+            'date_added': today - timedelta(days=generator.randrange(60)),
+            'checked': state != 'unchecked',
+            'approved': state in ('queued', 'posted'),
+            'published': state == 'posted',
+            'my_comment': None,
+        }
+
+    with db_handler.engine.begin() as connection:
+        for start in range(1, rows + 1, chunk_size):
+            batch = [meme(meme_id) for meme_id in range(start, min(start + chunk_size, rows + 1))]
+            connection.execute(insert(db_handler.memes_table), batch)
+
+    db_handler.engine.dispose()
+
+
+def open_copy(database_path, workspace, name):
+    # Every benchmark run starts from the same generated database
+    path = os.path.join(workspace, f'{name}.db')
+    shutil.copyfile(database_path, path)
+    return DBHandler(f'sqlite:///{path}', manual_meme_rank=MANUAL_MEME_RANK)
+
+
+def bench_selection(db_handler, options):
+    started_at = time.perf_counter()
+    rows = db_handler.get_queue_for_scoring()
+    loaded_at = time.perf_counter()
+    meme_ids, scores = score_queue(rows, pinned_rank=MANUAL_MEME_RANK)
+    scored_at = time.perf_counter()
+    db_handler.save_posting_order(meme_ids, scores)
+    saved_at = time.perf_counter()
+
+    next_memes = []
+    for _ in range(options.selection_reads):
+        read_started_at = time.perf_counter()
+        db_handler.get_memes_to_channel(3)
+        next_memes.append(time.perf_counter() - read_started_at)
+
+    claims = []
+    for _ in range(options.claims):
+        claim_started_at = time.perf_counter()
+        meme = db_handler.claim_meme_to_channel(node_id='bench')
+        claims.append(time.perf_counter() - claim_started_at)
+        if meme:
+            db_handler.finish_meme_claim(meme.id, posted=True)
+
+    return {
+        'queue_size': len(meme_ids),
+        'load_queue_seconds': loaded_at - started_at,
+        'score_queue_seconds': scored_at - loaded_at,
+        'save_order_seconds': saved_at - scored_at,
+        'get_memes_to_channel_seconds': next_memes,
+        'claim_seconds': claims,
+    }
+
+
+def bench_cleanup(db_handler, options):
+    started_at = time.perf_counter()
+    unapproved_removed, posted_removed = db_handler.remove_old_memes(
+        datetime.today() - timedelta(days=30), chunk_size=options.cleanup_chunk_size
+    )
+    elapsed = time.perf_counter() - started_at
+    removed = unapproved_removed + posted_removed
+
+    return {
+        'removed': removed,
+        'cleanup_seconds': elapsed,
+        'removed_per_second': removed / elapsed if elapsed else 0.0,
+    }
+
+
+def bench_posting(db_handler, options, workspace, origin):
+    # The bot's own posting path, main.post_to_channel, with its clients replaced by the
+    # fakes through the application container
+    bot = FakeBot(latency=options.telegram_latency, upload_bytes_per_second=options.upload_rate,
+                  error_rate=options.error_rate, seed=options.seed)
+    media_cache = MediaCache(os.path.join(workspace, 'media_cache'), 1024 ** 3)
+    optimizer = ImageOptimizer(media_cache, max_workers=options.optimizer_workers, max_bytes=5 * 1024 * 1024)
+    fanout = FanoutSender(max_workers=options.channels)
+
+    # The queued manual memes are in storage until they are posted, a fresh bucket per run
+    with db_handler.engine.connect() as connection:
+        manual_ids = connection.execute(
+            select(db_handler.memes_table.c.id)
+            .where(db_handler.memes_table.c.rank == MANUAL_MEME_RANK, db_handler.queue_filter)
+        ).scalars().all()
+    bucket = FakeBucket({manual_blob_name(meme_id): synthetic_image(meme_id) for meme_id in manual_ids},
+                        latency=options.origin_latency)
+
+    app.override('db_handler', db_handler)
+    app.override('bot', bot)
+    app.override('bucket', bucket)
+    # Rate limits are lifted, they would make the benchmark measure the limiter
+    app.override('telegram_sender', TelegramSender(bot, chat_rate=1000, chat_burst=1000, global_rate=1000,
+                                                   base_delay=0.01))
+    app.override('fanout', fanout)
+    app.override('media_cache', media_cache)
+    app.override('image_optimizer', optimizer)
+
+    meme_bot.supporting_channel_ids = [f'-1000000000{index:02d}' for index in range(2, options.channels + 1)]
+    meme_bot.posting_channel_ids = [meme_bot.target_channel_id] + meme_bot.supporting_channel_ids
+
+    # The queue is ranked ahead of the slots, like the prefetch job does, so the pinned
+    # manual memes come first
+    meme_bot.rank_queue()
+
+    latencies = []
+    started_at = time.perf_counter()
+
+    try:
+        for _ in range(options.posts):
+            if db_handler.get_meme_to_channel() is None:
+                break
+
+            # A post is counted when it shows up in the statistics, like in production
+            published = db_handler.get_statistics()['all_published_count'] or 0
+            post_started_at = time.perf_counter()
+            meme_bot.post_to_channel()
+            if (db_handler.get_statistics()['all_published_count'] or 0) > published:
+                latencies.append(time.perf_counter() - post_started_at)
+    finally:
+        elapsed = time.perf_counter() - started_at
+        optimizer.executor.shutdown()
+        fanout.executor.shutdown()
+
+    return {
+        'posts': len(latencies),
+        'post_seconds': latencies,
+        'posts_per_second': len(latencies) / elapsed if elapsed else 0.0,
+        'telegram_calls': bot.calls,
+        'uploaded_bytes': bot.uploaded_bytes,
+    }
+
+
+def make_background_video(path, seconds, width, height):
+    # A synthetic background with a silent audio track, like the bot's background videos
+    subprocess.run([
+        'ffmpeg', '-nostdin', '-y', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', f'testsrc2=size={width}x{height}:rate=30:duration={seconds}',
+        '-f', 'lavfi', '-i', f'anullsrc=channel_layout=stereo:sample_rate=44100',
+        '-shortest', '-codec:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', '-codec:a', 'aac', path,
+    ], check=True, capture_output=True)
+
+
+def bench_render(options, workspace, repeat):
+    # The render path of the bot: main.prepare_render_jobs takes the background video from
+    # a fake bucket and the memes from a fake origin, then every batch is rendered with
+    # each encoder profile and overlay mode
+    width, height = options.render_size
+    video_path = os.path.join(workspace, 'background.mp4')
+    if not os.path.exists(video_path):
+        make_background_video(video_path, options.render_seconds, width, height)
+
+    with open(video_path, 'rb') as file:
+        bucket = FakeBucket({'video_generation/background.mp4': file.read()}, latency=options.origin_latency)
+
+    run_workspace = tempfile.mkdtemp(dir=workspace)
+    output_directory = os.path.join(run_workspace, 'renders')
+    media_cache = MediaCache(os.path.join(run_workspace, 'media_cache'), 1024 ** 3)
+    optimizer = ImageOptimizer(media_cache, max_workers=options.optimizer_workers, max_bytes=5 * 1024 * 1024)
+    origin = MediaOrigin(latency=options.origin_latency, width=1080, height=1350).start()
+
+    app.override('bucket', bucket)
+    app.override('media_cache', media_cache)
+    app.override('image_optimizer', optimizer)
+
+    batch_sizes = [1] + ([options.render_batch] if options.render_batch > 1 else [])
+    seeds = itertools.count((options.seed * 1000 + repeat) * 100)
+    results = {}
+
+    try:
+        for profile in options.render_profiles:
+            for overlay_mode in options.render_modes:
+                for batch_size in batch_sizes:
+                    # New memes for every render, so the overlay frame cache is not what gets measured
+                    jobs = [SimpleNamespace(meme_id=seed, media_url=origin.url(seed))
+                            for seed in itertools.islice(seeds, batch_size)]
+                    groups = meme_bot.prepare_render_jobs(jobs)
+                    if len(groups) != 1 or isinstance(groups[0][1], Exception):
+                        raise RuntimeError(f"Preparing the renders failed: {groups}")
+
+                    meme_paths, background_path, _, video_info, _, _ = groups[0][1]
+
+                    started_at = time.perf_counter()
+                    output_paths = render_overlay_batch(meme_paths, background_path, output_directory, video_info,
+                                                        {'profile': profile}, overlay_mode)
+                    elapsed = time.perf_counter() - started_at
+
+                    if None in output_paths:
+                        raise RuntimeError(f"Render of {batch_size} memes with profile {profile} and "
+                                           f"{overlay_mode} overlay failed")
+
+                    if batch_size == 1:
+                        results[f'{profile}_{overlay_mode}_seconds'] = elapsed
+                        results[f'{profile}_{overlay_mode}_bytes'] = os.path.getsize(output_paths[0])
+                    else:
+                        # The same render for a batch of memes in one ffmpeg run, per video
+                        results[f'{profile}_{overlay_mode}_batch_seconds_per_video'] = elapsed / len(output_paths)
+
+                    for output_path in output_paths:
+                        os.remove(output_path)
+    finally:
+        origin.stop()
+        optimizer.executor.shutdown()
+
+    return results
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'median': statistics.median(samples),
+        'mean': statistics.fmean(samples),
+        'min': samples[0],
+        'max': samples[-1],
+        'p95': samples[min(int(len(samples) * 0.95), len(samples) - 1)],
+        'samples': len(samples),
+    }
+
+
+def aggregate(runs):
+    # Metrics of all runs of a benchmark; lists of per operation timings are pooled
+    samples = {}
+    for run in runs:
+        for name, value in run.items():
+            samples.setdefault(name, []).extend(value if isinstance(value, list) else [value])
+    return {name: summarize(values) for name, values in samples.items() if values}
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                  check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                                    text=True, check=True).stdout.strip())
+        return revision + ('-dirty' if dirty else '')
+    except Exception:
+        return None
+
+
+def run_benchmarks(options):
+    workspace = tempfile.mkdtemp(prefix='memebot_bench_')
+    origin = MediaOrigin(latency=options.origin_latency).start()
+    results = {}
+
+    try:
+        database_path = os.path.join(workspace, 'generated.db')
+        started_at = time.perf_counter()
+        build_database(database_path, options.rows, options.source, options.seed, origin.url)
+        logging.warning(f"Generated {options.rows} memes in {time.perf_counter() - started_at:.1f}s")
+
+        for name in options.only:
+            if name == 'render' and (shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None):
+                logging.warning("ffmpeg is not installed, skipping the render benchmark")
+                continue
+
+            runs = []
+            for repeat in range(options.repeat):
+                if name == 'render':
+                    runs.append(bench_render(options, workspace, repeat))
+                    continue
+
+                db_handler = open_copy(database_path, workspace, f'{name}_{repeat}')
+                try:
+                    if name == 'selection':
+                        runs.append(bench_selection(db_handler, options))
+                    elif name == 'cleanup':
+                        runs.append(bench_cleanup(db_handler, options))
+                    else:
+                        run_workspace = tempfile.mkdtemp(dir=workspace)
+                        runs.append(bench_posting(db_handler, options, run_workspace, origin))
+                finally:
+                    db_handler.engine.dispose()
+
+            results[name] = aggregate(runs)
+            logging.warning(f"Finished the {name} benchmark")
+    finally:
+        origin.stop()
+        if options.keep:
+            logging.warning(f"Kept the benchmark workspace in {workspace}")
+        else:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    return {
+        'revision': git_revision(),
+        'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'parameters': {name: value for name, value in vars(options).items()
+                       if name not in ('output', 'compare', 'log_level', 'keep')},
+        'results': results,
+    }
+
+
+def format_report(report, baseline=None):
+    lines = [f"Revision {report['revision']}, Python {report['python']}, {report['cpus']} CPUs"]
+    if baseline:
+        lines.append(f"Compared with revision {baseline['revision']} (negative change is faster or smaller)")
+
+    for benchmark, metrics in report['results'].items():
+        lines.append('')
+        lines.append(f'{benchmark}:')
+        for name, summary in metrics.items():
+            line = f"  {name:<36} median {summary['median']:>12.4f}  p95 {summary['p95']:>12.4f}"
+
+            previous = ((baseline or {}).get('results', {}).get(benchmark, {}).get(name) or {}).get('median')
+            if previous:
+                line += f"  change {100 * (summary['median'] - previous) / previous:+7.1f}%"
+            lines.append(line)
+
+    return '\n'.join(lines)
+
+
+def parse_size(text):
+    width, _, height = text.lower().partition('x')
+    return int(width), int(height)
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the meme bot hot paths.')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=list(BENCHMARKS),
+                        help='benchmarks to run')
+    parser.add_argument('--rows', type=int, default=100000, help='memes in the generated database')
+    parser.add_argument('--source', default='reddit_items.db', help='database the memes are modelled on')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the generated data')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every benchmark')
+    parser.add_argument('--claims', type=int, default=200, help='claims per selection run')
+    parser.add_argument('--selection-reads', type=int, default=50, help='queue reads per selection run')
+    parser.add_argument('--cleanup-chunk-size', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=30, help='posts per posting run')
+    parser.add_argument('--channels', type=int, default=3, help='channels every meme is posted to')
+    parser.add_argument('--optimizer-workers', type=int, default=2)
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help='seconds per Telegram call')
+    parser.add_argument('--upload-rate', type=float, default=5e6, help='upload bytes per second to Telegram')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of Telegram calls that fail')
+    parser.add_argument('--origin-latency', type=float, default=0.02, help='seconds per media origin request')
+    parser.add_argument('--render-size', type=parse_size, default=(720, 1280), help='background size, e.g. 720x1280')
+    parser.add_argument('--render-seconds', type=int, default=5, help='length of the background video')
+    parser.add_argument('--render-profiles', nargs='+', default=['fast', 'balanced'])
+    parser.add_argument('--render-modes', nargs='+', default=['template', 'layers'])
+    parser.add_argument('--render-batch', type=int, default=4, help='memes per batch render, 1 to skip it')
+    parser.add_argument('--output', help='write the JSON report to this file')
+    parser.add_argument('--compare', help='JSON report of an earlier run to compare with')
+    parser.add_argument('--keep', action='store_true', help='keep the generated databases and media')
+    parser.add_argument('--log-level', default='WARNING')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_arguments(argv)
+    configure_logging(options.log_level)
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as file:
+            baseline = json.load(file)
+
+    report = run_benchmarks(options)
+
+    if options.output:
+        with open(options.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    print(format_report(report, baseline))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,21 +1,20 @@
-import requests
-import pytz
-from datetime import datetime, timedelta
-from mimetypes import guess_extension
-from db_handler import DBHandler
+from container import Container
 import os
-import tempfile
+import socket
 import logging
-import firebase_admin
-from firebase_admin import credentials, storage
-from PIL import Image as PILImage
-from PIL import Image, ImageDraw, ImageFont
-import subprocess
-import shutil 
+from metrics import track, BYTES_TRANSFERRED
 import random
+import threading
+import time
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Settings are read from the environment here; the clients that use them are created on
+# first use by the factories below. Heavy libraries (SQLAlchemy, Firebase, Pillow,
+# requests) are imported by the functions that need them, so importing this module is fast
+# and works without credentials
+
+# Logging is configured by the entry point: LOG_LEVEL gates the messages, LOG_FORMAT is 'text' or 'json'
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
 
 # Get the current working directory
 current_directory = os.getcwd()
@@ -26,33 +25,132 @@ DB_HOST = os.environ.get('DB_HOST')
 DB_PORT = os.environ.get('DB_PORT')       
 DB_NAME = os.environ.get('DB_NAME')
 
+# Name of this replica; must be unique when several replicas share the database
+NODE_ID = os.environ.get('NODE_ID') or socket.gethostname()
+
 # Construct the PostgreSQL database URL
 db_url = f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
 
-# Correct the DBHandler initialization
-db_handler = DBHandler(db_url)
+# Connection pool settings; SQL statement logging is off unless DB_ECHO is set
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+DB_ECHO = os.environ.get('DB_ECHO', 'false').lower() in ('1', 'true', 'yes')
 
+# Nightly cleanup: rows deleted per transaction and optional archiving of removed
+# memes ('table' for the reddit_items_archive table, 'file' for a gzip JSONL file)
+CLEANUP_CHUNK_SIZE = int(os.environ.get('CLEANUP_CHUNK_SIZE', 1000))
+CLEANUP_ARCHIVE_MODE = os.environ.get('CLEANUP_ARCHIVE_MODE') or None
+CLEANUP_ARCHIVE_PATH = os.environ.get('CLEANUP_ARCHIVE_PATH', os.path.join('archive', 'reddit_items_archive.jsonl.gz'))
 
-#initalalizing firebase
-cred = credentials.Certificate("key.json")
-firebase_admin.initialize_app(cred, {'storageBucket': 'codereview-22c86.appspot.com'})
+# Rank marking memes uploaded manually; their media lives in Firebase storage under file_id
+MANUAL_MEME_RANK = 99999
 
-bucket = storage.bucket()
+# File extensions that are posted as videos rather than photos
+VIDEO_EXTENSIONS = ('mp4', 'mov', 'avi')
 
+# Limits for media downloads: timeout per request in seconds and maximum size in bytes
+# (50 MB is the largest file the Telegram bot API accepts for upload)
+DOWNLOAD_TIMEOUT = float(os.environ.get('DOWNLOAD_TIMEOUT', 30))
+DOWNLOAD_MAX_BYTES = int(os.environ.get('DOWNLOAD_MAX_BYTES', 50 * 1024 * 1024))
+DOWNLOAD_HEAD_CHECK = os.environ.get('DOWNLOAD_HEAD_CHECK', 'true').lower() in ('1', 'true', 'yes')
+
+# Specify the subdirectory for media storage (one directory back)
+media_subdir = os.path.join(current_directory, '..')
+
+# Construct the full path to the media directory
+media_dir = os.path.join(media_subdir, 'media')
+
+# Downloaded media (memes and background videos) is cached in media_dir up to this many
+# bytes. The directory is created along with the cache
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get('MEDIA_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+
+# Images are downscaled to IMAGE_MAX_SIDE pixels, recompressed at IMAGE_QUALITY and
+# stripped of metadata before upload; quality and size are lowered further for images
+# above IMAGE_MAX_BYTES. The optimized images are kept in the media cache
+IMAGE_MAX_SIDE = int(os.environ.get('IMAGE_MAX_SIDE', 2560))
+IMAGE_QUALITY = int(os.environ.get('IMAGE_QUALITY', 85))
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', 5 * 1024 * 1024))
+IMAGE_OPTIMIZER_WORKERS = int(os.environ.get('IMAGE_OPTIMIZER_WORKERS', 2))
+
+# Seconds the listing of the background video pool is reused before Firebase is asked again
+BACKGROUND_LIST_TTL = int(os.environ.get('BACKGROUND_LIST_TTL', 3600))
+
+# Folder name -> (monotonic time of the listing, [(blob name, generation)])
+background_videos = {}
+background_videos_lock = threading.Lock()
+
+
+def create_db_handler():
+    from db_handler import DBHandler
+
+    db_handler = DBHandler(
+        db_url,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        pool_recycle=DB_POOL_RECYCLE,
+        echo=DB_ECHO,
+        manual_meme_rank=MANUAL_MEME_RANK,
+    )
+    db_handler.migrate()
+    return db_handler
+
+
+def create_bucket():
+    # Firebase is initialized by the first command that needs data storage
+    import firebase_admin
+    from firebase_admin import credentials, storage
+
+    cred = credentials.Certificate("key.json")
+    firebase_admin.initialize_app(cred, {'storageBucket': 'codereview-22c86.appspot.com'})
+    return storage.bucket()
 
-def download_media_to_channel(url):
-    try:
-        response = requests.get(url)
-        content_type = response.headers.get('content-type')
 
-        if response.status_code == 200 and content_type:
-            file_extension = guess_extension(content_type.split('/')[1])
+def create_media_cache():
+    from media_cache import MediaCache
+    return MediaCache(media_dir, MEDIA_CACHE_MAX_BYTES)
 
-            # Use tempfile to generate a unique temporary file name
-            with tempfile.NamedTemporaryFile(suffix=file_extension, delete=False) as media:
-                media.write(response.content)
 
-            return media.name
+def create_image_optimizer():
+    from image_optimizer import ImageOptimizer
+
+    return ImageOptimizer(
+        app.media_cache,
+        max_workers=IMAGE_OPTIMIZER_WORKERS,
+        max_side=IMAGE_MAX_SIDE,
+        quality=IMAGE_QUALITY,
+        max_bytes=IMAGE_MAX_BYTES,
+    )
+
+
+# The application's clients, e.g. app.db_handler, each created on first use
+app = Container()
+app.register('db_handler', create_db_handler)
+app.register('bucket', create_bucket)
+app.register('media_cache', create_media_cache)
+app.register('image_optimizer', create_image_optimizer)
+
+
+def count_downloaded(result):
+    # result is the (content_type, sha256, size) of a finished download
+    BYTES_TRANSFERRED.inc(result[2], direction='downloaded')
+    return result
+
+
+def download_media_to_channel(url):
+    from downloads import stream_url_to_file
+
+    try:
+        # Stream the media into the media cache, or reuse it if it was downloaded before
+        with track('download_media_to_channel'):
+            return app.media_cache.fetch(
+                url,
+                lambda file: count_downloaded(stream_url_to_file(
+                    url, file, max_bytes=DOWNLOAD_MAX_BYTES, timeout=DOWNLOAD_TIMEOUT, head_check=DOWNLOAD_HEAD_CHECK
+                )),
+            )
 
     except Exception as e:
         logging.error(f"Error downloading media from {url}: {e}")
@@ -60,187 +158,148 @@ def download_media_to_channel(url):
     return None
 
 
-def mark_to_delete(message):
-    try:
-        meme = db_handler.get_meme_to_channel()
+def blob_cache_key(blob_name, generation=None):
+    # A new upload under the same name gets a new generation, and so a new cache entry
+    return f"blob:{blob_name}#{generation}" if generation else f"blob:{blob_name}"
 
-        if meme:
-            meme_id = meme.id
-            db_handler.mark_as_checked(meme_id, True)
-            db_handler.mark_as_approved(meme_id, False)
 
-    except Exception as e:
-        logging.error(f"Error marking meme to delete: {e}")
+def download_blob_to_channel(blob_name, attempts=3, generation=None):
+    from downloads import stream_blob_to_file, MediaTooLargeError
 
+    _, file_extension = os.path.splitext(blob_name)
 
+    for attempt in range(attempts):
+        try:
+            logging.info(f"Attempt {attempt + 1}: Downloading {blob_name} from data storage")
+            with track('download_blob_to_channel'):
+                media_path = app.media_cache.fetch(
+                    blob_cache_key(blob_name, generation),
+                    lambda file: count_downloaded(stream_blob_to_file(
+                        app.bucket.blob(blob_name, generation=generation), file, max_bytes=DOWNLOAD_MAX_BYTES,
+                        timeout=DOWNLOAD_TIMEOUT
+                    )),
+                    extension=file_extension,
+                )
+
+            logging.info("File successfully found and downloaded")
+            return media_path
+
+        except MediaTooLargeError as e:
+            # Retrying won't make the file smaller
+            logging.error(f"Error downloading {blob_name}: {e}")
+            return None
 
-def convert_to_local_time(moscow_hour, moscow_minute):
-    try:
-        # Define the Moscow timezone
-        moscow_tz = pytz.timezone('Europe/Moscow')
+        except Exception as e:
+            logging.error(f"Attempt {attempt + 1} failed: {e}")
+            if attempt < attempts - 1:
+                logging.info("Retrying after 3 seconds...")
+                time.sleep(3)
 
-        # Get the current time in Moscow
-        moscow_time = datetime.now(moscow_tz).replace(hour=moscow_hour, minute=moscow_minute, second=0, microsecond=0)
+    logging.critical("All attempts to download the file have failed")
+    return None
 
-        # Convert Moscow time to local time
-        local_tz = pytz.timezone('Europe/Berlin')
-        local_time = moscow_time.astimezone(local_tz)
 
-        # Format the local time as string in %H:%M format
-        formatted_time = local_time.strftime('%H:%M')
+def meme_cache_key(meme):
+    if meme.rank == MANUAL_MEME_RANK and meme.file_id:
+        return blob_cache_key(meme.file_id)
+    return meme.url
 
-        return formatted_time
 
-    except Exception as e:
-        logging.error(f"Error converting to local time: {e}")
+def fetch_meme_media(meme):
+    # Download the meme's media to the media cache, from Firebase storage for manually
+    # uploaded memes and from the meme URL otherwise
+    if meme.rank == MANUAL_MEME_RANK and meme.file_id:
+        media_path = download_blob_to_channel(meme.file_id)
+    elif meme.url:
+        media_path = download_media_to_channel(meme.url)
+    else:
         return None
 
-def download_random_video(folder_name='video_generation', output_directory='output_videos/'):
-    logging.info('Starting to download video')
-    blobs = list(bucket.list_blobs(prefix=folder_name))
-
-    if not blobs:
-        logging.error("No files found in the specified folder.")
+    # Don't keep broken media in the cache, a later attempt should download it again
+    if media_path and not validate_media(media_path):
+        app.media_cache.discard(meme_cache_key(meme))
         return None
 
-    random_video = random.choice(blobs)
+    return media_path
 
-    # Ensure the output directory exists
-    os.makedirs(output_directory, exist_ok=True)
 
-    # Construct the full path including filename
-    video_filename = os.path.basename(random_video.name)
-    destination_path = os.path.join(output_directory, video_filename)
+def optimize_media(media_path):
+    # Videos are uploaded as they are
+    if media_path.lower().endswith(VIDEO_EXTENSIONS):
+        return media_path
+    with track('optimize_image'):
+        return app.image_optimizer.optimize(media_path)
 
-    logging.info(f"Downloading to: {destination_path}")
+
+def validate_media(media_path):
+    from PIL import Image as PILImage
 
     try:
-        # Download the video file
-        random_video.download_to_filename(destination_path)
-        logging.info(f"Downloaded {random_video.name} to {destination_path}")
-        return destination_path
-    except Exception as e:
-        logging.error(f"Error downloading video: {e}")
-        return None
+        if os.path.getsize(media_path) == 0:
+            return False
 
-def preprocess_image(photo_path, output_path, video_width, target_width_percentage):
-    with PILImage.open(photo_path) as img:
-        original_width, original_height = img.size
-        target_width = int(video_width * target_width_percentage)
-        aspect_ratio = original_height / original_width
-        target_height = int(target_width * aspect_ratio)
-        resized_img = img.resize((target_width, target_height), PILImage.LANCZOS)
-        resized_img.save(output_path)
-        print(f"Preprocessed image dimensions: width={target_width}, height={target_height}")
-        return target_width, target_height
-
-def preprocess_icon(icon_path, output_path, video_width, target_width_percentage):
-    icon_image = PILImage.open(icon_path)
-    target_width = int(video_width * target_width_percentage)
-    aspect_ratio = icon_image.height / icon_image.width
-    target_height = int(target_width * aspect_ratio)
-    resized_icon = icon_image.resize((target_width, target_height), PILImage.LANCZOS)
-    resized_icon.save(output_path)
-
-def create_video_with_overlay(meme_path):
-    logging.info('Video generation started')
-
-    video_path = download_random_video()
-    if video_path is None:
-        logging.error("Failed to download a video. Exiting.")
-        return None
-    
-    # Check if ffprobe is available
-    if shutil.which('ffprobe') is None:
-        logging.error("ffprobe is not installed or not found in PATH.")
-        return None
+        # Videos are checked by Telegram; images are verified locally without decoding
+        if media_path.lower().endswith(VIDEO_EXTENSIONS):
+            return True
+
+        with PILImage.open(media_path) as img:
+            img.verify()
+
+        return True
+
+    except Exception as e:
+        logging.warning(f"Media {media_path} failed validation: {e}")
+        return False
 
-    icon_png_path = 'icons8-telegram-50.png'
 
+def mark_to_delete(meme):
     try:
-        result = subprocess.run(
-            ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height,duration', '-of',
-             'csv=p=0', video_path],
-            capture_output=True, text=True, check=True)
-        video_info = result.stdout.strip().split(',')
-        video_width = int(video_info[0])
-        video_height = int(video_info[1])
-        video_duration = float(video_info[2])
-        logging.info(f"Video dimensions: width={video_width}, height={video_height}")
+        if meme:
+            # The meme was claimed (marked as published) before posting, so reject it
+            # by id rather than looking up the current top of the queue
+            app.db_handler.set_flags([meme.id], checked=True, approved=False, published=False)
+
     except Exception as e:
-        logging.error(f"Error loading video: {e}")
-        return None
+        logging.error(f"Error marking meme to delete: {e}")
 
-    output_directory = 'output_videos/'
-    os.makedirs(output_directory, exist_ok=True)
 
-    preprocessed_image_path = os.path.join(output_directory, 'preprocessed_overlay_image.jpg')
-    image_width, image_height = preprocess_image(meme_path, preprocessed_image_path, video_width, 0.9)
-    logging.info(f"Preprocessed image dimensions: width={image_width}, height={image_height}")
+def list_background_videos(folder_name='video_generation'):
+    # The pool of background videos changes rarely, so it is listed once and reused for
+    # BACKGROUND_LIST_TTL seconds. Returns (name, generation) pairs
+    with background_videos_lock:
+        listed_at, videos = background_videos.get(folder_name, (0, []))
 
-    preprocessed_icon_path = os.path.join(output_directory, 'icon8-telegram.png')
-    preprocess_icon(icon_png_path, preprocessed_icon_path, video_width, 0.06)
+        if not videos or time.monotonic() - listed_at > BACKGROUND_LIST_TTL:
+            # The folder itself shows up as an empty object, it is not a video
+            videos = [(blob.name, blob.generation) for blob in app.bucket.list_blobs(prefix=folder_name)
+                      if not blob.name.endswith('/')]
+            background_videos[folder_name] = (time.monotonic(), videos)
+            logging.info(f"Listed {len(videos)} background videos in {folder_name}")
 
-    font_size = int(video_width * 0.05)
-    font_path = "mechanical.otf"
+        return videos
 
-    try:
-        font = ImageFont.truetype(font_path, font_size)
-    except IOError:
-        logging.warning("Specified font not found. Using default font.")
-        font = ImageFont.load_default()
-
-    text = "coode_review"
-    text_image = Image.new('RGBA', (video_width, font_size + 20), (255, 255, 255, 0))
-    draw = ImageDraw.Draw(text_image)
-    text_bbox = draw.textbbox((0, 0), text, font=font)
-    text_width = text_bbox[2] - text_bbox[0]
-    text_height = text_bbox[3] - text_bbox[1]
-    logging.info(f"Text dimensions: width={text_width}, height={text_height}")
-
-    draw.text((0, 0), text, font=font, fill="white")
-    text_image_path = os.path.join(output_directory, 'text_overlay.png')
-    text_image.save(text_image_path)
-
-    image_x = (video_width - image_width) // 2
-    image_y = (video_height - image_height - text_height - 20) // 2
-    text_x = (video_width * 0.95) - text_width
-    text_y = image_y + image_height + 20
-    icon_x = text_x - (video_width * 0.06 + 5)
-    icon_y = text_y - (video_height * 0.01)
-
-    final_video_path = os.path.join(output_directory, f"result_{os.path.basename(video_path)}")
-
-    ffmpeg_command = [
-        'ffmpeg', '-i', video_path, '-i', preprocessed_image_path, '-i', preprocessed_icon_path, '-i',
-        text_image_path,
-        '-filter_complex',
-        f"[1]scale=w={video_width * 0.9}:h=-1[overlay1];"
-        f"[2]scale=w={video_width * 0.06}:h=-1[overlay2];"
-        f"[0][overlay1]overlay={image_x}:{image_y}[bg1];"
-        f"[bg1][overlay2]overlay={icon_x}:{icon_y}[bg2];"
-        f"[bg2][3]overlay={text_x}:{text_y}",
-        '-codec:a', 'copy', '-map_metadata', '-1', final_video_path
-    ]
-
-    logging.info(f"Running ffmpeg command: {' '.join(ffmpeg_command)}")
 
-    try:
-        result = subprocess.run(ffmpeg_command, capture_output=True, text=True, check=True)
-        logging.info("Video created successfully!")
-        logging.debug(f"ffmpeg stdout: {result.stdout}")
-        logging.debug(f"ffmpeg stderr: {result.stderr}")
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Error saving video: {e}")
-        logging.debug(f"ffmpeg stdout: {e.stdout}")
-        logging.debug(f"ffmpeg stderr: {e.stderr}")
+def download_random_video(folder_name='video_generation'):
+    logging.info('Starting to download video')
+    videos = list_background_videos(folder_name)
+
+    if not videos:
+        logging.error("No files found in the specified folder.")
         return None
 
-    # Clean up
-    for file in [video_path, preprocessed_image_path, preprocessed_icon_path, text_image_path]:
-        try:
-            os.remove(file)
-        except Exception as e:
-            logging.warning(f"Error removing file {file}: {e}")
+    name, generation = random.choice(videos)
 
-    return final_video_path
+    try:
+        # Background videos are reused all the time, so each one is downloaded once per node
+        video_path = download_blob_to_channel(name, generation=generation)
+        if video_path is None:
+            # The video may have been replaced or removed since the listing
+            with background_videos_lock:
+                background_videos.pop(folder_name, None)
+            return None
+
+        logging.info(f"Using {name} from {video_path}")
+        return video_path
+    except Exception as e:
+        logging.error(f"Error downloading video: {e}")
+        return None
@@ -0,0 +1,2 @@
+# pytest puts the directory of this file on sys.path, so the tests import the bot modules
+# from the repository root
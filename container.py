@@ -0,0 +1,42 @@
+import logging
+import threading
+import time
+
+
+class Container:
+    def __init__(self):
+        # The shared clients of the bot (database, storage, Telegram, worker pools), each
+        # created by its factory on first use. Importing the modules that register them
+        # has no side effects, and a command only pays for the clients it touches
+        self.factories = {}
+        self.instances = {}
+        self.lock = threading.RLock()
+
+    def register(self, name, factory):
+        self.factories[name] = factory
+
+    def override(self, name, instance):
+        # Use instance instead of calling the factory, e.g. to run with a fake bot
+        with self.lock:
+            self.instances[name] = instance
+
+    def loaded(self, name):
+        return name in self.instances
+
+    def __getattr__(self, name):
+        # Only called for names that are not regular attributes, i.e. the clients
+        factories = self.__dict__.get('factories', {})
+        if name not in factories:
+            raise AttributeError(f"No client named {name}")
+
+        # Clients that exist are returned without taking the lock
+        if name in self.instances:
+            return self.instances[name]
+
+        with self.lock:
+            if name not in self.instances:
+                started_at = time.perf_counter()
+                self.instances[name] = factories[name]()
+                logging.info(f"Created {name} in {time.perf_counter() - started_at:.2f}s")
+
+            return self.instances[name]
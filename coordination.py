@@ -0,0 +1,86 @@
+from sqlalchemy import text
+import logging
+import threading
+
+# Key of the PostgreSQL advisory lock held by the replica that runs the scheduled jobs
+SCHEDULER_LOCK_KEY = 7305001
+
+
+class LeaderElection:
+    def __init__(self, engine, lock_key=SCHEDULER_LOCK_KEY, node_id=None):
+        # The leader is the replica holding a session level advisory lock. The lock lives
+        # on a connection kept out of the pool, so it is released by PostgreSQL as soon as
+        # the leader's process or connection dies and another replica can take over.
+        # Databases without advisory locks (SQLite) only support a single node, which is
+        # always the leader
+        self.engine = engine
+        self.lock_key = lock_key
+        self.node_id = node_id
+        self.enabled = engine.dialect.name == 'postgresql'
+
+        self.connection = None
+        self.leader = False
+        self.lock = threading.Lock()
+
+    def is_leader(self):
+        if not self.enabled:
+            return True
+
+        with self.lock:
+            try:
+                return self._check()
+            except Exception as e:
+                logging.error(f"Error checking leadership of node {self.node_id}: {e}")
+                self._reset()
+
+            # The connection may have died while idle, e.g. after a database restart, and
+            # PostgreSQL released the lock with it. Without another try on a new connection
+            # no replica would be leader until the next check
+            try:
+                return self._check()
+            except Exception as e:
+                logging.error(f"Error checking leadership of node {self.node_id} on a new connection: {e}")
+                self._reset()
+                return False
+
+    def _check(self):
+        if self.connection is None:
+            self.connection = self.engine.connect()
+
+        if self.leader:
+            # Make sure the session holding the lock is still alive
+            self.connection.execute(text('SELECT 1'))
+        else:
+            self.leader = bool(self.connection.execute(
+                text('SELECT pg_try_advisory_lock(:key)'), {'key': self.lock_key}
+            ).scalar())
+
+            if self.leader:
+                logging.info(f"Node {self.node_id} is now the leader.")
+
+        # Don't leave a transaction open between checks, the lock outlives it
+        self.connection.commit()
+        return self.leader
+
+    def _reset(self):
+        if self.leader:
+            logging.warning(f"Node {self.node_id} lost leadership.")
+
+        self.leader = False
+        if self.connection is not None:
+            try:
+                self.connection.invalidate()
+                self.connection.close()
+            except Exception as e:
+                logging.debug("Error closing leader election connection: %s", e)
+            self.connection = None
+
+    def resign(self):
+        with self.lock:
+            if self.leader and self.connection is not None:
+                try:
+                    self.connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': self.lock_key})
+                    self.connection.commit()
+                except Exception as e:
+                    logging.error(f"Error releasing leadership of node {self.node_id}: {e}")
+            self._reset()
@@ -1,15 +1,41 @@
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, Date, MetaData, Table
+from sqlalchemy import create_engine, Column, Integer, String, Boolean, Date, DateTime, Float, MetaData, Table, Index
+from sqlalchemy import UniqueConstraint
+from sqlalchemy import and_, or_, true, false, select, update, insert, delete, literal, func, case, exists
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import declarative_base, sessionmaker
 from datetime import datetime, timedelta
+from migrations import apply_migrations, STATISTICS_ROW_ID
+import gzip
+import json
 import logging
+import math
+import os
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
 
 class DBHandler:
-    def __init__(self, database_url):
-        # Create an SQLAlchemy engine and metadata
-        self.engine = create_engine(database_url, echo=True)
+    def __init__(self, database_url, pool_size=5, max_overflow=10, pool_pre_ping=True, pool_recycle=1800, echo=False,
+                 manual_meme_rank=None):
+        # Create one pooled SQLAlchemy engine per process. SQL statement logging is off
+        # unless explicitly requested
+        engine_options = {'echo': echo}
+
+        # SQLite uses its own connection pools that don't accept sizing options
+        if make_url(database_url).get_backend_name() != 'sqlite':
+            engine_options.update(
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_pre_ping=pool_pre_ping,
+                pool_recycle=pool_recycle,
+            )
+
+        self.engine = create_engine(database_url, **engine_options)
+
+        # Session factory shared by all methods
+        self.Session = sessionmaker(bind=self.engine)
+
+        # Rank of manually uploaded memes, counted apart from suggested ones in the statistics
+        self.manual_meme_rank = manual_meme_rank
         self.metadata = MetaData()
 
         # Define tables for memes and statistics
@@ -32,6 +58,136 @@ class DBHandler:
             Column('my_comment', String)
         )
 
+        # Condition for memes waiting to be posted. The queue queries and the partial
+        # index share this exact expression so the planner can match them
+        self.queue_filter = and_(
+            self.memes_table.c.checked == true(),
+            self.memes_table.c.approved == true(),
+            self.memes_table.c.published == false(),
+        )
+
+        self.queue_index = Index(
+            'ix_reddit_items_queue_rank',
+            self.memes_table.c.rank.desc(),
+            postgresql_where=self.queue_filter,
+            sqlite_where=self.queue_filter,
+        )
+
+        # Perceptual hash of every fetched meme image, with the hash split into bands that
+        # are indexed separately for near duplicate lookups. Rows of posted memes are kept
+        # when the memes themselves are removed by the cleanup
+        self.media_hashes_table = Table(
+            'media_hashes',
+            self.metadata,
+            Column('meme_id', Integer, primary_key=True),
+            Column('dhash', String),
+            Column('band0', Integer, index=True),
+            Column('band1', Integer, index=True),
+            Column('band2', Integer, index=True),
+            Column('band3', Integer, index=True),
+            Column('posted', Boolean, index=True),
+            Column('created_at', DateTime),
+        )
+
+        # Posting order precomputed by the scoring engine, position 0 is posted first
+        self.posting_order_table = Table(
+            'posting_order',
+            self.metadata,
+            Column('meme_id', Integer, primary_key=True),
+            Column('position', Integer, index=True),
+            Column('score', Float),
+            Column('computed_at', DateTime),
+        )
+
+        # The queue in posting order is read from two indexes: scored memes by walking the
+        # position index of the posting order, and memes added since the order was last
+        # computed after them, by walking the partial queue index by rank. Each lookup
+        # stops at the first matching rows, whatever the size of the queue
+        self.in_queue = exists().where(
+            self.memes_table.c.id == self.posting_order_table.c.meme_id, self.queue_filter
+        )
+        self.not_scored = ~exists().where(self.posting_order_table.c.meme_id == self.memes_table.c.id)
+
+        # Index used by the nightly cleanup to find old memes without a full scan
+        self.date_added_index = Index('ix_reddit_items_date_added', self.memes_table.c.date_added)
+
+        # Compact copy of removed memes, kept when cleanup runs in archive mode
+        self.archive_table = Table(
+            'reddit_items_archive',
+            self.metadata,
+            Column('archive_id', Integer, primary_key=True),
+            Column('id', Integer),
+            Column('rank', Integer),
+            Column('comments', Integer),
+            Column('url', String),
+            Column('signature', String),
+            Column('posted_by', String),
+            Column('date_added', Date),
+            Column('approved', Boolean),
+            Column('published', Boolean),
+            Column('archived_at', DateTime),
+        )
+
+        # Columns of reddit_items that are copied into the archive
+        self.archived_columns = ['id', 'rank', 'comments', 'url', 'signature', 'posted_by', 'date_added', 'approved',
+                                 'published']
+
+        # Telegram file_id of every uploaded media, keyed by the SHA-256 of its content,
+        # so the same content is sent by reference instead of being uploaded again
+        self.telegram_files_table = Table(
+            'telegram_files',
+            self.metadata,
+            Column('sha256', String, primary_key=True),
+            Column('file_id', String, index=True),
+            Column('media_type', String),
+            Column('created_at', DateTime),
+        )
+
+        # Queue of overlay video renders, processed by the render worker pool
+        self.render_jobs_table = Table(
+            'render_jobs',
+            self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('meme_id', Integer),
+            Column('media_url', String),
+            Column('status', String, index=True),
+            Column('attempts', Integer),
+            Column('error', String),
+            Column('available_at', DateTime),
+            Column('created_at', DateTime),
+            Column('updated_at', DateTime),
+            Column('claimed_by', String),
+        )
+
+        # Lease on every meme that is being posted. A meme whose lease ran out because
+        # the node posting it crashed goes back to the queue
+        self.meme_claims_table = Table(
+            'meme_claims',
+            self.metadata,
+            Column('meme_id', Integer, primary_key=True),
+            Column('node_id', String),
+            Column('claimed_at', DateTime),
+            Column('expires_at', DateTime, index=True),
+        )
+
+        # Delivery status of every meme in every channel it is posted to. The meme and
+        # chat pair is the idempotency key of a send: a meme is sent to a chat only once
+        self.deliveries_table = Table(
+            'deliveries',
+            self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('meme_id', Integer),
+            Column('chat_id', String),
+            Column('status', String),
+            Column('message_id', Integer),
+            Column('error', String),
+            Column('created_at', DateTime),
+            Column('updated_at', DateTime),
+            UniqueConstraint('meme_id', 'chat_id', name='uq_deliveries_meme_chat'),
+        )
+
+        # Running totals, updated in the same transaction as publishing and cleanup. The sum
+        # of ranks keeps the mean exact without reading the memes again
         self.stats_table = Table(
             'statistics',
             self.metadata,
@@ -43,6 +199,7 @@ class DBHandler:
             Column('max_rank_of_suggested', Integer),
             Column('min_rank_of_suggested', Integer),
             Column('mean_rank_of_suggested', Integer),
+            Column('sum_rank_of_suggested', Float),
         )
 
         # Define declarative base classes for memes and statistics
@@ -58,117 +215,706 @@ class DBHandler:
 
         self.Statistics = Statistics
 
+    def migrate(self):
+        try:
+            # Bring the database schema up to date (indexes, new tables and columns)
+            apply_migrations(self)
+        except Exception as e:
+            # Everything else relies on the migrated schema, so the error is raised and the
+            # bot doesn't start without it
+            logging.error(f"Error applying schema migrations: {e}")
+            raise
+
     def get_meme_to_channel(self):
+        # The next meme in posting order, without claiming it
+        memes = self.get_memes_to_channel(1)
+        return memes[0] if memes else None
+
+    def _scored_queue_ids(self):
+        # Ids of the queue in the stored posting order, driven by the position index
+        return (
+            select(self.posting_order_table.c.meme_id)
+            .where(self.in_queue)
+            .order_by(self.posting_order_table.c.position)
+        )
+
+    def _unscored_queue_ids(self):
+        # Ids of queued memes that are not in the posting order yet, by rank
+        return (
+            select(self.memes_table.c.id)
+            .where(self.queue_filter, self.not_scored)
+            .order_by(self.memes_table.c.rank.desc())
+        )
+
+    def get_memes_to_channel(self, limit):
         try:
-            # Create a session to interact with the database
-            Session = sessionmaker(bind=self.engine)
-            with Session() as session:
-                # Query the database for an unchecked, approved, and unpublished meme
-                query = session.query(self.Meme).filter_by(checked=True, approved=True, published=False).order_by(
-                    self.Meme.rank.desc())
-                meme = query.first()
-                return meme
+            # Read the next memes in posting order without claiming them
+            with self.engine.connect() as connection:
+                meme_ids = connection.execute(self._scored_queue_ids().limit(limit)).scalars().all()
+                if len(meme_ids) < limit:
+                    meme_ids += connection.execute(
+                        self._unscored_queue_ids().limit(limit - len(meme_ids))
+                    ).scalars().all()
+
+                rows = {row.id: row for row in connection.execute(
+                    select(self.memes_table).where(self.memes_table.c.id.in_(meme_ids))
+                )}
+                return [rows[meme_id] for meme_id in meme_ids if meme_id in rows]
 
         except Exception as e:
             # Log an error message if an exception occurs during meme retrieval
-            logging.error(f"Error getting meme: {e}")
+            logging.error(f"Error getting memes: {e}")
+            return []
 
-    def mark_as_published(self, meme_id, status):
+    def get_meme(self, meme_id):
         try:
-            # Create a session to interact with the database
-            Session = sessionmaker(bind=self.engine)
-            with Session() as session:
-                # Query the database for the specified meme ID
-                meme = session.query(self.Meme).filter_by(id=meme_id).first()
+            with self.engine.connect() as connection:
+                return connection.execute(select(self.memes_table).where(self.memes_table.c.id == meme_id)).first()
+
+        except Exception as e:
+            # Log an error message if an exception occurs during meme retrieval
+            logging.error(f"Error getting meme id {meme_id}: {e}")
+
+    def claim_meme_to_channel(self, node_id=None, lease=1800):
+        # Pick the first meme in posting order, from the scored memes first. On PostgreSQL
+        # rows locked by another claim are skipped; SQLite drops FOR UPDATE and relies on
+        # its single writer lock. Returns None for an empty queue; database errors are
+        # raised, so a broken database is not mistaken for an empty queue
+        candidates = [
+            self._scored_queue_ids().limit(1).with_for_update(skip_locked=True, of=self.posting_order_table),
+            self._unscored_queue_ids().limit(1).with_for_update(skip_locked=True, of=self.memes_table),
+        ]
+
+        # Mark the meme as published and return it in the same statement
+        statements = [
+            update(self.memes_table)
+            .where(self.memes_table.c.id == candidate.scalar_subquery(), self.queue_filter)
+            .values(published=True)
+            .returning(*self.memes_table.c)
+            for candidate in candidates
+        ]
 
+        now = datetime.utcnow()
+
+        with self.engine.begin() as connection:
+            # The unscored memes are only looked at once no scored meme is left
+            meme = None
+            for statement in statements:
+                meme = connection.execute(statement).first()
                 if meme:
-                    # Update the published status and commit the changes
-                    meme.published = status
-                    session.commit()
-
-        except Exception as e:
-            # Log an error message if an exception occurs during marking as published
-            logging.error(f"Error marking meme as published: {e}")
-
-    def remove_old_memes(self, date):
-        try:
-            # Create a session to interact with the database
-            Session = sessionmaker(bind=self.engine)
-            with Session() as session:
-                # Define a helper function for meme deletion
-                def delete_memes(memes, log_prefix):
-                    if memes:
-                        # Log the number of memes to delete
-                        logging.info(f"Found {len(memes)} {log_prefix} memes to delete.")
-
-                        for meme in memes:
-                            # Log the deletion of each meme and delete it
-                            logging.info(f"Deleting {log_prefix.lower()} meme id: {meme.id}")
-                            session.delete(meme)
-                            logging.info(f"{log_prefix.capitalize()} meme id {meme.id} deleted successfully.")
-
-                        # Commit the changes and log the completion of the deletion process
-                        session.commit()
-                        logging.info(f"{log_prefix.capitalize()} deletion process completed.")
-                    else:
-                        # Log a message if no memes are found to delete
-                        logging.info(f"No {log_prefix.lower()} memes found to delete.")
-
-                # Query the database for memes older than the specified date
-                memes_to_delete = (
-                    session.query(self.Meme)
-                    .filter(self.Meme.date_added <= date, self.Meme.checked == True, self.Meme.approved == False)
-                    .all()
+                    break
+
+            # Take a lease on the meme in the same transaction. Its place in the posting
+            # order is dropped, so the next claim doesn't step over it; a meme that goes
+            # back to the queue is scored again by the next ranking
+            if meme:
+                connection.execute(
+                    delete(self.posting_order_table).where(self.posting_order_table.c.meme_id == meme.id)
+                )
+                connection.execute(delete(self.meme_claims_table).where(self.meme_claims_table.c.meme_id == meme.id))
+                connection.execute(
+                    insert(self.meme_claims_table).values(
+                        meme_id=meme.id, node_id=node_id, claimed_at=now, expires_at=now + timedelta(seconds=lease)
+                    )
+                )
+
+            return meme
+
+    def count_queue(self):
+        try:
+            # Answered from the partial queue index
+            with self.engine.connect() as connection:
+                return connection.execute(
+                    select(func.count()).select_from(self.memes_table).where(self.queue_filter)
+                ).scalar()
+
+        except Exception as e:
+            # Log an error message if an exception occurs during the query
+            logging.error(f"Error counting the queue: {e}")
+            return 0
+
+    def get_queue_for_scoring(self):
+        try:
+            # The columns the scoring engine needs, for the whole queue in one query
+            columns = self.memes_table.c
+            statement = select(
+                columns.id, columns.rank, columns.comments, columns.posted_when, columns.date_added, columns.posted_by
+            ).where(self.queue_filter)
+
+            with self.engine.connect() as connection:
+                return connection.execute(statement).all()
+
+        except Exception as e:
+            # Log an error message if an exception occurs during the query
+            logging.error(f"Error loading the queue for scoring: {e}")
+            return []
+
+    def save_posting_order(self, meme_ids, scores):
+        try:
+            now = datetime.utcnow()
+            rows = [
+                # Pinned memes score infinity, which not every database stores
+                {'meme_id': meme_id, 'position': position, 'score': score if math.isfinite(score) else None,
+                 'computed_at': now}
+                for position, (meme_id, score) in enumerate(zip(meme_ids, scores))
+            ]
+
+            # Replace the whole order at once, so claims never see a mix of two orders
+            with self.Session.begin() as session:
+                session.execute(delete(self.posting_order_table))
+                if rows:
+                    session.execute(insert(self.posting_order_table), rows)
+
+            return len(rows)
+
+        except Exception as e:
+            # Log an error message if an exception occurs while saving
+            logging.error(f"Error saving the posting order: {e}")
+            return 0
+
+    def finish_meme_claim(self, meme_id, posted=False):
+        try:
+            # The post is over, whatever its outcome, so the lease is no longer needed.
+            # A successful post is counted in the statistics in the same transaction
+            with self.Session.begin() as session:
+                session.execute(delete(self.meme_claims_table).where(self.meme_claims_table.c.meme_id == meme_id))
+
+                if posted:
+                    self._count_published(session, [meme_id])
+
+                    # The meme's image is now part of the posting history duplicates are checked against
+                    session.execute(
+                        update(self.media_hashes_table)
+                        .where(self.media_hashes_table.c.meme_id == meme_id)
+                        .values(posted=True)
+                    )
+
+        except Exception as e:
+            # Log an error message if an exception occurs while releasing the lease
+            logging.error(f"Error finishing claim of meme id {meme_id}: {e}")
+
+    def recover_meme_claims(self, main_chat_id, node_id=None):
+        try:
+            claims = self.meme_claims_table.c
+            deliveries = self.deliveries_table.c
+
+            # Expired leases, and with node_id all leases of that node, which are left over
+            # from before a restart
+            condition = claims.expires_at < datetime.utcnow()
+            if node_id:
+                condition = or_(condition, claims.node_id == node_id)
+
+            with self.Session.begin() as session:
+                meme_ids = session.execute(
+                    select(claims.meme_id).where(condition).with_for_update(skip_locked=True)
+                ).scalars().all()
+
+                if not meme_ids:
+                    return 0
+
+                # Memes that reached the main channel, or may have, stay published
+                delivered = dict(session.execute(
+                    select(deliveries.meme_id, deliveries.status).where(
+                        deliveries.meme_id.in_(meme_ids),
+                        deliveries.chat_id == str(main_chat_id),
+                        deliveries.status.in_(('sent', 'sending')),
+                    )
+                ).all())
+
+                # The node died before finishing the claim of the ones that were sent, so
+                # they are counted here, like finish_meme_claim would have
+                sent = [meme_id for meme_id, status in delivered.items() if status == 'sent']
+                if sent:
+                    self._count_published(session, sent)
+                    session.execute(
+                        update(self.media_hashes_table)
+                        .where(self.media_hashes_table.c.meme_id.in_(sent))
+                        .values(posted=True)
+                    )
+
+                requeued = [meme_id for meme_id in meme_ids if meme_id not in delivered]
+                if requeued:
+                    session.execute(
+                        update(self.memes_table).where(self.memes_table.c.id.in_(requeued)).values(published=False)
+                    )
+
+                session.execute(delete(self.meme_claims_table).where(claims.meme_id.in_(meme_ids)))
+                return len(requeued)
+
+        except Exception as e:
+            # Log an error message if an exception occurs during recovery
+            logging.error(f"Error recovering meme claims: {e}")
+            return 0
+
+    def mark_as_published(self, meme_id, status):
+        # Update the published status of a single meme
+        self.set_flags([meme_id], published=status)
+
+    def get_telegram_file(self, sha256=None, file_id=None):
+        try:
+            # Look up an uploaded media by content hash or by its Telegram file_id
+            statement = select(self.telegram_files_table)
+            if sha256:
+                statement = statement.where(self.telegram_files_table.c.sha256 == sha256)
+            else:
+                statement = statement.where(self.telegram_files_table.c.file_id == file_id)
+
+            with self.engine.connect() as connection:
+                return connection.execute(statement.limit(1)).first()
+
+        except Exception as e:
+            # Log an error message if an exception occurs during the lookup
+            logging.error(f"Error getting Telegram file: {e}")
+
+    def save_telegram_file(self, sha256, file_id, media_type, meme_id=None):
+        try:
+            with self.Session.begin() as session:
+                # Record the file_id for this content, replacing an older one if present
+                updated = session.execute(
+                    update(self.telegram_files_table)
+                    .where(self.telegram_files_table.c.sha256 == sha256)
+                    .values(file_id=file_id, media_type=media_type)
+                ).rowcount
+
+                if not updated:
+                    session.execute(
+                        insert(self.telegram_files_table).values(
+                            sha256=sha256, file_id=file_id, media_type=media_type, created_at=datetime.utcnow()
+                        )
+                    )
+
+                # Store it on the meme as well, so reposting it needs no download or upload
+                if meme_id is not None:
+                    session.execute(
+                        update(self.memes_table).where(self.memes_table.c.id == meme_id).values(file_id=file_id)
+                    )
+
+        except Exception as e:
+            # Log an error message if an exception occurs while saving
+            logging.error(f"Error saving Telegram file_id for {sha256}: {e}")
+
+    def forget_telegram_file(self, file_id):
+        try:
+            with self.Session.begin() as session:
+                # Telegram no longer accepts the file_id, e.g. after the file expired. The
+                # content is uploaded again on its next send and gets a new file_id
+                session.execute(delete(self.telegram_files_table).where(self.telegram_files_table.c.file_id == file_id))
+                session.execute(
+                    update(self.memes_table).where(self.memes_table.c.file_id == file_id).values(file_id=None)
                 )
 
-                # Query the database for posted memes older than the specified date
-                posted_memes_to_delete = (
-                    session.query(self.Meme)
-                    .filter(self.Meme.date_added <= date, self.Meme.published == True)
-                    .all()
+        except Exception as e:
+            # Log an error message if an exception occurs while deleting
+            logging.error(f"Error forgetting Telegram file_id {file_id}: {e}")
+
+    def record_delivery(self, meme_id, chat_id, status, message_id=None, error=None):
+        try:
+            now = datetime.utcnow()
+            columns = self.deliveries_table.c
+
+            with self.Session.begin() as session:
+                # One row per meme and channel, updated when the meme is sent there again
+                updated = session.execute(
+                    update(self.deliveries_table)
+                    .where(columns.meme_id == meme_id, columns.chat_id == chat_id)
+                    .values(status=status, message_id=message_id, error=error, updated_at=now)
+                ).rowcount
+
+                if not updated:
+                    session.execute(
+                        insert(self.deliveries_table).values(
+                            meme_id=meme_id, chat_id=chat_id, status=status, message_id=message_id, error=error,
+                            created_at=now, updated_at=now
+                        )
+                    )
+
+        except Exception as e:
+            # Log an error message if an exception occurs while recording
+            logging.error(f"Error recording delivery of meme id {meme_id} to {chat_id}: {e}")
+
+    def get_media_hash(self, meme_id):
+        try:
+            with self.engine.connect() as connection:
+                return connection.execute(
+                    select(self.media_hashes_table.c.dhash).where(self.media_hashes_table.c.meme_id == meme_id)
+                ).scalar()
+
+        except Exception as e:
+            # Log an error message if an exception occurs during the lookup
+            logging.error(f"Error getting media hash of meme id {meme_id}: {e}")
+
+    def save_media_hash(self, meme_id, dhash, bands):
+        try:
+            values = {f'band{index}': band for index, band in enumerate(bands)}
+
+            with self.Session.begin() as session:
+                updated = session.execute(
+                    update(self.media_hashes_table)
+                    .where(self.media_hashes_table.c.meme_id == meme_id)
+                    .values(dhash=dhash, **values)
+                ).rowcount
+
+                if not updated:
+                    session.execute(
+                        insert(self.media_hashes_table).values(
+                            meme_id=meme_id, dhash=dhash, posted=False, created_at=datetime.utcnow(), **values
+                        )
+                    )
+
+        except Exception as e:
+            # Log an error message if an exception occurs while saving
+            logging.error(f"Error saving media hash of meme id {meme_id}: {e}")
+
+    def find_posted_media_hashes(self, band_candidates, exclude_meme_id=None):
+        # Hashes of posted memes matching any of the candidate values in its band; each
+        # band condition is answered by that band's index
+        columns = self.media_hashes_table.c
+        band_conditions = [columns[f'band{index}'].in_(values) for index, values in enumerate(band_candidates)]
+
+        statement = select(columns.meme_id, columns.dhash).where(columns.posted == true(), or_(*band_conditions))
+        if exclude_meme_id is not None:
+            statement = statement.where(columns.meme_id != exclude_meme_id)
+
+        try:
+            with self.engine.connect() as connection:
+                return connection.execute(statement).all()
+
+        except Exception as e:
+            # Log an error message if an exception occurs during the lookup
+            logging.error(f"Error looking up media hashes: {e}")
+            return []
+
+    def reserve_delivery(self, meme_id, chat_id):
+        # Returns True if the meme may be sent to the chat now: it was never sent there or
+        # the last send failed. A delivery that is 'sent', or 'sending' because a node
+        # crashed mid-send, is never sent again. Database errors are raised, so the send
+        # fails rather than going out unrecorded
+        now = datetime.utcnow()
+        columns = self.deliveries_table.c
+
+        try:
+            with self.Session.begin() as session:
+                retried = session.execute(
+                    update(self.deliveries_table)
+                    .where(columns.meme_id == meme_id, columns.chat_id == chat_id, columns.status == 'failed')
+                    .values(status='sending', error=None, updated_at=now)
+                ).rowcount
+
+                if retried:
+                    return True
+
+                existing = session.execute(
+                    select(columns.id).where(columns.meme_id == meme_id, columns.chat_id == chat_id)
+                ).first()
+
+                if existing:
+                    return False
+
+                session.execute(
+                    insert(self.deliveries_table).values(
+                        meme_id=meme_id, chat_id=chat_id, status='sending', created_at=now, updated_at=now
+                    )
+                )
+                return True
+
+        except IntegrityError:
+            # Another node reserved the delivery at the same time
+            return False
+
+    def enqueue_render_job(self, meme_id, media_url):
+        try:
+            now = datetime.utcnow()
+            with self.Session.begin() as session:
+                result = session.execute(
+                    insert(self.render_jobs_table).values(
+                        meme_id=meme_id, media_url=media_url, status='queued', attempts=0, available_at=now,
+                        created_at=now, updated_at=now
+                    )
+                )
+                return result.inserted_primary_key[0]
+
+        except Exception as e:
+            # Log an error message if an exception occurs while queueing
+            logging.error(f"Error queueing render job for meme id {meme_id}: {e}")
+
+    def claim_render_job(self, node_id=None):
+        try:
+            columns = self.render_jobs_table.c
+            now = datetime.utcnow()
+
+            # Take the oldest job that is due, skipping jobs another worker is claiming
+            next_job_id = (
+                select(columns.id)
+                .where(columns.status == 'queued', columns.available_at <= now)
+                .order_by(columns.id)
+                .limit(1)
+                .with_for_update(skip_locked=True)
+                .scalar_subquery()
+            )
+
+            statement = (
+                update(self.render_jobs_table)
+                .where(columns.id == next_job_id, columns.status == 'queued')
+                .values(status='running', attempts=columns.attempts + 1, updated_at=now, claimed_by=node_id)
+                .returning(*columns)
+            )
+
+            with self.engine.begin() as connection:
+                return connection.execute(statement).first()
+
+        except Exception as e:
+            # Log an error message if an exception occurs during claiming
+            logging.error(f"Error claiming render job: {e}")
+
+    def update_render_job(self, job_id, status, error=None, available_at=None):
+        try:
+            values = {'status': status, 'error': error, 'updated_at': datetime.utcnow()}
+            if available_at:
+                values['available_at'] = available_at
+
+            with self.Session.begin() as session:
+                session.execute(
+                    update(self.render_jobs_table).where(self.render_jobs_table.c.id == job_id).values(**values)
                 )
 
-                # Use the helper function to delete memes
-                delete_memes(memes_to_delete, "Unapproved")
-                delete_memes(posted_memes_to_delete, "Posted")
+        except Exception as e:
+            # Log an error message if an exception occurs during the update
+            logging.error(f"Error updating render job {job_id}: {e}")
+
+    def requeue_running_render_jobs(self, node_id=None, stale_before=None):
+        try:
+            columns = self.render_jobs_table.c
+
+            # Jobs left running by a previous process of this node will never finish, and
+            # neither will jobs whose node stopped updating them before stale_before
+            conditions = [columns.claimed_by.is_(None)]
+            if node_id:
+                conditions.append(columns.claimed_by == node_id)
+            if stale_before:
+                conditions.append(columns.updated_at < stale_before)
+
+            with self.Session.begin() as session:
+                return session.execute(
+                    update(self.render_jobs_table)
+                    .where(columns.status == 'running', or_(*conditions))
+                    .values(status='queued', claimed_by=None, updated_at=datetime.utcnow())
+                ).rowcount
+
+        except Exception as e:
+            # Log an error message if an exception occurs during the update
+            logging.error(f"Error requeueing render jobs: {e}")
+            return 0
+
+    def get_render_job_counts(self):
+        try:
+            columns = self.render_jobs_table.c
+            with self.engine.connect() as connection:
+                rows = connection.execute(select(columns.status, func.count()).group_by(columns.status)).all()
+                return {status: count for status, count in rows}
+
+        except Exception as e:
+            # Log an error message if an exception occurs during the query
+            logging.error(f"Error counting render jobs: {e}")
+            return {}
+
+    def remove_old_memes(self, date, chunk_size=1000, archive_mode=None, archive_path=None):
+        try:
+            columns = self.memes_table.c
+
+            # Memes older than the specified date that were rejected
+            unapproved_filter = and_(columns.date_added <= date, columns.checked == true(),
+                                     columns.approved == false())
+
+            # Posted memes older than the specified date
+            posted_filter = and_(columns.date_added <= date, columns.published == true())
+
+            unapproved_removed = self._delete_in_chunks(unapproved_filter, "Unapproved", chunk_size, archive_mode,
+                                                        archive_path)
+            posted_removed = self._delete_in_chunks(posted_filter, "Posted", chunk_size, archive_mode, archive_path)
 
-                return len(memes_to_delete), len(posted_memes_to_delete)
+            return unapproved_removed, posted_removed
         except Exception as e:
             # Log an error message if an exception occurs during the deletion process
             logging.error(f"An error occurred during the deletion process: {e}")
-            return 0  # Return 0 or another appropriate value in case of an error
+            return 0, 0
 
+    def _delete_in_chunks(self, condition, log_prefix, chunk_size, archive_mode, archive_path):
+        columns = self.memes_table.c
+        removed = 0
+
+        while True:
+            # Each chunk is its own short transaction, so the queue is never locked for long
+            with self.Session.begin() as session:
+                # Lock a bounded batch of matching ids. A meme that is being posted is only
+                # locked while its claim commits, after that its lease in meme_claims keeps
+                # it out of the batch. SKIP LOCKED passes over rows other transactions
+                # are writing, e.g. a claim that has not committed yet
+                meme_ids = session.execute(
+                    select(columns.id)
+                    .where(condition, ~exists().where(self.meme_claims_table.c.meme_id == columns.id))
+                    .order_by(columns.id)
+                    .limit(chunk_size)
+                    .with_for_update(skip_locked=True)
+                ).scalars().all()
+
+                if not meme_ids:
+                    break
+
+                if archive_mode == 'table':
+                    # Copy the rows into the archive table inside the same transaction
+                    archived = select(*[columns[name] for name in self.archived_columns],
+                                      literal(datetime.utcnow(), DateTime))
+                    session.execute(
+                        insert(self.archive_table).from_select(
+                            self.archived_columns + ['archived_at'], archived.where(columns.id.in_(meme_ids))
+                        )
+                    )
+                elif archive_mode == 'file':
+                    # Append the rows to a gzip compressed JSONL file before they are deleted.
+                    # A failed delete may archive a row twice, but never loses one
+                    rows = session.execute(
+                        select(*[columns[name] for name in self.archived_columns]).where(columns.id.in_(meme_ids))
+                    ).mappings().all()
+                    self._append_to_archive_file(archive_path, rows)
+
+                session.execute(delete(self.memes_table).where(columns.id.in_(meme_ids)))
+
+                # Hashes of posted memes stay for duplicate detection, the others are useless now
+                session.execute(
+                    delete(self.media_hashes_table).where(
+                        self.media_hashes_table.c.meme_id.in_(meme_ids),
+                        or_(self.media_hashes_table.c.posted.is_(None), self.media_hashes_table.c.posted == false()),
+                    )
+                )
+                # Render jobs, delivery records and leftover positions of removed memes would
+                # otherwise pile up forever
+                for table in (self.render_jobs_table, self.deliveries_table, self.posting_order_table):
+                    session.execute(delete(table).where(table.c.meme_id.in_(meme_ids)))
+                self._update_statistics(session, {'all_deleted_count': len(meme_ids)})
+
+            removed += len(meme_ids)
+            logging.debug("Deleted a chunk of %d %s memes.", len(meme_ids), log_prefix.lower())
+
+        if removed:
+            logging.info(f"{log_prefix.capitalize()} deletion process completed, {removed} memes removed.")
+        else:
+            # Log a message if no memes are found to delete
+            logging.info(f"No {log_prefix.lower()} memes found to delete.")
+
+        return removed
+
+    def _append_to_archive_file(self, archive_path, rows):
+        archive_directory = os.path.dirname(archive_path)
+        if archive_directory:
+            os.makedirs(archive_directory, exist_ok=True)
+
+        # Appending creates a new gzip member, which gzip readers handle transparently
+        archived_at = datetime.utcnow().isoformat()
+        with gzip.open(archive_path, 'at', encoding='utf-8') as archive_file:
+            for row in rows:
+                record = dict(row, archived_at=archived_at)
+                archive_file.write(json.dumps(record, default=str) + '\n')
 
     def mark_as_checked(self, meme_id, status):
+        # Update the checked status of a single meme
+        self.set_flags([meme_id], checked=status)
+
+    def mark_as_approved(self, meme_id, status):
+        # Update the approved status of a single meme
+        self.set_flags([meme_id], approved=status)
+
+    def set_flags(self, meme_ids, checked=None, approved=None, published=None):
+        # Collect only the flags that were given, so any combination can be changed at once
+        flags = {'checked': checked, 'approved': approved, 'published': published}
+        values = {name: value for name, value in flags.items() if value is not None}
+        meme_ids = list(meme_ids)
+
+        if not values or not meme_ids:
+            return 0
+
         try:
-            # Create a session to interact with the database
-            Session = sessionmaker(bind=self.engine)
-            with Session() as session:
-                # Query the database for the specified meme ID
-                meme = session.query(self.Meme).filter_by(id=meme_id).first()
+            # Apply all flag changes to all memes in a single UPDATE statement
+            with self.Session.begin() as session:
+                if published:
+                    # Memes becoming published now are counted in the statistics
+                    newly_published = session.execute(
+                        select(self.memes_table.c.id).where(
+                            self.memes_table.c.id.in_(meme_ids),
+                            or_(self.memes_table.c.published.is_(None), self.memes_table.c.published == false()),
+                        )
+                    ).scalars().all()
 
-                if meme:
-                    # Update the checked status and commit the changes
-                    meme.checked = status
-                    session.commit()
+                result = session.execute(
+                    update(self.memes_table).where(self.memes_table.c.id.in_(meme_ids)).values(**values)
+                )
+
+                if published and newly_published:
+                    self._count_published(session, newly_published)
+
+                return result.rowcount
 
         except Exception as e:
-            # Log an error message if an exception occurs during marking as checked
-            logging.error(f"Error marking meme as checked: {e}")
+            # Log an error message if an exception occurs during the update
+            logging.error(f"Error updating flags of memes {meme_ids}: {e}")
+            return 0
 
-    def mark_as_approved(self, meme_id, status):
-        try:
-            # Create a session to interact with the database
-            Session = sessionmaker(bind=self.engine)
-            with Session() as session:
-                # Query the database for the specified meme ID
-                meme = session.query(self.Meme).filter_by(id=meme_id).first()
+    def _count_published(self, session, meme_ids):
+        # Add published memes to the statistics, in the caller's transaction
+        ranks = session.execute(
+            select(self.memes_table.c.rank).where(self.memes_table.c.id.in_(meme_ids))
+        ).scalars().all()
 
-                if meme:
-                    # Update the approved status and commit the changes
-                    meme.approved = status
-                    session.commit()
+        manual = [rank for rank in ranks if self.manual_meme_rank is not None and rank == self.manual_meme_rank]
+        suggested = [rank or 0 for rank in ranks if self.manual_meme_rank is None or rank != self.manual_meme_rank]
+
+        increments = {
+            'all_published_count': len(ranks),
+            'published_manual_count': len(manual),
+            'published_suggested_count': len(suggested),
+            'sum_rank_of_suggested': sum(suggested),
+        }
+
+        if suggested:
+            self._update_statistics(session, increments, min(suggested), max(suggested))
+        else:
+            self._update_statistics(session, increments)
+
+    def _update_statistics(self, session, increments, min_rank=None, max_rank=None):
+        # Increment the running totals with a single UPDATE, so concurrent transactions
+        # add up instead of overwriting each other
+        stats = self.stats_table.c
+        values = {name: func.coalesce(stats[name], 0) + amount for name, amount in increments.items() if amount}
+
+        if min_rank is not None:
+            values['min_rank_of_suggested'] = case(
+                (or_(stats.min_rank_of_suggested.is_(None), stats.min_rank_of_suggested > min_rank), min_rank),
+                else_=stats.min_rank_of_suggested,
+            )
+            values['max_rank_of_suggested'] = case(
+                (or_(stats.max_rank_of_suggested.is_(None), stats.max_rank_of_suggested < max_rank), max_rank),
+                else_=stats.max_rank_of_suggested,
+            )
+
+        if increments.get('published_suggested_count'):
+            # The right hand side sees the old values, so the new mean is computed from them
+            values['mean_rank_of_suggested'] = (
+                (func.coalesce(stats.sum_rank_of_suggested, 0) + increments['sum_rank_of_suggested'])
+                / (func.coalesce(stats.published_suggested_count, 0) + increments['published_suggested_count'])
+            )
+
+        if values:
+            session.execute(update(self.stats_table).where(stats.id == STATISTICS_ROW_ID).values(**values))
+
+    def get_statistics(self):
+        try:
+            # The totals are kept up to date as memes are published and removed, so this
+            # is a single row lookup
+            with self.engine.connect() as connection:
+                row = connection.execute(
+                    select(self.stats_table).where(self.stats_table.c.id == STATISTICS_ROW_ID)
+                ).mappings().first()
+                return dict(row) if row else None
 
         except Exception as e:
-            # Log an error message if an exception occurs during marking as approved
-            logging.error(f"Error marking meme as approved: {e}")
+            # Log an error message if an exception occurs during the query
+            logging.error(f"Error getting statistics: {e}")
@@ -0,0 +1,111 @@
+from mimetypes import guess_extension
+import hashlib
+import logging
+import requests
+
+# Size of the chunks read from the network and written to disk
+CHUNK_SIZE = 64 * 1024
+
+
+class MediaTooLargeError(Exception):
+    pass
+
+
+class HashingWriter:
+    def __init__(self, file, max_bytes=None):
+        # File-like wrapper that hashes and counts the bytes written through it,
+        # and stops the download as soon as it goes over max_bytes
+        self.file = file
+        self.max_bytes = max_bytes
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk):
+        self.size += len(chunk)
+
+        if self.max_bytes and self.size > self.max_bytes:
+            raise MediaTooLargeError(f"Media is larger than {self.max_bytes} bytes")
+
+        self.sha256.update(chunk)
+        return self.file.write(chunk)
+
+    def seek(self, offset, whence=0):
+        # Storage clients rewind the stream when they restart a download from scratch
+        if offset != 0 or whence != 0:
+            raise ValueError("HashingWriter can only be rewound to the start")
+
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.file.seek(0)
+        self.file.truncate()
+        return 0
+
+    def tell(self):
+        return self.size
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def check_content_length(headers, max_bytes):
+    content_length = headers.get('content-length')
+
+    if max_bytes and content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        raise MediaTooLargeError(f"Media is {content_length} bytes, limit is {max_bytes}")
+
+
+def extension_for_content_type(content_type):
+    # Content types may carry parameters, e.g. "image/jpeg; charset=binary"
+    return guess_extension(content_type.split(';')[0].strip()) or ''
+
+
+def head_media(url, max_bytes, timeout):
+    # Reject oversized media before downloading it. Servers that don't answer HEAD
+    # are not an error, the size is checked again while streaming
+    try:
+        response = requests.head(url, allow_redirects=True, timeout=timeout)
+    except requests.RequestException as e:
+        logging.debug("HEAD request for %s failed: %s", url, e)
+        return
+
+    if response.status_code == 200:
+        check_content_length(response.headers, max_bytes)
+
+
+def stream_url_to_file(url, file, max_bytes=None, timeout=30, head_check=True):
+    # Stream the response body to the file chunk by chunk, hashing it on the way.
+    # Returns (content_type, sha256, size); memory use does not depend on the media size
+    if head_check:
+        head_media(url, max_bytes, timeout)
+
+    with requests.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        check_content_length(response.headers, max_bytes)
+
+        writer = HashingWriter(file, max_bytes)
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            writer.write(chunk)
+
+        return response.headers.get('content-type'), writer.hexdigest(), writer.size
+
+
+def stream_blob_to_file(blob, file, max_bytes=None, timeout=60):
+    # Same as stream_url_to_file for a Firebase storage blob. The blob metadata is
+    # loaded first so the size limit is enforced before anything is downloaded
+    blob.reload(timeout=timeout)
+
+    if max_bytes and blob.size and blob.size > max_bytes:
+        raise MediaTooLargeError(f"Blob {blob.name} is {blob.size} bytes, limit is {max_bytes}")
+
+    writer = HashingWriter(file, max_bytes)
+    blob.download_to_file(writer, timeout=timeout)
+
+    return blob.content_type, writer.hexdigest(), writer.size
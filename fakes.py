@@ -0,0 +1,195 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from PIL import Image
+from telebot.apihelper import ApiTelegramException
+import itertools
+import random
+import threading
+import time
+
+# Local stand-ins for Telegram, Firebase storage and the media origin, with configurable
+# latency, so the posting pipeline can be measured offline
+
+
+def synthetic_image(seed, width=800, height=600, quality=90):
+    # A deterministic JPEG per seed: a gradient with a few rectangles, so every meme
+    # has different content and a different perceptual hash
+    generator = random.Random(seed)
+    image = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    pixels = image.load()
+
+    for _ in range(6):
+        left, top = generator.randrange(width - 100), generator.randrange(height - 100)
+        color = tuple(generator.randrange(256) for _ in range(3))
+        for x in range(left, left + generator.randrange(20, 100)):
+            for y in range(top, top + 40):
+                pixels[x, y] = color
+
+    buffer = BytesIO()
+    image.save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+class FakeFile:
+    def __init__(self, file_id):
+        self.file_id = file_id
+
+
+class FakeMessage:
+    def __init__(self, message_id, photo=None, video=None):
+        self.message_id = message_id
+        self.photo = photo
+        self.video = video
+
+
+class FakeBot:
+    def __init__(self, latency=0.0, upload_bytes_per_second=None, error_rate=0.0, seed=0):
+        # Every call takes latency seconds, uploads additionally size / upload_bytes_per_second.
+        # error_rate of the calls fail with a 502 like a Telegram outage
+        self.latency = latency
+        self.upload_bytes_per_second = upload_bytes_per_second
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.message_ids = itertools.count(1)
+        self.calls = 0
+        self.uploaded_bytes = 0
+
+    def _respond(self, content, media_type):
+        with self.lock:
+            self.calls += 1
+            failed = self.random.random() < self.error_rate
+
+        delay = self.latency
+        if hasattr(content, 'read'):
+            size = len(content.read())
+            with self.lock:
+                self.uploaded_bytes += size
+            if self.upload_bytes_per_second:
+                delay += size / self.upload_bytes_per_second
+
+        time.sleep(delay)
+
+        if failed:
+            raise ApiTelegramException('send', None, {'error_code': 502, 'description': 'Bad Gateway'})
+
+        message_id = next(self.message_ids)
+        file_id = content if isinstance(content, str) else f'{media_type}-{message_id}'
+
+        if media_type == 'photo':
+            return FakeMessage(message_id, photo=[FakeFile(f'{file_id}-small'), FakeFile(file_id)])
+        if media_type == 'video':
+            return FakeMessage(message_id, video=FakeFile(file_id))
+        return FakeMessage(message_id)
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        return self._respond(photo, 'photo')
+
+    def send_video(self, chat_id, video, **kwargs):
+        return self._respond(video, 'video')
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._respond(text, 'message')
+
+
+class FakeBlob:
+    def __init__(self, bucket, name, generation=None):
+        self.bucket = bucket
+        self.name = name
+        self.generation = generation or 1
+        self.content_type = 'video/mp4' if name.endswith('.mp4') else 'image/jpeg'
+
+    @property
+    def size(self):
+        return len(self.bucket.objects.get(self.name, b''))
+
+    def reload(self, timeout=None):
+        time.sleep(self.bucket.latency)
+
+    def download_to_file(self, file, timeout=None):
+        time.sleep(self.bucket.latency)
+        file.write(self.bucket.objects[self.name])
+
+    def delete(self):
+        self.bucket.objects.pop(self.name, None)
+
+
+class FakeBucket:
+    def __init__(self, objects=None, latency=0.0):
+        # objects maps blob names to their content
+        self.objects = dict(objects or {})
+        self.latency = latency
+
+    def blob(self, name, generation=None):
+        return FakeBlob(self, name, generation)
+
+    def list_blobs(self, prefix=''):
+        time.sleep(self.latency)
+        return [FakeBlob(self, name) for name in sorted(self.objects) if name.startswith(prefix)]
+
+
+class MediaOriginHandler(BaseHTTPRequestHandler):
+    def _content(self):
+        # /media/<seed>.jpg is the synthetic image for that seed
+        name = self.path.rsplit('/', 1)[-1]
+        seed = name.split('.')[0]
+        if not seed.isdigit():
+            return None
+        return self.server.image(int(seed))
+
+    def _respond(self, with_body):
+        time.sleep(self.server.latency)
+        content = self._content()
+
+        if content is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(content)
+
+    def do_HEAD(self):
+        self._respond(False)
+
+    def do_GET(self):
+        self._respond(True)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MediaOrigin(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, width=800, height=600):
+        # Serves synthetic images on a free local port after every request waited latency seconds
+        super().__init__(('127.0.0.1', 0), MediaOriginHandler)
+        self.latency = latency
+        self.width = width
+        self.height = height
+        self.images = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, name='media-origin', daemon=True)
+
+    def image(self, seed):
+        with self.lock:
+            if seed not in self.images:
+                self.images[seed] = synthetic_image(seed, self.width, self.height)
+            return self.images[seed]
+
+    def url(self, seed):
+        return f'http://127.0.0.1:{self.server_address[1]}/media/{seed}.jpg'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
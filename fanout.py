@@ -0,0 +1,24 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import logging
+
+
+class FanoutSender:
+    def __init__(self, max_workers=8):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fanout')
+
+    def send_all(self, chat_ids, send):
+        # Run send(chat_id) for all chats at the same time, so posting takes as long as the
+        # slowest chat rather than the sum of all of them. An error in one chat doesn't
+        # affect the others. Returns {chat_id: (message, error)}
+        futures = {self.executor.submit(send, chat_id): chat_id for chat_id in chat_ids}
+        results = {}
+
+        for future in as_completed(futures):
+            chat_id = futures[future]
+            try:
+                results[chat_id] = (future.result(), None)
+            except Exception as e:
+                logging.error(f"Error sending to chat {chat_id}: {e}")
+                results[chat_id] = (None, e)
+
+        return results
@@ -0,0 +1,63 @@
+from PIL import Image, UnidentifiedImageError
+import itertools
+import numpy as np
+
+# dHash of HASH_SIZE x HASH_SIZE bits, split into BANDS bands for the Hamming index
+HASH_SIZE = 8
+BANDS = 4
+BAND_BITS = HASH_SIZE * HASH_SIZE // BANDS
+
+
+def dhash(path, hash_size=HASH_SIZE):
+    # Difference hash: shrink the grayscale image to (hash_size + 1) x hash_size and
+    # record for every pixel whether it is brighter than its left neighbour. Rescaled,
+    # recompressed or slightly edited copies of an image get the same or a close hash.
+    # Returns None for files Pillow can't read, e.g. videos
+    try:
+        with Image.open(path) as image:
+            small = image.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS)
+    except (UnidentifiedImageError, OSError):
+        return None
+
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+
+def format_hash(value):
+    return f'{value:0{HASH_SIZE * HASH_SIZE // 4}x}'
+
+
+def parse_hash(text):
+    return int(text, 16)
+
+
+def hamming_distance(first, second):
+    return bin(first ^ second).count('1')
+
+
+def hash_bands(value):
+    # The hash split into BANDS integers of BAND_BITS bits each
+    mask = (1 << BAND_BITS) - 1
+    return [(value >> (BAND_BITS * band)) & mask for band in range(BANDS)]
+
+
+def band_neighbors(band, radius):
+    # All band values within radius bits of band
+    values = [band]
+    for distance in range(1, radius + 1):
+        for positions in itertools.combinations(range(BAND_BITS), distance):
+            flipped = band
+            for position in positions:
+                flipped ^= 1 << position
+            values.append(flipped)
+    return values
+
+
+def candidate_bands(value, max_distance):
+    # Multi-index lookup: two hashes at most max_distance bits apart differ in at most
+    # max_distance // BANDS bits in at least one band. Searching every band for values
+    # that close finds all near duplicates with a few indexed lookups instead of
+    # comparing against every stored hash
+    radius = max_distance // BANDS
+    return [band_neighbors(band, radius) for band in hash_bands(value)]
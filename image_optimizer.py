@@ -0,0 +1,139 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from PIL import Image, ImageOps, UnidentifiedImageError
+from downloads import HashingWriter
+import logging
+import os
+import threading
+
+# Telegram shows photos at up to 2560 pixels on the long side and recompresses anything bigger
+TELEGRAM_MAX_SIDE = 2560
+
+# Images are never shrunk below this size to meet the byte limit
+MIN_SIDE = 320
+
+
+def has_transparency(image):
+    return image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+
+
+def encode_image(image, transparent, quality):
+    # Saving without the exif and info of the source strips all metadata
+    buffer = BytesIO()
+    if transparent:
+        image.save(buffer, 'PNG', optimize=True)
+    else:
+        image.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def optimize_image(path, max_side=TELEGRAM_MAX_SIDE, quality=85, max_bytes=None, min_quality=60):
+    # Downscale the image to max_side, recompress it (JPEG, or PNG to keep transparency)
+    # and strip its metadata. Quality, then size, is lowered until it fits max_bytes.
+    # Returns (data, extension), or None when the image can't be improved: unreadable
+    # files, videos, animations, or a result that is not smaller than the original
+    try:
+        source = Image.open(path)
+    except (UnidentifiedImageError, OSError):
+        return None
+
+    with source:
+        if getattr(source, 'is_animated', False):
+            return None
+
+        # Apply the EXIF orientation before the EXIF data is dropped
+        image = ImageOps.exif_transpose(source)
+        transparent = has_transparency(image)
+        image = image.convert('RGBA' if transparent else 'RGB')
+
+    resized = max(image.size) > max_side
+    if resized:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    while True:
+        data = encode_image(image, transparent, quality)
+
+        if not max_bytes or len(data) <= max_bytes:
+            break
+
+        if not transparent and quality > min_quality:
+            quality = max(min_quality, quality - 10)
+            continue
+
+        if min(image.size) * 3 // 4 < MIN_SIDE:
+            break
+
+        image = image.resize((image.width * 3 // 4, image.height * 3 // 4), Image.LANCZOS)
+        resized = True
+
+    if not resized and len(data) >= os.path.getsize(path):
+        return None
+
+    return data, '.png' if transparent else '.jpg'
+
+
+class ImageOptimizer:
+    def __init__(self, media_cache, max_workers=2, max_side=TELEGRAM_MAX_SIDE, quality=85, max_bytes=None,
+                 timeout=120):
+        # Runs optimize_image in a pool of worker processes, so decoding and encoding big
+        # images doesn't hold the GIL of the posting threads. Results are stored in the
+        # media cache under the hash of the original, so each image is optimized once.
+        # The keys of images that can't be improved are remembered as well, otherwise
+        # small JPEGs and animations would be decoded again for every caller
+        self.media_cache = media_cache
+        self.max_workers = max_workers
+        self.options = {'max_side': max_side, 'quality': quality, 'max_bytes': max_bytes}
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        self.unimproved = set()
+
+    def cache_key(self, media_path):
+        options = ':'.join(str(self.options[name]) for name in ('max_side', 'quality', 'max_bytes'))
+        return f"optimized:{self.media_cache.content_hash(media_path)}:{options}"
+
+    def optimize(self, media_path):
+        # Returns the path of the optimized image, or media_path if it can't be improved
+        key = self.cache_key(media_path)
+
+        cached_path = self.media_cache.get(key)
+        if cached_path or key in self.unimproved:
+            return cached_path or media_path
+
+        try:
+            result = self._run(media_path)
+        except Exception as e:
+            # Failures are not remembered, the next call tries again
+            logging.error(f"Error optimizing {media_path}: {e}")
+            return media_path
+
+        if result is None:
+            with self.lock:
+                self.unimproved.add(key)
+            return media_path
+
+        data, extension = result
+
+        def write(file):
+            writer = HashingWriter(file)
+            writer.write(data)
+            return None, writer.hexdigest(), writer.size
+
+        optimized_path = self.media_cache.fetch(key, write, extension=extension)
+        logging.info(f"Optimized {media_path} from {os.path.getsize(media_path)} to {len(data)} bytes")
+        return optimized_path
+
+    def _run(self, media_path):
+        try:
+            with self.lock:
+                future = self.executor.submit(optimize_image, media_path, **self.options)
+            return future.result(timeout=self.timeout)
+
+        except BrokenProcessPool:
+            # A worker died, e.g. on a decompression bomb; start a new pool for the next image
+            with self.lock:
+                self.executor.shutdown(wait=False)
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            raise
@@ -0,0 +1,41 @@
+import json
+import logging
+
+# Attributes every log record has; anything else was passed with extra= and is a field
+STANDARD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line, with the fields passed in extra= next to the message
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        entry.update({name: value for name, value in vars(record).items() if name not in STANDARD_ATTRIBUTES})
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level='INFO', log_format='text'):
+    # Configure the root logger once for the whole process. Messages below level are
+    # dropped before they are formatted
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT))
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+
+    # Chatty libraries only log warnings, unless the bot itself is debugging
+    if root.level > logging.DEBUG:
+        for name in ('urllib3', 'PIL', 'google', 'TeleBot'):
+            logging.getLogger(name).setLevel(logging.WARNING)
@@ -1,60 +1,203 @@
+import argparse
 import logging
-import schedule
-import telebot
 import time
 import os
+import sys
 from datetime import datetime, timedelta
+from types import SimpleNamespace
 from config import *
-from io import BytesIO
+from logging_config import configure_logging
+from scheduler import EventScheduler, CalendarTrigger, parse_calendar
+from metrics import Gauge, track, start_metrics_server, BYTES_TRANSFERRED, POSTS
 
+# The Telegram client, Pillow, numpy and the worker pools are only imported and created
+# when a command uses them, see the factories at the end of this module
 
-# Initializing bot
-bot = telebot.TeleBot('your_telegram_bot_token')
+# All sends go through the rate limiter, which retries flood waits, server errors and
+# failed connections. TELEGRAM_CHAT_RATE is the number of sends per minute to any one chat
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', 20)) / 60
+TELEGRAM_CHAT_BURST = int(os.environ.get('TELEGRAM_CHAT_BURST', 3))
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30))
+TELEGRAM_SEND_ATTEMPTS = int(os.environ.get('TELEGRAM_SEND_ATTEMPTS', 5))
 
 # Defining target channel ID and status channel ID
 target_channel_id = '-1002115819190'
 status_chat_id = '-1001999613821'
 code_review_video_id = '-1002226599559'
 
-# Define constants for time intervals
-MORNING_TIMES = [
-    convert_to_local_time(8, 45),
-]
+# Supporting channels that receive every post too, as a comma separated list of chat IDs
+supporting_channel_ids = [chat_id.strip() for chat_id in os.environ.get('SUPPORTING_CHANNEL_IDS', '').split(',')
+                          if chat_id.strip()]
 
-EVENING_TIMES = [
-    convert_to_local_time(15, 45),
-    convert_to_local_time(20, 45),
-]
+# All channels memes are posted to, the main channel first
+posting_channel_ids = [target_channel_id] + supporting_channel_ids
 
-# Get the current working directory
-current_directory = os.getcwd()
+# Posting calendar: slots per weekday in POSTING_TIMEZONE, e.g.
+# "mon-fri=08:45,15:45,20:45;sat,sun=11:00,19:00". Times are local to the timezone,
+# including across daylight saving changes
+POSTING_TIMEZONE = os.environ.get('POSTING_TIMEZONE', 'Europe/Moscow')
+POSTING_CALENDAR = parse_calendar(os.environ.get('POSTING_CALENDAR', 'mon-sun=08:45,15:45,20:45'))
 
-# Specify the subdirectory for media storage (one directory back)
-media_subdir = os.path.join(current_directory, '..')
+# Slots missed while the bot was held up: 'skip' them, post once for the 'latest' one or
+# post for 'all' of them, as long as they are at most POSTING_CATCH_UP_WINDOW seconds old
+POSTING_CATCH_UP = os.environ.get('POSTING_CATCH_UP', 'latest')
+POSTING_CATCH_UP_WINDOW = int(os.environ.get('POSTING_CATCH_UP_WINDOW', 3600))
 
-# Construct the full path to the media directory
-media_dir = os.path.join(media_subdir, 'media')
+# Old memes are removed from the database every night
+CLEANUP_CALENDAR = parse_calendar(os.environ.get('CLEANUP_CALENDAR', 'mon-sun=03:00'))
 
-# Ensure the directory exists for media storage
-if not os.path.exists(media_dir):
-    os.makedirs(media_dir)
+# A digest of the statistics is sent to the status channel every evening
+STATS_DIGEST_CALENDAR = parse_calendar(os.environ.get('STATS_DIGEST_CALENDAR', 'mon-sun=22:00'))
+
+# Prometheus style metrics endpoint
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9100))
+
+# Scheduled jobs run in a pool of worker threads
+SCHEDULER_WORKERS = int(os.environ.get('SCHEDULER_WORKERS', 4))
 
 # Set the maximum number of attempts for posting
 MAX_ATTEMPTS = 3
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+# Seconds a replica may take to post a meme it claimed before the meme goes back to the queue.
+# Every replica renders, but only the leader runs the scheduled jobs
+MEME_CLAIM_LEASE = int(os.environ.get('MEME_CLAIM_LEASE', 1800))
+
+# Prefetch the media of the next memes this many minutes before each posting slot.
+# One meme per posting attempt is staged, so retries don't wait for a download either
+PREFETCH_LEAD_MINUTES = int(os.environ.get('PREFETCH_LEAD_MINUTES', 10))
+PREFETCH_COUNT = int(os.environ.get('PREFETCH_COUNT', MAX_ATTEMPTS))
+PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS', 4))
+
+# Weights of the queue scoring: rank and comment count, halved every SCORE_HALF_LIFE_HOURS
+# of age, with each further meme of the same author multiplied by SCORE_DIVERSITY_PENALTY.
+# Manually uploaded memes always go first
+SCORING = {
+    'rank_weight': float(os.environ.get('SCORE_RANK_WEIGHT', 1.0)),
+    'comments_weight': float(os.environ.get('SCORE_COMMENTS_WEIGHT', 0.25)),
+    'half_life_hours': float(os.environ.get('SCORE_HALF_LIFE_HOURS', 72)),
+    'diversity_penalty': float(os.environ.get('SCORE_DIVERSITY_PENALTY', 0.7)),
+    'pinned_rank': MANUAL_MEME_RANK,
+}
+
+# Images within this many bits of the perceptual hash of a posted meme are duplicates
+DUPLICATE_MAX_DISTANCE = int(os.environ.get('DUPLICATE_MAX_DISTANCE', 6))
+
+# Sends to all posting channels at the same time
+FANOUT_WORKERS = int(os.environ.get('FANOUT_WORKERS', 8))
+
+# Overlay videos are rendered by a pool of worker processes, with retries for failed renders
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', 2))
+RENDER_MAX_ATTEMPTS = int(os.environ.get('RENDER_MAX_ATTEMPTS', 3))
+RENDER_RETRY_DELAY = int(os.environ.get('RENDER_RETRY_DELAY', 60))
+RENDER_LEASE = int(os.environ.get('RENDER_LEASE', 3600))
+
+# Queued renders are taken up to RENDER_BATCH_SIZE at a time; a batch shares one background
+# video, which ffmpeg decodes once for all of its memes
+RENDER_BATCH_SIZE = int(os.environ.get('RENDER_BATCH_SIZE', 4))
+
+# Encoder settings for renders: a named profile (fast, balanced or small), optionally with
+# an explicit preset, thread count per encode and codec (e.g. a hardware encoder)
+RENDER_ENCODER = {
+    'profile': os.environ.get('RENDER_PROFILE', 'balanced'),
+    'preset': os.environ.get('RENDER_PRESET') or None,
+    'threads': int(os.environ.get('RENDER_THREADS', 0)) or None,
+    'codec': os.environ.get('RENDER_CODEC', 'libx264'),
+}
+
+# 'template' overlays one pre-composited full frame, 'layers' overlays the meme and the
+# caption badge separately
+RENDER_OVERLAY_MODE = os.environ.get('RENDER_OVERLAY_MODE', 'template')
+
+
+def create_bot():
+    import telebot
+    return telebot.TeleBot('your_telegram_bot_token')
+
+
+def create_telegram_sender():
+    from telegram_sender import TelegramSender
+
+    return TelegramSender(
+        app.bot,
+        chat_rate=TELEGRAM_CHAT_RATE,
+        chat_burst=TELEGRAM_CHAT_BURST,
+        global_rate=TELEGRAM_GLOBAL_RATE,
+        max_attempts=TELEGRAM_SEND_ATTEMPTS,
+    )
+
+
+def create_leader():
+    from coordination import LeaderElection
+    return LeaderElection(app.db_handler.engine, node_id=NODE_ID)
+
+
+def create_fanout():
+    from fanout import FanoutSender
+    return FanoutSender(max_workers=FANOUT_WORKERS)
+
+
+def create_prefetcher():
+    # Prefetched media is staged in the media cache
+    from prefetch import MediaPrefetcher
+    return MediaPrefetcher(prefetch_meme_media, max_workers=PREFETCH_WORKERS)
+
+
+def create_render_pool():
+    # The pool is started by schedule_posting
+    from render_worker import RenderWorkerPool
+    from video_render import render_overlay_batch
+
+    return RenderWorkerPool(
+        app.db_handler,
+        prepare_render_jobs,
+        render_overlay_batch,
+        send_video_to_dm,
+        concurrency=RENDER_WORKERS,
+        max_attempts=RENDER_MAX_ATTEMPTS,
+        retry_delay=RENDER_RETRY_DELAY,
+        node_id=NODE_ID,
+        lease=RENDER_LEASE,
+        batch_size=RENDER_BATCH_SIZE,
+    )
+
+
+def leader_only(job):
+    # Scheduled jobs run on every replica, but only do their work on the leader
+    def run():
+        if app.leader.is_leader():
+            job()
+        else:
+            logging.info(f"Node {NODE_ID} is not the leader, skipping {job.__name__}.")
+    return run
 
 
 def post_to_channel():
     try:
         logging.info("Attempting to post to the channel...")
+
+        # Memes claimed by a replica that died while posting them go back to the queue
+        requeued = app.db_handler.recover_meme_claims(target_channel_id)
+        if requeued:
+            logging.warning(f"Returned {requeued} memes with expired claims to the queue.")
+
         for attempt in range(1, MAX_ATTEMPTS + 1):
-            meme = db_handler.get_meme_to_channel()
+            # Pick the next meme and mark it as published in a single statement, under a lease
+            try:
+                with track('claim_meme_to_channel'):
+                    meme = app.db_handler.claim_meme_to_channel(node_id=NODE_ID, lease=MEME_CLAIM_LEASE)
+            except Exception as e:
+                logging.error(f"Error claiming a meme to post: {e}")
+                POSTS.inc(outcome='error')
+                break
             if not meme:
                 logging.info("No meme found to post.")
+                POSTS.inc(outcome='queue_empty')
                 break
-            if post_single_meme(meme):
+            posted = post_single_meme(meme)
+            app.db_handler.finish_meme_claim(meme.id, posted=posted)
+            POSTS.inc(outcome='posted' if posted else 'failed')
+            if posted:
                 break
             logging.warning(f"Error posting current meme (attempt {attempt}/{MAX_ATTEMPTS}). Trying another meme.")
         else:
@@ -63,92 +206,323 @@ def post_to_channel():
         logging.error(f"Error posting to channel: {e}")
 
 
+def rank_queue():
+    try:
+        # Score the whole queue in one pass and store the resulting posting order, which
+        # the claims then just read from the top
+        from scoring import score_queue
+
+        started_at = time.monotonic()
+        meme_ids, scores = score_queue(app.db_handler.get_queue_for_scoring(), **SCORING)
+        saved = app.db_handler.save_posting_order(meme_ids, scores)
+        logging.info(f"Ranked {saved} memes in the queue in {time.monotonic() - started_at:.2f}s.")
+    except Exception as e:
+        logging.error(f"Error ranking the queue: {e}")
+
+
+def prefetch_memes():
+    try:
+        # Rank the queue ahead of the posting slot, then stage the media of the next memes.
+        # The downloads run in the prefetch worker pool, so the scheduler is not blocked
+        rank_queue()
+        memes = app.db_handler.get_memes_to_channel(PREFETCH_COUNT)
+        app.prefetcher.prefetch(memes)
+        app.prefetcher.discard_stale()
+    except Exception as e:
+        logging.error(f"Error prefetching memes: {e}")
+
+
 def post_single_meme(meme):
+    from telegram_sender import RejectedMediaError, UncertainSendError
+
     try:
         if not (meme.file_id or meme.url):
             logging.warning("Meme has no file_id or URL. Cannot post.")
             mark_to_delete(meme)
             return False
 
-        media = meme.file_id if meme.file_id else download_media_to_channel(meme.url)
+        # A meme that was uploaded before carries the Telegram file_id of that upload
+        telegram_file = app.db_handler.get_telegram_file(file_id=meme.file_id) if meme.file_id else None
+        if telegram_file:
+            logging.info("Sending meme by reference to its earlier upload.")
+            try:
+                deliver_to_channels(
+                    meme, posting_channel_ids, lambda chat_id: send_by_reference(chat_id, telegram_file, meme.my_comment)
+                )
+                logging.info("Post successful.", extra={'meme_id': meme.id})
+                return True
+            except RejectedMediaError as e:
+                # Telegram refused the file_id, not the meme, so it is uploaded again below
+                logging.warning(f"Telegram refused the file_id of meme id {meme.id}, uploading it again: {e}")
+                app.db_handler.forget_telegram_file(telegram_file.file_id)
+
+        # Use the media staged by the prefetch job, downloading it now only if it is missing.
+        # Nothing is staged when no prefetch ran in this process, e.g. for post-now
+        staged = app.prefetcher.take(meme) if app.loaded('prefetcher') else None
+        media = staged or fetch_meme_media(meme)
+
+        duplicate_of = find_duplicate(meme, media) if media else None
+        if duplicate_of:
+            logging.warning(f"Meme id {meme.id} is a duplicate of posted meme id {duplicate_of}, rejecting it.")
+            mark_to_delete(meme)
+            return False
 
         if media:
             caption = meme.my_comment
-            send_media_to_channel(media, meme, caption)
-            db_handler.mark_as_published(meme.id, True)
-            logging.info("Post successful.")
+            upload_path = optimize_media(media)
+            with track('send_media_to_channel'):
+                send_media_to_channel(upload_path, meme, caption)
+            logging.info("Post successful.", extra={'meme_id': meme.id})
             return True
 
         logging.warning("Error posting meme: Media not found.")
         mark_to_delete(meme)
         return False
+    except UncertainSendError as e:
+        # The main channel send timed out after it reached Telegram. The meme is most likely
+        # posted, and posting another one into the same slot would be worse than a gap
+        logging.warning(f"Meme id {meme.id} may have been posted, not posting another meme: {e}")
+        return True
+    except RejectedMediaError as e:
+        # Telegram refused the media itself, posting it again would fail the same way
+        logging.error(f"Telegram rejected meme id {meme.id}: {e}")
+        mark_to_delete(meme)
+        return False
     except Exception as e:
+        # Anything else may work next time, so the meme goes back to the queue
         logging.error(f"Error posting meme: {e}")
-        mark_to_delete(meme)
+        release_meme(meme)
         return False
 
 
-def send_media_to_channel(media_path, meme, caption=None):
-    logging.info("Started sending media to channel")
+def find_duplicate(meme, media_path):
+    # Returns the id of an already posted meme with the same or a very similar image.
+    # The hash is computed once per meme, when its media is first fetched
+    from image_hash import dhash, format_hash, parse_hash, hash_bands, candidate_bands, hamming_distance
+
     try:
-        if media_path.lower().endswith(('mp4', 'mov', 'avi')):
-            send_method = bot.send_video
+        stored_hash = app.db_handler.get_media_hash(meme.id)
+        if stored_hash:
+            value = parse_hash(stored_hash)
         else:
-            send_method = bot.send_photo
-
-        if meme.rank == 99999:
-            logging.info("Trying to find file in data storage")
-            file_data = None
-            for attempt in range(3):
-                try:
-                    blob = bucket.blob(media_path)
-                    logging.info(f"Attempt {attempt + 1}: Downloading file from data storage")
-                    file_data = blob.download_as_bytes()
-                    logging.info("File successfully found and downloaded")
-                    break
-                except Exception as e:
-                    logging.error(f"Attempt {attempt + 1} failed: {e}")
-                    if attempt < 2:
-                        logging.info("Retrying after 3 seconds...")
-                        time.sleep(3)
-                    else:
-                        logging.critical("All attempts to download the file have failed")
-                        return
-
-            if file_data:
-                if caption:
-                    send_method(target_channel_id, BytesIO(file_data), caption=caption)
-                else:
-                    send_method(target_channel_id, BytesIO(file_data))
-                blob.delete()
-        else:
-            with open(media_path, 'rb') as file:
-                if caption:
-                    send_method(target_channel_id, file, caption=caption)
-                else:
-                    send_method(target_channel_id, file)
-                send_video_to_dm(media_path)
+            value = dhash(media_path)
+            if value is None:
+                return None
+            app.db_handler.save_media_hash(meme.id, format_hash(value), hash_bands(value))
+
+        candidates = app.db_handler.find_posted_media_hashes(
+            candidate_bands(value, DUPLICATE_MAX_DISTANCE), exclude_meme_id=meme.id
+        )
+        for meme_id, other_hash in candidates:
+            if hamming_distance(value, parse_hash(other_hash)) <= DUPLICATE_MAX_DISTANCE:
+                return meme_id
+
     except Exception as e:
-        logging.error(f"Error sending media to channel: {e}")
+        logging.error(f"Error checking meme id {meme.id} for duplicates: {e}")
+
+    return None
+
+
+def prefetch_meme_media(meme):
+    # Duplicates found while prefetching are taken out of the queue before their slot
+    media_path = fetch_meme_media(meme)
+
+    duplicate_of = find_duplicate(meme, media_path) if media_path else None
+    if duplicate_of:
+        logging.warning(f"Meme id {meme.id} is a duplicate of posted meme id {duplicate_of}, rejecting it.")
+        mark_to_delete(meme)
+        return None
+
+    # Optimize the image now too, the post then finds it in the media cache
+    if media_path:
+        optimize_media(media_path)
+
+    return media_path
+
 
-def send_video_to_dm(media_path):
+def release_meme(meme):
     try:
-        final_video_path = create_video_with_overlay(media_path)
+        app.db_handler.set_flags([meme.id], published=False)
+    except Exception as e:
+        logging.error(f"Error returning meme id {meme.id} to the queue: {e}")
+
+
+def send_by_reference(chat_id, telegram_file, caption=None):
+    if telegram_file.media_type == 'video':
+        send_method = app.telegram_sender.send_video
+    else:
+        send_method = app.telegram_sender.send_photo
+
+    if caption:
+        return send_method(chat_id, telegram_file.file_id, caption=caption)
+    return send_method(chat_id, telegram_file.file_id)
+
+
+def uploaded_file_id(message):
+    # Telegram returns several sizes of a photo, the last one is the original
+    if message.video:
+        return message.video.file_id, 'video'
+    if message.photo:
+        return message.photo[-1].file_id, 'photo'
+    return None, None
+
+
+def send_media(chat_id, media_path, caption=None, meme_id=None):
+    from telegram_sender import RejectedMediaError
+
+    # Send content that was uploaded before by its file_id, without uploading it again
+    sha256 = app.media_cache.content_hash(media_path)
+    telegram_file = app.db_handler.get_telegram_file(sha256=sha256)
+
+    if telegram_file:
+        logging.info(f"Sending {media_path} by reference to its earlier upload.")
+        try:
+            message = send_by_reference(chat_id, telegram_file, caption)
+            if meme_id is not None:
+                app.db_handler.save_telegram_file(sha256, telegram_file.file_id, telegram_file.media_type, meme_id)
+            return message
+        except RejectedMediaError as e:
+            # The file_id is stale, the media itself is fine and is uploaded again
+            logging.warning(f"Telegram refused the file_id of {media_path}, uploading it again: {e}")
+            app.db_handler.forget_telegram_file(telegram_file.file_id)
+
+    if media_path.lower().endswith(VIDEO_EXTENSIONS):
+        send_method = app.telegram_sender.send_video
+    else:
+        send_method = app.telegram_sender.send_photo
+
+    with open(media_path, 'rb') as file:
+        if caption:
+            message = send_method(chat_id, file, caption=caption)
+        else:
+            message = send_method(chat_id, file)
 
-        with open(final_video_path, 'rb') as file:
-            video_bytes = BytesIO(file.read())
-            bot.send_video(code_review_video_id, video=video_bytes)
+    BYTES_TRANSFERRED.inc(os.path.getsize(media_path), direction='uploaded')
 
-        os.remove(final_video_path)
+    # Remember the file_id Telegram assigned to the upload for later sends of this content
+    file_id, media_type = uploaded_file_id(message)
+    if file_id:
+        app.db_handler.save_telegram_file(sha256, file_id, media_type, meme_id)
+
+    return message
+
+
+def deliver_to_channels(meme, chat_ids, send):
+    # Send to all chats at once and record the outcome per chat. Only a failure in the
+    # main channel fails the post; supporting channels just record their error
+    from telegram_sender import UncertainSendError
+
+    def send_once(chat_id):
+        # The delivery row is the idempotency key, so a meme that was sent to a chat
+        # before a crash is not sent there again after the restart
+        if not app.db_handler.reserve_delivery(meme.id, chat_id):
+            logging.info(f"Meme id {meme.id} was already sent to {chat_id}, not sending it again.")
+            return None
+        return send(chat_id)
+
+    results = app.fanout.send_all(chat_ids, send_once)
+
+    for chat_id, (message, error) in results.items():
+        if isinstance(error, UncertainSendError):
+            # The message may be in the chat, so the delivery stays 'sending' and is never retried
+            logging.warning(f"Meme id {meme.id} may have been sent to {chat_id}, not sending it again: {error}")
+            app.db_handler.record_delivery(meme.id, chat_id, 'sending', error=str(error))
+        elif error:
+            app.db_handler.record_delivery(meme.id, chat_id, 'failed', error=str(error))
+        elif message:
+            app.db_handler.record_delivery(meme.id, chat_id, 'sent', message_id=message.message_id)
+
+    _, main_channel_error = results.get(target_channel_id, (None, None))
+    if main_channel_error:
+        raise main_channel_error
 
+
+def send_media_to_channel(media_path, meme, caption=None):
+    logging.info("Started sending media to channel")
+
+    def send(chat_id):
+        # The meme's file_id is saved along with the main channel send only
+        meme_id = meme.id if chat_id == target_channel_id else None
+        return send_media(chat_id, media_path, caption, meme_id=meme_id)
+
+    if app.db_handler.get_telegram_file(sha256=app.media_cache.content_hash(media_path)):
+        deliver_to_channels(meme, posting_channel_ids, send)
+    else:
+        # Upload once, to the main channel; the supporting channels then all get the
+        # file_id Telegram assigned to it
+        deliver_to_channels(meme, [target_channel_id], send)
+        deliver_to_channels(meme, supporting_channel_ids, send)
+
+    try:
+        if meme.rank == MANUAL_MEME_RANK:
+            # Manually uploaded memes are removed from data storage and the cache once posted
+            app.bucket.blob(meme.file_id).delete()
+            app.media_cache.discard(meme_cache_key(meme))
+        else:
+            # The overlay video is rendered in the background, posting doesn't wait for it.
+            # Without a render pool in this process, a serving replica picks the job up
+            app.db_handler.enqueue_render_job(meme.id, meme.url)
+            if app.loaded('render_pool'):
+                app.render_pool.notify()
     except Exception as e:
-        logging.error(f"Error sending video to DM: {e}")
+        logging.error(f"Error finishing post of meme id {meme.id}: {e}")
+
+
+def prepare_render_jobs(jobs):
+    # Gather the inputs of a batch of renders; they usually come straight from the media
+    # cache. Returns (jobs, arguments) groups for the render pool, all memes of the batch
+    # on one background video
+    from video_render import probe_video, get_overlay_assets, OUTPUT_DIRECTORY
+
+    video_path = download_random_video()
+    if video_path is None:
+        return [(jobs, RuntimeError("Could not download a background video"))]
+
+    # Probe the background and build the overlay assets for its width here, once, so the
+    # workers find both ready and only have to process the meme images
+    with track('ffprobe'):
+        video_info = probe_video(video_path)
+    get_overlay_assets(video_info[0], video_info[1])
+
+    groups = []
+    prepared_jobs = []
+    meme_paths = []
+
+    for job in jobs:
+        meme_path = download_media_to_channel(job.media_url)
+        if meme_path is None:
+            groups.append(([job], RuntimeError(f"Could not download media of meme id {job.meme_id}")))
+            continue
+
+        # The image optimized for the post is already downscaled, so the render decodes and
+        # resizes a much smaller image
+        prepared_jobs.append(job)
+        meme_paths.append(optimize_media(meme_path))
+
+    if prepared_jobs:
+        arguments = (meme_paths, video_path, OUTPUT_DIRECTORY, video_info, RENDER_ENCODER, RENDER_OVERLAY_MODE)
+        groups.append((prepared_jobs, arguments))
+
+    return groups
+
+
+def send_video_to_dm(job, final_video_path):
+    try:
+        with open(final_video_path, 'rb') as file:
+            app.telegram_sender.send_video(code_review_video_id, file)
+    finally:
+        os.remove(final_video_path)
 
 
 def delete_old_memes_from_db():
     try:
         filter_date = datetime.today() - timedelta(days=30)
-        unapproved_removed, posted_removed = db_handler.remove_old_memes(filter_date)
+        unapproved_removed, posted_removed = app.db_handler.remove_old_memes(
+            filter_date,
+            chunk_size=CLEANUP_CHUNK_SIZE,
+            archive_mode=CLEANUP_ARCHIVE_MODE,
+            archive_path=CLEANUP_ARCHIVE_PATH,
+        )
 
         if unapproved_removed > 0:
             logging.info(f"Deleted {unapproved_removed} unapproved memes from the database.")
@@ -160,29 +534,172 @@ def delete_old_memes_from_db():
         else:
             logging.info("No posted memes found to delete.")
 
-        bot.send_message(
-            chat_id=status_chat_id,
-            text=f'Deleting of memes completed successfully. {unapproved_removed} unapproved memes and {posted_removed} posted memes were removed from the database.'
+        render_counts = app.db_handler.get_render_job_counts()
+        render_summary = ', '.join(f'{count} {status}' for status, count in sorted(render_counts.items())) or 'none'
+
+        app.telegram_sender.send_message(
+            status_chat_id,
+            f'Deleting of memes completed successfully. {unapproved_removed} unapproved memes and {posted_removed} posted memes were removed from the database. Render jobs: {render_summary}.'
         )
     except Exception as e:
         logging.error(f"Error deleting old memes from the database: {e}")
 
 
+def format_statistics(stats):
+    mean_rank = stats['mean_rank_of_suggested']
+    mean_text = f'{mean_rank:.1f}' if mean_rank is not None else 'n/a'
+
+    return (
+        f"Statistics: {stats['all_published_count'] or 0} memes published "
+        f"({stats['published_suggested_count'] or 0} suggested, {stats['published_manual_count'] or 0} manual), "
+        f"{stats['all_deleted_count'] or 0} removed by cleanup. Rank of suggested memes: "
+        f"min {stats['min_rank_of_suggested']}, max {stats['max_rank_of_suggested']}, mean {mean_text}."
+    )
+
+
+def send_statistics_digest():
+    try:
+        stats = app.db_handler.get_statistics()
+        if not stats:
+            logging.warning("No statistics to send.")
+            return
+
+        app.telegram_sender.send_message(status_chat_id, format_statistics(stats))
+    except Exception as e:
+        logging.error(f"Error sending the statistics digest: {e}")
+
+
+def register_gauges():
+    # Evaluated on every scrape of the metrics endpoint
+    Gauge('memebot_queue_depth', 'Memes waiting to be posted.', callback=app.db_handler.count_queue)
+    Gauge('memebot_render_jobs', 'Render jobs by status.', ['status'],
+          callback=lambda: {(status,): count for status, count in app.render_pool.status().items()})
+    Gauge('memebot_prefetch_staged', 'Memes with staged media.', callback=lambda: len(app.prefetcher.staged))
+    Gauge('memebot_leader', 'Whether this node runs the scheduled jobs.', callback=lambda: int(app.leader.leader))
+
+
 def schedule_posting():
     logging.info("Started scheduling")
+
+    # Metrics are served on localhost only unless METRICS_HOST says otherwise; port 0 disables them
+    if METRICS_PORT:
+        register_gauges()
+        start_metrics_server(METRICS_HOST, METRICS_PORT)
+
+    app.render_pool.start()
     logging.info(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-    for time_interval in MORNING_TIMES:
-        schedule.every().day.at(time_interval).do(post_to_channel).tag('morning')
 
-    for time_interval in EVENING_TIMES:
-        schedule.every().day.at(time_interval).do(post_to_channel).tag('evening')
+    # Memes this node was posting when it stopped are recovered right away
+    requeued = app.db_handler.recover_meme_claims(target_channel_id, node_id=NODE_ID)
+    if requeued:
+        logging.warning(f"Returned {requeued} memes claimed before the restart to the queue.")
+
+    scheduler = EventScheduler(max_workers=SCHEDULER_WORKERS)
+
+    scheduler.add_job(
+        'posting',
+        CalendarTrigger(POSTING_CALENDAR, POSTING_TIMEZONE),
+        leader_only(post_to_channel),
+        catch_up=POSTING_CATCH_UP,
+        catch_up_window=POSTING_CATCH_UP_WINDOW,
+    )
+
+    # A missed prefetch is not caught up, posting downloads the media itself then
+    scheduler.add_job(
+        'prefetch',
+        CalendarTrigger(POSTING_CALENDAR, POSTING_TIMEZONE, offset=-timedelta(minutes=PREFETCH_LEAD_MINUTES)),
+        leader_only(prefetch_memes),
+    )
+
+    scheduler.add_job(
+        'cleanup',
+        CalendarTrigger(CLEANUP_CALENDAR, POSTING_TIMEZONE),
+        leader_only(delete_old_memes_from_db),
+        catch_up='latest',
+        catch_up_window=6 * 3600,
+    )
+
+    scheduler.add_job(
+        'statistics',
+        CalendarTrigger(STATS_DIGEST_CALENDAR, POSTING_TIMEZONE),
+        leader_only(send_statistics_digest),
+    )
+
+    scheduler.run_forever()
+
+
+def render_memes(meme_ids):
+    # Render the overlay videos of the given memes in this process, as one batch, and send
+    # them, without the render queue. Returns the number of videos sent
+    from video_render import render_overlay_batch
+
+    jobs = []
+    for meme_id in meme_ids:
+        meme = app.db_handler.get_meme(meme_id)
+        if meme is None or not meme.url:
+            logging.error(f"Meme id {meme_id} does not exist or has no URL to render.")
+            continue
+        jobs.append(SimpleNamespace(id=None, meme_id=meme.id, media_url=meme.url))
+
+    if not jobs:
+        return 0
+
+    sent = 0
+    try:
+        for group, arguments in prepare_render_jobs(jobs):
+            if isinstance(arguments, Exception):
+                logging.error(f"Error preparing renders of meme ids {[job.meme_id for job in group]}: {arguments}")
+                continue
+
+            with track('render_video'):
+                output_paths = render_overlay_batch(*arguments)
+
+            for job, output_path in zip(group, output_paths):
+                if output_path:
+                    send_video_to_dm(job, output_path)
+                    sent += 1
+                    logging.info(f"Rendered and sent the video of meme id {job.meme_id}.")
+    except Exception as e:
+        logging.error(f"Error rendering meme ids {meme_ids}: {e}")
+
+    return sent
+
+
+app.register('bot', create_bot)
+app.register('telegram_sender', create_telegram_sender)
+app.register('leader', create_leader)
+app.register('fanout', create_fanout)
+app.register('prefetcher', create_prefetcher)
+app.register('render_pool', create_render_pool)
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Telegram meme posting bot.')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('serve', help='run the posting schedule and the render workers (the default)')
+    commands.add_parser('post-now', help='post the next meme in the queue right away')
+    commands.add_parser('cleanup', help='remove old memes from the database')
+    render = commands.add_parser('render', help='render the overlay videos of memes, as one batch, and send them')
+    render.add_argument('meme_ids', type=int, nargs='+', metavar='meme_id')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    # Each command only creates the clients it uses; serve creates all of them
+    arguments = parse_arguments(argv)
+    configure_logging(LOG_LEVEL, LOG_FORMAT)
 
-    schedule.every().day.at(convert_to_local_time(3, 00)).do(delete_old_memes_from_db).tag('midnight')
+    if arguments.command == 'post-now':
+        post_to_channel()
+    elif arguments.command == 'cleanup':
+        delete_old_memes_from_db()
+    elif arguments.command == 'render':
+        return 0 if render_memes(arguments.meme_ids) == len(arguments.meme_ids) else 1
+    else:
+        schedule_posting()
 
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    return 0
 
 
 if __name__ == "__main__":
-    schedule_posting()
+    sys.exit(main())
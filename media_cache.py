@@ -0,0 +1,156 @@
+from downloads import extension_for_content_type, file_sha256
+import json
+import logging
+import os
+import tempfile
+import threading
+
+
+class MediaCache:
+    def __init__(self, cache_dir, max_bytes):
+        # Content addressed cache: files are stored under their SHA-256, and index.json
+        # maps source keys (URL or blob name) to the hash of the content they returned
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, 'index.json')
+
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._remove_partial_files()
+        self.index = self._load_index()
+
+    def _remove_partial_files(self):
+        # Downloads interrupted by a crash leave .part files behind
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.part'):
+                os.remove(entry.path)
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as index_file:
+                return json.load(index_file)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logging.warning(f"Media cache index is unreadable, starting empty: {e}")
+            return {}
+
+    def _save_index(self):
+        # Write the index atomically so a crash never leaves it half written
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w') as index_file:
+            json.dump(self.index, index_file)
+        os.replace(temp_path, self.index_path)
+
+    def _object_path(self, entry):
+        return os.path.join(self.cache_dir, entry['sha256'] + entry['extension'])
+
+    def _key_lock(self, key):
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    def get(self, key):
+        with self.lock:
+            entry = self.index.get(key)
+
+            if not entry:
+                return None
+
+            object_path = self._object_path(entry)
+
+            if not os.path.exists(object_path):
+                # The content was evicted, forget the key too
+                del self.index[key]
+                self._save_index()
+                return None
+
+        # Mark the file as recently used, eviction removes the least recently used first
+        os.utime(object_path)
+        return object_path
+
+    def fetch(self, key, download, extension=None):
+        # Return the cached file for key, calling download(file) to fill the cache on a miss.
+        # download must return (content_type, sha256, size) for what it wrote. Concurrent
+        # fetches of the same key wait for a single download
+        with self._key_lock(key):
+            object_path = self.get(key)
+            if object_path:
+                logging.debug("Media cache hit for %s", key)
+                return object_path
+
+            file_descriptor, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.part')
+            try:
+                with os.fdopen(file_descriptor, 'wb') as file:
+                    content_type, sha256, size = download(file)
+
+                if extension is None:
+                    extension = extension_for_content_type(content_type) if content_type else ''
+
+                entry = {'sha256': sha256, 'extension': extension}
+                object_path = self._object_path(entry)
+
+                # Files only appear in the cache complete, under their final name
+                os.replace(temp_path, object_path)
+            except Exception:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+
+            with self.lock:
+                self.index[key] = entry
+                self._save_index()
+
+            logging.info(f"Cached {size} bytes for {key} at {object_path}")
+            self.evict(keep=object_path)
+            return object_path
+
+    def content_hash(self, path):
+        # Cached files are named after their SHA-256, other files are hashed on demand
+        if os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.cache_dir):
+            return os.path.splitext(os.path.basename(path))[0]
+        return file_sha256(path)
+
+    def discard(self, key):
+        # Forget the key, and remove its content unless another key shares it
+        with self.lock:
+            entry = self.index.pop(key, None)
+            if not entry:
+                return
+
+            if entry not in self.index.values():
+                object_path = self._object_path(entry)
+                if os.path.exists(object_path):
+                    os.remove(object_path)
+
+            self._save_index()
+
+    def evict(self, keep=None):
+        with self.lock:
+            cached_files = []
+            for entry in os.scandir(self.cache_dir):
+                if entry.is_file() and entry.path not in (self.index_path, keep) and not entry.name.endswith(
+                        ('.part', '.tmp')):
+                    stat = entry.stat()
+                    cached_files.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total_size = sum(size for _, size, _ in cached_files)
+            if keep and os.path.exists(keep):
+                total_size += os.path.getsize(keep)
+
+            # Remove the least recently used files until the cache fits its budget
+            evicted = set()
+            for _, size, path in sorted(cached_files):
+                if total_size <= self.max_bytes:
+                    break
+
+                os.remove(path)
+                evicted.add(path)
+                total_size -= size
+                logging.info(f"Evicted {path} from the media cache")
+
+            if evicted:
+                self.index = {key: entry for key, entry in self.index.items()
+                              if self._object_path(entry) not in evicted}
+                self._save_index()
@@ -0,0 +1,235 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import bisect
+import logging
+import threading
+import time
+
+# Histogram buckets in seconds, from a fast database query to a slow render
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def render(self):
+        # All metrics in the Prometheus text exposition format
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics)
+
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.metric_type}')
+            try:
+                lines.extend(metric.samples())
+            except Exception as e:
+                logging.error("Error collecting metric %s: %s", metric.name, e)
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    metric_type = 'untyped'
+
+    def __init__(self, name, help_text, label_names=(), registry=REGISTRY):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        return [f'{self.name}{format_labels(self.label_names, key)} {format_value(value)}'
+                for key, value in sorted(values.items())]
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def __init__(self, name, help_text, label_names=(), registry=REGISTRY, callback=None):
+        # callback() is called on every scrape and returns the value, or a dict of label
+        # value tuples to values for a gauge with labels
+        super().__init__(name, help_text, label_names, registry)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.callback:
+            result = self.callback()
+            values = result if isinstance(result, dict) else {(): result}
+        else:
+            with self.lock:
+                values = dict(self.values)
+
+        return [f'{self.name}{format_labels(self.label_names, key)} {format_value(value)}'
+                for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), registry=REGISTRY, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, label_names, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        # Observe how long the block takes, also when it raises
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+
+        lines = []
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = format_labels(self.label_names, key, [('le', format_value(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+
+            labels = format_labels(self.label_names, key)
+            lines.append(f'{self.name}_sum{labels} {format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] == '/metrics':
+            body = self.registry.render().encode()
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            status = 200
+        elif self.path == '/healthz':
+            body, content_type, status = b'ok\n', 'text/plain', 200
+        else:
+            body, content_type, status = b'not found\n', 'text/plain', 404
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are frequent, keep them out of the log unless debugging
+        logging.debug("Metrics request: " + format, *args)
+
+
+def start_metrics_server(host='127.0.0.1', port=9100):
+    # Serve /metrics from a daemon thread; returns the server so it can be shut down
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    logging.info("Serving metrics on http://%s:%s/metrics", host, server.server_address[1])
+    return server
+
+
+# Metrics shared by the modules of the bot
+
+OPERATION_SECONDS = Histogram(
+    'memebot_operation_duration_seconds', 'Duration of hot path operations.', ['operation'])
+
+OPERATION_ATTEMPTS = Counter(
+    'memebot_operation_attempts_total', 'Hot path operations started.', ['operation'])
+
+OPERATION_FAILURES = Counter(
+    'memebot_operation_failures_total', 'Hot path operations that failed.', ['operation'])
+
+JOB_SECONDS = Histogram(
+    'memebot_job_duration_seconds', 'Duration of scheduled jobs.', ['job'])
+
+JOB_RUNS = Counter(
+    'memebot_job_runs_total', 'Scheduled job runs by outcome.', ['job', 'outcome'])
+
+BYTES_TRANSFERRED = Counter(
+    'memebot_bytes_total', 'Bytes moved, by direction (downloaded, uploaded, rendered).', ['direction'])
+
+TELEGRAM_SENDS = Counter(
+    'memebot_telegram_sends_total', 'Telegram API send attempts by method and outcome.', ['method', 'outcome'])
+
+POSTS = Counter(
+    'memebot_posts_total', 'Posting attempts by outcome.', ['outcome'])
+
+
+@contextmanager
+def track(operation):
+    # Count the operation and time it; failures are counted when the block raises
+    OPERATION_ATTEMPTS.inc(operation=operation)
+    started_at = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        OPERATION_FAILURES.inc(operation=operation)
+        raise
+    finally:
+        OPERATION_SECONDS.observe(time.perf_counter() - started_at, operation=operation)
@@ -0,0 +1,142 @@
+from sqlalchemy import Column, Integer, String, DateTime, MetaData, Table, select, inspect, text, func
+from datetime import datetime
+import logging
+
+# Id of the single row of the statistics table
+STATISTICS_ROW_ID = 1
+
+# Key of the PostgreSQL advisory lock that keeps replicas starting at the same time
+# from applying migrations concurrently
+MIGRATIONS_LOCK_KEY = 7305000
+
+# Table recording which schema migrations have already been applied
+migrations_metadata = MetaData()
+
+schema_migrations_table = Table(
+    'schema_migrations',
+    migrations_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('name', String),
+    Column('applied_at', DateTime),
+)
+
+
+def add_queue_index(connection, db_handler):
+    # Partial index over the posting queue so picking the next meme is an index
+    # lookup instead of a full scan and sort of reddit_items
+    db_handler.queue_index.create(connection, checkfirst=True)
+
+
+def add_archive_table(connection, db_handler):
+    # Table receiving removed memes when cleanup runs in archive mode
+    db_handler.archive_table.create(connection, checkfirst=True)
+
+
+def add_date_added_index(connection, db_handler):
+    # Lets the nightly cleanup find old memes without scanning the whole table
+    db_handler.date_added_index.create(connection, checkfirst=True)
+
+
+def add_telegram_files_table(connection, db_handler):
+    # Lookup of Telegram file_ids by content hash, for sending media by reference
+    db_handler.telegram_files_table.create(connection, checkfirst=True)
+
+
+def add_render_jobs_table(connection, db_handler):
+    # Persistent queue of overlay video renders
+    db_handler.render_jobs_table.create(connection, checkfirst=True)
+
+
+def add_deliveries_table(connection, db_handler):
+    # Per channel delivery status of posted memes
+    db_handler.deliveries_table.create(connection, checkfirst=True)
+
+
+def add_meme_claims_table(connection, db_handler):
+    # Leases on memes being posted, so memes claimed by a crashed node are posted again
+    db_handler.meme_claims_table.create(connection, checkfirst=True)
+
+
+def add_render_job_claimed_by(connection, db_handler):
+    # Node running a render job, so a restarted node requeues only its own jobs. Tables
+    # created after the column was added to the model already have it
+    columns = [column['name'] for column in inspect(connection).get_columns('render_jobs')]
+    if 'claimed_by' not in columns:
+        connection.execute(text('ALTER TABLE render_jobs ADD COLUMN claimed_by VARCHAR'))
+
+
+def add_posting_order_table(connection, db_handler):
+    # Posting order computed by the scoring engine
+    db_handler.posting_order_table.create(connection, checkfirst=True)
+
+
+def add_statistics_running_sums(connection, db_handler):
+    # Running sum of suggested ranks, so the mean is updated without reading the memes.
+    # It starts from the stored mean, and the single statistics row is created if missing
+    stats_table = db_handler.stats_table
+    stats_table.create(connection, checkfirst=True)
+
+    columns = [column['name'] for column in inspect(connection).get_columns('statistics')]
+    if 'sum_rank_of_suggested' not in columns:
+        connection.execute(text('ALTER TABLE statistics ADD COLUMN sum_rank_of_suggested FLOAT'))
+
+    stats = stats_table.c
+    connection.execute(
+        stats_table.update()
+        .where(stats.sum_rank_of_suggested.is_(None))
+        .values(sum_rank_of_suggested=func.coalesce(stats.mean_rank_of_suggested, 0)
+                * func.coalesce(stats.published_suggested_count, 0))
+    )
+
+    if connection.execute(select(stats.id).where(stats.id == STATISTICS_ROW_ID)).first() is None:
+        connection.execute(stats_table.insert().values(
+            id=STATISTICS_ROW_ID, all_published_count=0, all_deleted_count=0, published_suggested_count=0,
+            published_manual_count=0, sum_rank_of_suggested=0,
+        ))
+
+
+def add_media_hashes_table(connection, db_handler):
+    # Perceptual hashes of meme images for near duplicate detection
+    db_handler.media_hashes_table.create(connection, checkfirst=True)
+
+
+# Ordered list of (version, name, migration); append new migrations at the end
+MIGRATIONS = [
+    (1, 'add_queue_index', add_queue_index),
+    (2, 'add_archive_table', add_archive_table),
+    (3, 'add_date_added_index', add_date_added_index),
+    (4, 'add_telegram_files_table', add_telegram_files_table),
+    (5, 'add_render_jobs_table', add_render_jobs_table),
+    (6, 'add_deliveries_table', add_deliveries_table),
+    (7, 'add_meme_claims_table', add_meme_claims_table),
+    (8, 'add_render_job_claimed_by', add_render_job_claimed_by),
+    (9, 'add_posting_order_table', add_posting_order_table),
+    (10, 'add_statistics_running_sums', add_statistics_running_sums),
+    (11, 'add_media_hashes_table', add_media_hashes_table),
+]
+
+
+def apply_migrations(db_handler):
+    with db_handler.engine.begin() as connection:
+        # Replicas wait here for the one migrating first; the lock ends with the transaction
+        if connection.dialect.name == 'postgresql':
+            connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': MIGRATIONS_LOCK_KEY})
+
+        schema_migrations_table.create(connection, checkfirst=True)
+
+        applied_versions = set(connection.execute(select(schema_migrations_table.c.version)).scalars())
+
+        for version, name, migration in MIGRATIONS:
+            if version in applied_versions:
+                continue
+
+            logging.info(f"Applying schema migration {version}: {name}")
+            try:
+                migration(connection, db_handler)
+            except Exception:
+                # All pending migrations share the transaction, so none of them is applied
+                logging.error(f"Schema migration {version} ({name}) failed, rolling back the pending migrations")
+                raise
+            connection.execute(
+                schema_migrations_table.insert().values(version=version, name=name, applied_at=datetime.utcnow())
+            )
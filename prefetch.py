@@ -0,0 +1,84 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import logging
+import os
+import threading
+import time
+
+
+class MediaPrefetcher:
+    def __init__(self, fetch_media, max_workers=4, max_age=6 * 3600):
+        # fetch_media(meme) downloads and validates the meme's media into the media cache
+        # and returns its local path, or None. The cache is the staging area
+        self.fetch_media = fetch_media
+        self.max_age = max_age
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='prefetch')
+        self.lock = threading.Lock()
+
+        # Meme id -> (staged file path, staging time), and meme id -> download in progress
+        self.staged = {}
+        self.pending = {}
+
+    def prefetch(self, memes):
+        # Queue downloads for memes that are neither staged nor being downloaded.
+        # Returns immediately, the downloads run in the worker pool
+        with self.lock:
+            for meme in memes:
+                if meme.id in self.staged or meme.id in self.pending:
+                    continue
+
+                logging.info(f"Prefetching media for meme id {meme.id}")
+                self.pending[meme.id] = self.executor.submit(self._stage, meme)
+
+    def _stage(self, meme):
+        try:
+            media_path = self.fetch_media(meme)
+
+            if not media_path:
+                logging.warning(f"Prefetch of meme id {meme.id} returned no usable media.")
+                return None
+
+            with self.lock:
+                self.staged[meme.id] = (media_path, time.time())
+
+            logging.info(f"Media for meme id {meme.id} staged at {media_path}")
+            return media_path
+
+        except Exception as e:
+            logging.error(f"Error prefetching media for meme id {meme.id}: {e}")
+            return None
+
+        finally:
+            with self.lock:
+                self.pending.pop(meme.id, None)
+
+    def take(self, meme, timeout=60):
+        # If the meme is still downloading, wait for it instead of downloading it twice
+        with self.lock:
+            future = self.pending.get(meme.id)
+
+        if future:
+            try:
+                future.result(timeout=timeout)
+            except FutureTimeoutError:
+                logging.warning(f"Prefetch of meme id {meme.id} did not finish in {timeout} seconds.")
+                return None
+
+        with self.lock:
+            staged_path, _ = self.staged.pop(meme.id, (None, None))
+
+        # The file may have been evicted from the cache since it was staged
+        if staged_path and os.path.exists(staged_path):
+            return staged_path
+
+        return None
+
+    def discard_stale(self):
+        # Forget memes that were staged but never posted, e.g. after the queue order changed.
+        # Their files stay in the media cache until they are evicted
+        now = time.time()
+
+        with self.lock:
+            for meme_id, (staged_path, staged_at) in list(self.staged.items()):
+                if now - staged_at > self.max_age or not os.path.exists(staged_path):
+                    del self.staged[meme_id]
@@ -0,0 +1,202 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from metrics import OPERATION_SECONDS, OPERATION_FAILURES, BYTES_TRANSFERRED
+import logging
+import os
+import threading
+import time
+
+
+class RenderWorkerPool:
+    def __init__(self, db_handler, prepare, render, deliver, concurrency=2, max_attempts=3, retry_delay=60,
+                 poll_interval=30, node_id=None, lease=3600, batch_size=1):
+        # Queued jobs are claimed in batches of up to batch_size. prepare(jobs) runs in the
+        # dispatcher thread, e.g. to download the inputs, and returns a list of (jobs, arguments)
+        # groups; arguments is an exception for jobs that could not be prepared.
+        # render(*arguments) runs in a forked worker process and returns an output path per
+        # job of the group, so it must be a module level function that doesn't use the
+        # parent's connections or locks. deliver(job, output_path) sends a finished video.
+        # Several nodes can share the render queue; a job that stayed running for longer
+        # than lease seconds is assumed lost with its node and queued again
+        self.db_handler = db_handler
+        self.prepare = prepare
+        self.render = render
+        self.deliver = deliver
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.node_id = node_id
+        self.lease = lease
+        self.batch_size = batch_size
+        self.next_requeue_at = 0
+
+        self.executor = None
+        self.executor_broken = False
+        self.thread = None
+        self.wakeup = threading.Event()
+
+    def start(self):
+        requeued = self.db_handler.requeue_running_render_jobs(node_id=self.node_id)
+        if requeued:
+            logging.info(f"Requeued {requeued} render jobs left running by a previous process.")
+
+        self.executor = self._create_executor()
+        self.thread = threading.Thread(target=self._run, name='render-dispatcher', daemon=True)
+        self.thread.start()
+
+    def _create_executor(self):
+        return ProcessPoolExecutor(max_workers=self.concurrency)
+
+    def _replace_broken_executor(self):
+        # A worker process died, which breaks the whole pool and fails all of its jobs
+        if self.executor_broken:
+            logging.error("Render worker pool broke, restarting it.")
+            self.executor.shutdown(wait=False)
+            self.executor = self._create_executor()
+            self.executor_broken = False
+
+    def _requeue_stale_jobs(self):
+        # Jobs of nodes that went away, checked a few times per lease
+        if time.monotonic() < self.next_requeue_at:
+            return
+
+        self.next_requeue_at = time.monotonic() + self.lease / 4
+        stale_before = datetime.utcnow() - timedelta(seconds=self.lease)
+
+        requeued = self.db_handler.requeue_running_render_jobs(stale_before=stale_before)
+        if requeued:
+            logging.warning(f"Requeued {requeued} render jobs running for longer than {self.lease}s.")
+
+    def notify(self):
+        # Wake the dispatcher up after a job was queued
+        self.wakeup.set()
+
+    def status(self):
+        return self.db_handler.get_render_job_counts()
+
+    def _run(self):
+        running = {}
+
+        while True:
+            try:
+                self._replace_broken_executor()
+                self._requeue_stale_jobs()
+
+                # Fill the free worker slots with batches of queued jobs
+                while len(running) < self.concurrency:
+                    jobs = self._claim_batch()
+                    if not jobs:
+                        break
+
+                    for future, group in self._submit(jobs):
+                        running[future] = (group, time.monotonic())
+
+                if running:
+                    # Check for new jobs every second while there are free slots
+                    timeout = self.poll_interval if len(running) >= self.concurrency else 1
+                    done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                    for future in done:
+                        group, started_at = running.pop(future)
+                        self._complete(group, future, started_at)
+                else:
+                    self.wakeup.wait(self.poll_interval)
+
+                self.wakeup.clear()
+
+            except Exception as e:
+                logging.error(f"Error in render dispatcher: {e}")
+                self.wakeup.wait(self.poll_interval)
+
+    def _claim_batch(self):
+        jobs = []
+        while len(jobs) < self.batch_size:
+            job = self.db_handler.claim_render_job(node_id=self.node_id)
+            if not job:
+                break
+            jobs.append(job)
+        return jobs
+
+    def _submit(self, jobs):
+        # Returns the (future, jobs) of every group that was submitted; the other jobs failed
+        submitted = []
+        handled = set()
+
+        try:
+            for job in jobs:
+                logging.info(f"Starting render job {job.id} for meme id {job.meme_id} (attempt {job.attempts})")
+
+            for group, arguments in self.prepare(jobs):
+                handled.update(job.id for job in group)
+
+                if isinstance(arguments, Exception):
+                    for job in group:
+                        self._fail(job, arguments)
+                    continue
+
+                submitted.append((self.executor.submit(self.render, *arguments), group))
+
+        except BrokenProcessPool as e:
+            self.executor_broken = True
+            self._fail_unhandled(jobs, handled, e)
+
+        except Exception as e:
+            self._fail_unhandled(jobs, handled, e)
+
+        return submitted
+
+    def _fail_unhandled(self, jobs, handled, error):
+        for job in jobs:
+            if job.id not in handled:
+                self._fail(job, error)
+
+    def _complete(self, group, future, started_at):
+        try:
+            output_paths = future.result()
+        except BrokenProcessPool as e:
+            self.executor_broken = True
+            output_paths = [e] * len(group)
+        except Exception as e:
+            output_paths = [e] * len(group)
+
+        # Time from submission to finished videos, including waiting for a free worker
+        elapsed = time.monotonic() - started_at
+
+        for job, output_path in zip(group, output_paths):
+            if isinstance(output_path, Exception):
+                self._fail(job, output_path)
+            else:
+                self._finish(job, output_path, elapsed)
+
+    def _finish(self, job, output_path, elapsed):
+        try:
+            if not output_path:
+                raise RuntimeError("Render produced no video")
+
+            output_size = os.path.getsize(output_path)
+
+            OPERATION_SECONDS.observe(elapsed, operation='render_video')
+            BYTES_TRANSFERRED.inc(output_size, direction='rendered')
+
+            self.deliver(job, output_path)
+            self.db_handler.update_render_job(job.id, 'done')
+            logging.info(f"Render job {job.id} for meme id {job.meme_id} done in {elapsed:.2f}s, "
+                         f"{output_size} bytes.")
+
+        except Exception as e:
+            self._fail(job, e)
+
+    def _fail(self, job, error):
+        OPERATION_FAILURES.inc(operation='render_video')
+
+        if job.attempts < self.max_attempts:
+            # Retry later with exponential backoff
+            delay = self.retry_delay * 2 ** (job.attempts - 1)
+            available_at = datetime.utcnow() + timedelta(seconds=delay)
+            self.db_handler.update_render_job(job.id, 'queued', error=str(error), available_at=available_at)
+            logging.warning(f"Render job {job.id} failed (attempt {job.attempts}), retrying in {delay}s: {error}")
+        else:
+            self.db_handler.update_render_job(job.id, 'failed', error=str(error))
+            logging.error(f"Render job {job.id} failed after {job.attempts} attempts: {error}")
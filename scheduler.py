@@ -0,0 +1,189 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import heapq
+import itertools
+import logging
+import threading
+import time
+import pytz
+from metrics import JOB_SECONDS, JOB_RUNS
+
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+# What to do with slots that were missed, e.g. while the host was suspended:
+# 'skip' drops them, 'latest' runs the most recent one, 'all' runs every one of them
+CATCH_UP_POLICIES = ('skip', 'latest', 'all')
+
+
+def parse_weekdays(spec):
+    # "mon-fri", "sat,sun", "*" or a mix like "mon,wed-fri"
+    spec = spec.strip().lower()
+    if spec in ('*', 'daily'):
+        return list(range(7))
+
+    weekdays = []
+    for part in spec.split(','):
+        start, _, end = part.strip().partition('-')
+        first = WEEKDAYS.index(start.strip())
+        last = WEEKDAYS.index(end.strip()) if end else first
+        weekdays.extend(range(first, last + 1))
+    return weekdays
+
+
+def parse_calendar(spec):
+    # A posting calendar like "mon-fri=08:45,15:45,20:45;sat,sun=11:00,19:00" becomes
+    # {weekday: [times]}, with Monday as 0
+    calendar = {}
+    for entry in spec.split(';'):
+        if not entry.strip():
+            continue
+
+        weekdays, _, times = entry.partition('=')
+        slots = [datetime.strptime(slot.strip(), '%H:%M').time() for slot in times.split(',') if slot.strip()]
+        for weekday in parse_weekdays(weekdays):
+            calendar[weekday] = sorted(set(calendar.get(weekday, [])) | set(slots))
+    return calendar
+
+
+class CalendarTrigger:
+    def __init__(self, calendar, timezone, offset=timedelta(0)):
+        # Fires at the calendar's times in the given timezone, shifted by offset. The due
+        # times are computed from the wall clock of that timezone every time, so they
+        # stay right across daylight saving changes
+        self.calendar = calendar
+        self.timezone = pytz.timezone(timezone) if isinstance(timezone, str) else timezone
+        self.offset = offset
+
+    def next_after(self, moment):
+        # The first due time after moment, as an aware UTC datetime
+        local_date = moment.astimezone(self.timezone).date()
+        candidates = []
+
+        for days in range(-1, 9):
+            day = local_date + timedelta(days=days)
+            for slot in self.calendar.get(day.weekday(), ()):
+                local_time = self.timezone.normalize(self.timezone.localize(datetime.combine(day, slot)))
+                due = local_time.astimezone(pytz.utc) + self.offset
+                if due > moment:
+                    candidates.append(due)
+
+        return min(candidates) if candidates else None
+
+
+class ScheduledJob:
+    def __init__(self, name, trigger, func, catch_up='skip', catch_up_window=3600, grace=60):
+        if catch_up not in CATCH_UP_POLICIES:
+            raise ValueError(f"Unknown catch-up policy {catch_up}")
+
+        # A run that starts within grace seconds of its slot is on time; missed slots
+        # older than catch_up_window seconds are never run
+        self.name = name
+        self.trigger = trigger
+        self.func = func
+        self.catch_up = catch_up
+        self.catch_up_window = timedelta(seconds=catch_up_window)
+        self.grace = timedelta(seconds=grace)
+        self.future = None
+
+
+class EventScheduler:
+    def __init__(self, max_workers=4, max_sleep=600):
+        # Sleeps until the next due job instead of polling. The sleep is capped at
+        # max_sleep seconds so a change of the system clock is picked up eventually.
+        # Jobs run in a thread pool, so a slow job never holds up the next slot
+        self.max_sleep = max_sleep
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='scheduler')
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+
+    def add_job(self, name, trigger, func, catch_up='skip', catch_up_window=3600, grace=60):
+        job = ScheduledJob(name, trigger, func, catch_up, catch_up_window, grace)
+        due = trigger.next_after(self._now())
+
+        with self.condition:
+            self._push(job, due)
+            self.condition.notify()
+
+        logging.info(f"Scheduled job {name}, next run at {due}")
+        return job
+
+    def _now(self):
+        return datetime.now(pytz.utc)
+
+    def _push(self, job, due):
+        if due is not None:
+            heapq.heappush(self.heap, (due, next(self.counter), job))
+
+    def run_forever(self):
+        while True:
+            with self.condition:
+                now = self._now()
+
+                if not self.heap or self.heap[0][0] > now:
+                    timeout = self.max_sleep
+                    if self.heap:
+                        timeout = min(timeout, (self.heap[0][0] - now).total_seconds())
+                    self.condition.wait(timeout)
+                    continue
+
+                due, _, job = heapq.heappop(self.heap)
+
+            try:
+                self._dispatch(job, due, now)
+            except Exception as e:
+                logging.error(f"Error dispatching job {job.name}: {e}")
+
+    def _dispatch(self, job, due, now):
+        # Collect every slot of the job that is due by now; there is more than one only
+        # if the scheduler was held up, e.g. by a suspended host
+        missed = [due]
+        next_due = job.trigger.next_after(due)
+        while next_due is not None and next_due <= now:
+            missed.append(next_due)
+            next_due = job.trigger.next_after(next_due)
+
+        for slot in self._slots_to_run(job, missed, now):
+            self._submit(job, slot)
+
+        with self.condition:
+            self._push(job, next_due)
+
+        logging.debug("Next run of job %s at %s", job.name, next_due)
+
+    def _slots_to_run(self, job, missed, now):
+        on_time = [slot for slot in missed if now - slot <= job.grace]
+        late = [slot for slot in missed if job.grace < now - slot <= job.catch_up_window]
+
+        if job.catch_up == 'all':
+            slots = late + on_time
+        elif job.catch_up == 'latest':
+            slots = (late + on_time)[-1:]
+        else:
+            slots = on_time
+
+        skipped = len(missed) - len(slots)
+        if skipped:
+            logging.warning(f"Skipping {skipped} missed slots of job {job.name} "
+                            f"(catch-up policy {job.catch_up}).")
+        return slots
+
+    def _submit(self, job, slot):
+        if job.future and not job.future.done():
+            logging.warning(f"Job {job.name} is still running, starting another run for the {slot} slot.")
+
+        job.future = self.executor.submit(self._run_job, job, slot)
+
+    def _run_job(self, job, slot):
+        started_at = time.monotonic()
+        logging.info(f"Running job {job.name} for the {slot} slot")
+
+        try:
+            job.func()
+            logging.info(f"Job {job.name} finished in {time.monotonic() - started_at:.2f}s")
+            JOB_RUNS.inc(job=job.name, outcome='ok')
+        except Exception as e:
+            logging.error(f"Error running job {job.name}: {e}")
+            JOB_RUNS.inc(job=job.name, outcome='failed')
+        finally:
+            JOB_SECONDS.observe(time.monotonic() - started_at, job=job.name)
@@ -0,0 +1,87 @@
+from datetime import datetime
+import numpy as np
+
+
+def load_columns(rows):
+    # Turn the queue rows (id, rank, comments, posted_when, date_added, posted_by) into
+    # one NumPy array per column
+    if not rows:
+        return None
+
+    ids, ranks, comments, posted_when, date_added, posted_by = zip(*rows)
+
+    return {
+        'id': np.array(ids, dtype=np.int64),
+        'rank': np.array([rank or 0 for rank in ranks], dtype=np.float64),
+        'comments': np.array([count or 0 for count in comments], dtype=np.float64),
+        'posted_when': np.array([when or 0 for when in posted_when], dtype=np.float64),
+        'date_added': np.array(date_added, dtype='datetime64[s]'),
+        # Memes without a known author don't count against each other
+        'posted_by': np.array([author or f'#{meme_id}' for meme_id, author in zip(ids, posted_by)]),
+    }
+
+
+def log_normalized(values, included=None):
+    # Scale to 0..1 on a log scale, so a few huge values don't flatten all the others.
+    # With included, only those values set the scale
+    scaled = np.log1p(np.clip(values, 0, None))
+    reference = scaled if included is None else scaled[included]
+    peak = reference.max() if reference.size else 0
+    return scaled / peak if peak > 0 else scaled
+
+
+def age_hours(columns, now):
+    # posted_when is how many hours old the Reddit post was when the meme was scraped, so
+    # the age is that plus the time since the meme was added, where known
+    added = columns['date_added']
+    since_added = (np.datetime64(now.replace(tzinfo=None), 's') - added).astype('float64') / 3600
+    since_added = np.where(np.isnat(added), 0, since_added)
+
+    return np.clip(columns['posted_when'] + since_added, 0, None)
+
+
+def occurrence_index(groups):
+    # For every element, how many elements of the same group come before it
+    order = np.argsort(groups, kind='stable')
+    sorted_groups = groups[order]
+
+    starts = np.r_[0, np.flatnonzero(sorted_groups[1:] != sorted_groups[:-1]) + 1]
+    lengths = np.diff(np.r_[starts, len(groups)])
+
+    occurrence = np.empty(len(groups), dtype=np.int64)
+    occurrence[order] = np.arange(len(groups)) - np.repeat(starts, lengths)
+    return occurrence
+
+
+def score_queue(rows, now=None, rank_weight=1.0, comments_weight=0.25, half_life_hours=72.0,
+                diversity_penalty=0.7, pinned_rank=None):
+    # Score the whole queue at once and return (meme_ids, scores) in posting order.
+    # The score is the weighted rank and comment count, halved every half_life_hours of
+    # age. The n-th meme of the same author is multiplied by diversity_penalty ** n, so
+    # one source doesn't take all the top slots. Memes ranked pinned_rank always go first
+    columns = load_columns(rows)
+    if columns is None:
+        return [], []
+
+    now = now or datetime.utcnow()
+
+    # The pinned rank is made up, it would squash the ranks of all other memes
+    if pinned_rank is not None:
+        pinned = columns['rank'] == pinned_rank
+    else:
+        pinned = np.zeros(len(columns['id']), dtype=bool)
+
+    score = (rank_weight * log_normalized(columns['rank'], ~pinned)
+             + comments_weight * log_normalized(columns['comments'], ~pinned))
+    score *= 0.5 ** (age_hours(columns, now) / half_life_hours)
+
+    # Count each author's memes in score order, so their best meme keeps its score
+    by_score = np.argsort(-score, kind='stable')
+    _, authors = np.unique(columns['posted_by'][by_score], return_inverse=True)
+    score[by_score] *= diversity_penalty ** occurrence_index(authors)
+
+    score[pinned] = np.inf
+
+    # Highest score first, ties in id order
+    order = np.lexsort((columns['id'], -score))
+    return columns['id'][order].tolist(), score[order].tolist()
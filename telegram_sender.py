@@ -0,0 +1,211 @@
+from telebot.apihelper import ApiTelegramException, ApiHTTPException
+from urllib3.exceptions import ConnectTimeoutError, MaxRetryError
+from metrics import TELEGRAM_SENDS
+import logging
+import random
+import requests
+import threading
+import time
+
+
+class PermanentSendError(Exception):
+    # Telegram refused the request and sending it again won't help, e.g. the bot was
+    # removed from the chat
+    pass
+
+
+class RejectedMediaError(PermanentSendError):
+    # Telegram refused the media itself, e.g. a broken image or a file that is too big
+    pass
+
+
+class UncertainSendError(Exception):
+    # The request reached Telegram but its reply never arrived, e.g. the read timed out or
+    # the connection was reset, so the message may have been posted. Sending it again
+    # could post it twice
+    pass
+
+
+# 400 errors about the chat rather than the media that was sent
+CHAT_ERROR_MARKERS = ('chat not found', 'not enough rights', 'chat_write_forbidden', 'chat_admin_required',
+                      'need administrator rights', 'peer_id_invalid')
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        # Allows bursts of up to capacity sends, refilled at rate sends per second
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # Hold back all sends for a while, e.g. when Telegram asks us to retry later
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def connection_failed(error):
+    # True if requests never got a connection to Telegram, so nothing was sent. A
+    # connection that was reset or closed after the request went out doesn't count
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+
+    reason = error.args[0] if error.args else None
+    if isinstance(reason, MaxRetryError):
+        reason = reason.reason
+
+    # NewConnectionError, e.g. a refused connection or a failed DNS lookup, is a ConnectTimeoutError
+    return isinstance(reason, ConnectTimeoutError)
+
+
+def classify_error(error):
+    # Returns (retry, retry_after) for transient errors; raises PermanentSendError or
+    # RejectedMediaError for errors that won't go away by sending again, and
+    # UncertainSendError when the send may have gone through
+    if isinstance(error, ApiTelegramException):
+        code = error.error_code
+        description = (error.description or '').lower()
+
+        if code == 429:
+            parameters = (error.result_json or {}).get('parameters') or {}
+            return True, parameters.get('retry_after')
+        if code >= 500:
+            return True, None
+        if code in (400, 413) and not any(marker in description for marker in CHAT_ERROR_MARKERS):
+            raise RejectedMediaError(str(error)) from error
+        raise PermanentSendError(str(error)) from error
+
+    if isinstance(error, ApiHTTPException):
+        status_code = getattr(error.result, 'status_code', None)
+
+        if status_code == 429 or (status_code and status_code >= 500):
+            return True, None
+        if status_code == 413:
+            raise RejectedMediaError(str(error)) from error
+        raise PermanentSendError(str(error)) from error
+
+    if isinstance(error, requests.ConnectionError) and connection_failed(error):
+        # The request never reached Telegram, so sending it again is safe
+        return True, None
+
+    if isinstance(error, (requests.ConnectionError, requests.ReadTimeout, requests.exceptions.ChunkedEncodingError,
+                          requests.exceptions.ContentDecodingError)):
+        # The request went out and the connection broke or timed out before the reply
+        # was read, so the message may be in the chat
+        raise UncertainSendError(str(error)) from error
+
+    return False, None
+
+
+class TelegramSender:
+    def __init__(self, bot, chat_rate=20 / 60, chat_burst=3, global_rate=30, max_attempts=5, base_delay=1,
+                 max_delay=60, max_retry_after=300):
+        # Sends through the bot while staying under Telegram's limits: chat_rate sends per
+        # second to any one chat and global_rate sends per second overall. Flood waits,
+        # server errors and failed connections are retried with exponential backoff
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.lock = threading.Lock()
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        return self._send(self.bot.send_photo, chat_id, photo, **kwargs)
+
+    def send_video(self, chat_id, video, **kwargs):
+        return self._send(self.bot.send_video, chat_id, video, **kwargs)
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._send(self.bot.send_message, chat_id, text, **kwargs)
+
+    def _chat_bucket(self, chat_id):
+        with self.lock:
+            if chat_id not in self.chat_buckets:
+                self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            return self.chat_buckets[chat_id]
+
+    def _backoff(self, attempt):
+        # Exponential backoff with jitter, so retries of several sends don't line up
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _send(self, method, chat_id, content, **kwargs):
+        chat_bucket = self._chat_bucket(chat_id)
+
+        for attempt in range(1, self.max_attempts + 1):
+            chat_bucket.acquire()
+            self.global_bucket.acquire()
+
+            try:
+                message = method(chat_id, content, **kwargs)
+                TELEGRAM_SENDS.inc(method=method.__name__, outcome='ok')
+                return message
+
+            except Exception as e:
+                try:
+                    retry, retry_after = classify_error(e)
+                except PermanentSendError:
+                    TELEGRAM_SENDS.inc(method=method.__name__, outcome='rejected')
+                    raise
+                except UncertainSendError:
+                    TELEGRAM_SENDS.inc(method=method.__name__, outcome='uncertain')
+                    raise
+
+                if retry and attempt < self.max_attempts:
+                    TELEGRAM_SENDS.inc(method=method.__name__, outcome='retried')
+                else:
+                    TELEGRAM_SENDS.inc(method=method.__name__, outcome='failed')
+
+                if not retry:
+                    raise
+                if attempt == self.max_attempts:
+                    logging.error(f"Sending to chat {chat_id} failed after {attempt} attempts: {e}")
+                    raise
+                if retry_after and retry_after > self.max_retry_after:
+                    logging.error(f"Telegram asked to wait {retry_after}s before sending to chat {chat_id}, "
+                                  f"giving up: {e}")
+                    raise
+
+                if retry_after:
+                    # Flood wait: hold back every send to this chat, not just this one
+                    delay = retry_after
+                    chat_bucket.pause(delay)
+                else:
+                    delay = self._backoff(attempt)
+
+                logging.warning(f"Sending to chat {chat_id} failed (attempt {attempt}/{self.max_attempts}), "
+                                f"retrying in {delay:.1f}s: {e}")
+
+                # An upload reads the file to the end, start it over on the next attempt
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+
+                if not retry_after:
+                    time.sleep(delay)
@@ -0,0 +1,101 @@
+from types import SimpleNamespace
+from coordination import LeaderElection
+
+
+class FakeConnection:
+    def __init__(self, database):
+        self.database = database
+        self.alive = True
+
+    def execute(self, statement, parameters=None):
+        if not self.alive:
+            raise ConnectionError('server closed the connection unexpectedly')
+
+        if 'pg_try_advisory_lock' in str(statement):
+            acquired = self.database.holder in (None, self)
+            if acquired:
+                self.database.holder = self
+            return SimpleNamespace(scalar=lambda: acquired)
+        return SimpleNamespace(scalar=lambda: 1)
+
+    def commit(self):
+        pass
+
+    def invalidate(self):
+        self.alive = False
+
+    def close(self):
+        pass
+
+
+class FakeEngine:
+    # A PostgreSQL engine with one advisory lock, released when its session dies
+    dialect = SimpleNamespace(name='postgresql')
+
+    def __init__(self):
+        self.holder = None
+        self.connections = []
+
+    def connect(self):
+        self.connections.append(FakeConnection(self))
+        return self.connections[-1]
+
+    def drop_connections(self):
+        for connection in self.connections:
+            connection.alive = False
+        self.holder = None
+
+
+def test_single_node_is_leader():
+    engine = FakeEngine()
+    election = LeaderElection(engine, node_id='a')
+
+    assert election.is_leader()
+    assert election.is_leader()
+    assert len(engine.connections) == 1
+
+
+def test_only_one_node_is_leader():
+    engine = FakeEngine()
+    first, second = LeaderElection(engine, node_id='a'), LeaderElection(engine, node_id='b')
+
+    assert first.is_leader()
+    assert not second.is_leader()
+
+
+def test_leader_takes_the_lock_again_after_its_connection_died():
+    engine = FakeEngine()
+    election = LeaderElection(engine, node_id='a')
+    assert election.is_leader()
+
+    # E.g. a database restart overnight, which also released the lock
+    engine.drop_connections()
+
+    assert election.is_leader()
+    assert engine.holder is engine.connections[-1]
+
+
+def test_follower_takes_over_after_the_leader_died():
+    engine = FakeEngine()
+    leader, follower = LeaderElection(engine, node_id='a'), LeaderElection(engine, node_id='b')
+    assert leader.is_leader()
+    assert not follower.is_leader()
+
+    engine.drop_connections()
+
+    assert follower.is_leader()
+    assert not leader.is_leader()
+
+
+def test_no_leader_while_the_database_is_down():
+    engine = FakeEngine()
+    election = LeaderElection(engine, node_id='a')
+    assert election.is_leader()
+
+    def refuse():
+        raise ConnectionError('connection refused')
+
+    engine.drop_connections()
+    engine.connect = refuse
+
+    assert not election.is_leader()
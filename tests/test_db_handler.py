@@ -0,0 +1,191 @@
+from datetime import date, timedelta
+from sqlalchemy import insert, select
+import pytest
+from db_handler import DBHandler
+
+MANUAL_MEME_RANK = 99999
+MAIN_CHAT_ID = '-100001'
+OLD = date(2026, 1, 1)
+
+
+@pytest.fixture
+def db():
+    db = DBHandler('sqlite://', manual_meme_rank=MANUAL_MEME_RANK)
+    db.metadata.create_all(db.engine)
+    db.migrate()
+    return db
+
+
+def add_memes(db, ranks, **values):
+    # Queued memes with the given ranks, ids counting from 1 after the existing ones
+    with db.engine.begin() as connection:
+        last_id = connection.execute(select(db.memes_table.c.id).order_by(db.memes_table.c.id.desc())).scalar()
+        first_id = (last_id or 0) + 1
+        rows = [dict({'id': first_id + index, 'rank': rank, 'url': f'http://memes/{first_id + index}.jpg',
+                      'date_added': OLD, 'checked': True, 'approved': True, 'published': False}, **values)
+                for index, rank in enumerate(ranks)]
+        connection.execute(insert(db.memes_table), rows)
+    return [row['id'] for row in rows]
+
+
+def column(db, table, name, **where):
+    statement = select(table.c[name]).order_by(table.c[name])
+    for key, value in where.items():
+        statement = statement.where(table.c[key] == value)
+    with db.engine.connect() as connection:
+        return connection.execute(statement).scalars().all()
+
+
+def published(db, meme_id):
+    return column(db, db.memes_table, 'published', id=meme_id)[0]
+
+
+def claim_all(db, **kwargs):
+    claimed = []
+    while (meme := db.claim_meme_to_channel(node_id='node', **kwargs)) is not None:
+        claimed.append(meme.id)
+    return claimed
+
+
+def test_claim_takes_scored_memes_before_unscored(db):
+    low, high, middle, top = add_memes(db, [10, 500, 100, 1000])
+    db.save_posting_order([middle, low], [2.0, 1.0])
+
+    assert [meme.id for meme in db.get_memes_to_channel(4)] == [middle, low, top, high]
+    assert claim_all(db) == [middle, low, top, high]
+    assert column(db, db.posting_order_table, 'meme_id') == []
+
+
+def test_claim_skips_scored_memes_that_left_the_queue(db):
+    queued, rejected = add_memes(db, [10, 20])
+    db.save_posting_order([rejected, queued], [2.0, 1.0])
+    db.set_flags([rejected], approved=False)
+
+    assert claim_all(db) == [queued]
+
+
+def test_claim_takes_a_lease_until_the_post_is_finished(db):
+    meme_id, = add_memes(db, [10])
+
+    meme = db.claim_meme_to_channel(node_id='node')
+    assert meme.id == meme_id and published(db, meme_id)
+    assert column(db, db.meme_claims_table, 'node_id') == ['node']
+
+    db.finish_meme_claim(meme_id, posted=True)
+    assert column(db, db.meme_claims_table, 'meme_id') == []
+
+
+def test_statistics_count_every_post_once(db):
+    first, second = add_memes(db, [100, 300])
+    manual, = add_memes(db, [MANUAL_MEME_RANK])
+
+    db.claim_meme_to_channel(node_id='node')
+    db.finish_meme_claim(manual, posted=True)
+
+    db.set_flags([first, second], published=True)
+    # Publishing memes that are already published doesn't count them again
+    db.set_flags([first, second, manual], published=True)
+
+    stats = db.get_statistics()
+    assert stats['all_published_count'] == 3
+    assert stats['published_manual_count'] == 1
+    assert stats['published_suggested_count'] == 2
+    assert stats['sum_rank_of_suggested'] == 400
+    assert stats['min_rank_of_suggested'] == 100
+    assert stats['max_rank_of_suggested'] == 300
+
+
+def test_failed_post_is_not_counted(db):
+    meme_id, = add_memes(db, [10])
+    db.claim_meme_to_channel(node_id='node')
+    db.finish_meme_claim(meme_id, posted=False)
+
+    assert db.get_statistics()['all_published_count'] == 0
+
+
+def test_recover_expired_claims(db):
+    sent, sending, unsent = add_memes(db, [300, 200, 100])
+    assert claim_all(db, lease=-1) == [sent, sending, unsent]
+
+    db.record_delivery(sent, MAIN_CHAT_ID, 'sent', message_id=1)
+    db.record_delivery(sending, MAIN_CHAT_ID, 'sending')
+    # A delivery to another channel doesn't keep the meme out of the queue
+    db.record_delivery(unsent, '-100002', 'sent', message_id=2)
+
+    assert db.recover_meme_claims(MAIN_CHAT_ID) == 1
+    assert published(db, sent) and published(db, sending) and not published(db, unsent)
+    assert column(db, db.meme_claims_table, 'meme_id') == []
+
+    # Only the meme known to be in the main channel is counted, and only once
+    assert db.recover_meme_claims(MAIN_CHAT_ID) == 0
+    stats = db.get_statistics()
+    assert stats['all_published_count'] == 1
+    assert stats['sum_rank_of_suggested'] == 300
+
+
+def test_recover_keeps_live_claims(db):
+    meme_id, = add_memes(db, [10])
+    db.claim_meme_to_channel(node_id='node', lease=1800)
+
+    assert db.recover_meme_claims(MAIN_CHAT_ID) == 0
+    assert column(db, db.meme_claims_table, 'meme_id') == [meme_id]
+
+    # Unless they belong to the node that is starting again
+    assert db.recover_meme_claims(MAIN_CHAT_ID, node_id='node') == 1
+    assert not published(db, meme_id)
+
+
+def test_reserve_delivery(db):
+    meme_id, = add_memes(db, [10])
+
+    assert db.reserve_delivery(meme_id, MAIN_CHAT_ID)
+    # In flight, maybe sent by a node that crashed
+    assert not db.reserve_delivery(meme_id, MAIN_CHAT_ID)
+
+    db.record_delivery(meme_id, MAIN_CHAT_ID, 'failed', error='Bad Gateway')
+    assert db.reserve_delivery(meme_id, MAIN_CHAT_ID)
+
+    db.record_delivery(meme_id, MAIN_CHAT_ID, 'sent', message_id=1)
+    assert not db.reserve_delivery(meme_id, MAIN_CHAT_ID)
+
+    # Other chats are independent
+    assert db.reserve_delivery(meme_id, '-100002')
+
+
+def test_cleanup_skips_claimed_memes(db):
+    add_memes(db, [10, 20], published=True)
+    add_memes(db, [30], approved=False)
+    claimed, = add_memes(db, [40])
+    db.claim_meme_to_channel(node_id='node')
+
+    assert db.remove_old_memes(OLD + timedelta(days=1)) == (1, 2)
+    assert column(db, db.memes_table, 'id') == [claimed]
+
+    db.finish_meme_claim(claimed, posted=True)
+    assert db.remove_old_memes(OLD + timedelta(days=1)) == (0, 1)
+    assert column(db, db.memes_table, 'id') == []
+
+
+def test_cleanup_removes_render_jobs_of_removed_memes(db):
+    done, queued = add_memes(db, [10, 20], published=True)
+    recent, = add_memes(db, [30], published=True, date_added=OLD + timedelta(days=7))
+    for meme_id in (done, queued, recent):
+        db.enqueue_render_job(meme_id, f'http://memes/{meme_id}.jpg')
+    db.update_render_job(db.claim_render_job(node_id='node').id, 'done')
+
+    assert db.remove_old_memes(OLD + timedelta(days=1)) == (0, 2)
+    assert column(db, db.render_jobs_table, 'meme_id') == [recent]
+
+
+def test_cleanup_removes_deliveries_and_positions_of_removed_memes(db):
+    sent, = add_memes(db, [10], published=True)
+    rejected, = add_memes(db, [20], approved=False)
+    recent, = add_memes(db, [30], date_added=OLD + timedelta(days=7))
+    db.record_delivery(sent, MAIN_CHAT_ID, 'sent', message_id=1)
+    db.record_delivery(recent, MAIN_CHAT_ID, 'failed', error='Bad Gateway')
+    # The scoring engine ranked the rejected meme before it left the queue
+    db.save_posting_order([rejected, recent], [2.0, 1.0])
+
+    assert db.remove_old_memes(OLD + timedelta(days=1)) == (1, 1)
+    assert column(db, db.deliveries_table, 'meme_id') == [recent]
+    assert column(db, db.posting_order_table, 'meme_id') == [recent]
@@ -0,0 +1,87 @@
+from io import BytesIO
+from PIL import Image
+import random
+import pytest
+from fakes import synthetic_image
+from image_hash import (BAND_BITS, BANDS, HASH_SIZE, band_neighbors, candidate_bands, dhash, format_hash,
+                        hamming_distance, hash_bands, parse_hash)
+
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+
+def flip_bits(value, positions):
+    for position in positions:
+        value ^= 1 << position
+    return value
+
+
+def is_candidate(value, other, max_distance):
+    # What find_posted_media_hashes matches: any band of other among the candidates of that band
+    return any(band in values for band, values in zip(hash_bands(other), candidate_bands(value, max_distance)))
+
+
+def test_format_and_parse_hash():
+    value = random.Random(1).getrandbits(HASH_BITS)
+
+    assert len(format_hash(value)) == HASH_BITS // 4
+    assert parse_hash(format_hash(value)) == value
+    assert format_hash(1) == '0' * 15 + '1'
+
+
+def test_hash_bands_cover_the_hash():
+    value = random.Random(2).getrandbits(HASH_BITS)
+    bands = hash_bands(value)
+
+    assert len(bands) == BANDS
+    assert sum(band << (BAND_BITS * index) for index, band in enumerate(bands)) == value
+
+
+def test_band_neighbors():
+    neighbors = band_neighbors(0b1010, 1)
+
+    assert len(neighbors) == len(set(neighbors)) == 1 + BAND_BITS
+    assert all(hamming_distance(0b1010, neighbor) <= 1 for neighbor in neighbors)
+
+
+@pytest.mark.parametrize('max_distance', [0, 3, 6, 8, 11])
+def test_candidate_bands_find_every_hash_within_max_distance(max_distance):
+    generator = random.Random(max_distance)
+
+    for _ in range(300):
+        value = generator.getrandbits(HASH_BITS)
+        distance = generator.randint(0, max_distance)
+        other = flip_bits(value, generator.sample(range(HASH_BITS), distance))
+
+        assert is_candidate(value, other, max_distance)
+
+
+def test_candidate_bands_with_the_flips_spread_over_all_bands():
+    # The worst case: 6 flipped bits as 2, 2, 1, 1 over the bands still leaves bands with one flip
+    value = random.Random(3).getrandbits(HASH_BITS)
+    other = flip_bits(value, [0, 1, BAND_BITS, BAND_BITS + 1, 2 * BAND_BITS, 3 * BAND_BITS])
+
+    assert hamming_distance(value, other) == 6
+    assert is_candidate(value, other, 6)
+
+    # With two flips in every band, the hash is too far away to be a candidate
+    too_far = flip_bits(other, [2 * BAND_BITS + 1, 3 * BAND_BITS + 1])
+    assert not is_candidate(value, too_far, 6)
+
+
+def test_dhash_of_a_rescaled_copy_is_close():
+    original = synthetic_image(7)
+    buffer = BytesIO()
+    Image.open(BytesIO(original)).resize((400, 300)).save(buffer, 'JPEG', quality=60)
+
+    value = dhash(BytesIO(original))
+    copy = dhash(BytesIO(buffer.getvalue()))
+
+    assert hamming_distance(value, copy) <= 6
+    assert hamming_distance(value, dhash(BytesIO(synthetic_image(8)))) > 6
+
+
+def test_dhash_of_a_file_that_is_no_image(tmp_path):
+    path = tmp_path / 'video.mp4'
+    path.write_bytes(b'not an image')
+
+    assert dhash(path) is None
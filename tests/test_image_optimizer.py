@@ -0,0 +1,59 @@
+from PIL import Image
+import pytest
+from fakes import synthetic_image
+from image_optimizer import ImageOptimizer
+from media_cache import MediaCache
+
+
+@pytest.fixture
+def optimizer(tmp_path):
+    optimizer = ImageOptimizer(MediaCache(str(tmp_path / 'cache'), 1024 ** 3), max_workers=1, max_side=640)
+    runs = []
+    run = optimizer._run
+
+    def counted_run(media_path):
+        runs.append(media_path)
+        return run(media_path)
+
+    optimizer._run = counted_run
+    optimizer.runs = runs
+    yield optimizer
+    optimizer.executor.shutdown()
+
+
+def write_image(path, **kwargs):
+    path.write_bytes(synthetic_image(1, **kwargs))
+    return str(path)
+
+
+def test_optimized_image_is_cached(optimizer, tmp_path):
+    media_path = write_image(tmp_path / 'big.jpg', width=1280, height=960)
+
+    optimized_path = optimizer.optimize(media_path)
+    assert optimized_path != media_path
+    assert optimizer.optimize(media_path) == optimized_path
+    assert len(optimizer.runs) == 1
+
+
+def test_image_that_cant_be_improved_is_only_decoded_once(optimizer, tmp_path):
+    # Animations are uploaded as they are
+    media_path = str(tmp_path / 'animation.gif')
+    frames = [Image.new('RGB', (64, 64), color) for color in ('red', 'green', 'blue')]
+    frames[0].save(media_path, save_all=True, append_images=frames[1:])
+
+    assert optimizer.optimize(media_path) == media_path
+    assert optimizer.optimize(media_path) == media_path
+    assert len(optimizer.runs) == 1
+
+
+def test_failures_are_tried_again(optimizer, tmp_path):
+    media_path = write_image(tmp_path / 'big.jpg', width=1280, height=960)
+    run = optimizer._run
+
+    def failing_run(media_path):
+        optimizer._run = run
+        raise TimeoutError('worker timed out')
+
+    optimizer._run = failing_run
+    assert optimizer.optimize(media_path) == media_path
+    assert optimizer.optimize(media_path) != media_path
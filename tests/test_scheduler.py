@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+import pytest
+import pytz
+from scheduler import CalendarTrigger, EventScheduler, ScheduledJob, parse_calendar
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=pytz.utc)
+
+
+def test_parse_calendar():
+    calendar = parse_calendar('mon-fri=08:45,15:45;sat,sun=11:00;fri=20:45')
+
+    assert [slot.strftime('%H:%M') for slot in calendar[0]] == ['08:45', '15:45']
+    assert [slot.strftime('%H:%M') for slot in calendar[4]] == ['08:45', '15:45', '20:45']
+    assert [slot.strftime('%H:%M') for slot in calendar[6]] == ['11:00']
+
+
+def test_next_after_keeps_the_wall_clock_time_across_daylight_saving():
+    trigger = CalendarTrigger(parse_calendar('mon-sun=08:45'), 'Europe/Berlin')
+
+    # Summer time starts on Sunday 2026-03-29, 08:45 moves from 07:45 to 06:45 UTC
+    assert trigger.next_after(utc(2026, 3, 28, 7, 0)) == utc(2026, 3, 28, 7, 45)
+    assert trigger.next_after(utc(2026, 3, 28, 7, 45)) == utc(2026, 3, 29, 6, 45)
+
+    # And back on Sunday 2026-10-25
+    assert trigger.next_after(utc(2026, 10, 24, 7, 0)) == utc(2026, 10, 25, 7, 45)
+
+
+def test_next_after_skips_days_without_slots():
+    trigger = CalendarTrigger(parse_calendar('sat=11:00'), 'Europe/Moscow')
+
+    # Monday 2026-03-02, the next Saturday 11:00 in Moscow is 08:00 UTC
+    assert trigger.next_after(utc(2026, 3, 2, 12, 0)) == utc(2026, 3, 7, 8, 0)
+
+
+def test_next_after_with_offset():
+    trigger = CalendarTrigger(parse_calendar('mon-sun=08:45'), 'Europe/Moscow', offset=-timedelta(minutes=10))
+
+    assert trigger.next_after(utc(2026, 3, 2, 0, 0)) == utc(2026, 3, 2, 5, 35)
+
+
+def test_next_after_empty_calendar():
+    assert CalendarTrigger({}, 'Europe/Moscow').next_after(utc(2026, 3, 2)) is None
+
+
+def slots_to_run(catch_up, missed, now):
+    job = ScheduledJob('post', None, None, catch_up=catch_up, catch_up_window=3600, grace=60)
+    scheduler = EventScheduler(max_workers=1)
+    try:
+        return scheduler._slots_to_run(job, missed, now)
+    finally:
+        scheduler.executor.shutdown()
+
+
+NOW = utc(2026, 3, 2, 12, 0)
+TOO_OLD = NOW - timedelta(hours=3)
+LATE = NOW - timedelta(minutes=30)
+ON_TIME = NOW - timedelta(seconds=10)
+
+
+@pytest.mark.parametrize('catch_up, missed, expected', [
+    ('skip', [TOO_OLD, LATE, ON_TIME], [ON_TIME]),
+    ('skip', [TOO_OLD, LATE], []),
+    ('latest', [TOO_OLD, LATE, ON_TIME], [ON_TIME]),
+    ('latest', [TOO_OLD, LATE], [LATE]),
+    ('latest', [TOO_OLD], []),
+    ('all', [TOO_OLD, LATE, ON_TIME], [LATE, ON_TIME]),
+])
+def test_slots_to_run_catch_up(catch_up, missed, expected):
+    assert slots_to_run(catch_up, missed, NOW) == expected
+
+
+def test_unknown_catch_up_policy():
+    with pytest.raises(ValueError):
+        ScheduledJob('post', None, None, catch_up='sometimes')
@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+import math
+import numpy as np
+import pytest
+from scoring import log_normalized, occurrence_index, score_queue
+
+NOW = datetime(2026, 3, 2, 12, 0)
+PINNED_RANK = 99999
+
+
+def meme(meme_id, rank, comments=0, posted_when=0, added=NOW, author=None):
+    # A queue row as returned by get_queue_for_scoring
+    return meme_id, rank, comments, posted_when, added, author or f'author{meme_id}'
+
+
+def scores_by_id(rows, **kwargs):
+    meme_ids, scores = score_queue(rows, now=NOW, **kwargs)
+    return dict(zip(meme_ids, scores))
+
+
+def test_empty_queue():
+    assert score_queue([], now=NOW) == ([], [])
+
+
+def test_log_normalized():
+    values = np.array([0, 9, 99])
+
+    assert log_normalized(values).tolist() == pytest.approx([0, 0.5, 1])
+    assert log_normalized(values, np.array([True, True, False])).tolist() == pytest.approx([0, 1, 2])
+    assert log_normalized(np.zeros(3)).tolist() == [0, 0, 0]
+
+
+def test_occurrence_index():
+    assert occurrence_index(np.array([2, 1, 2, 2, 1])).tolist() == [0, 0, 1, 2, 1]
+
+
+def test_higher_rank_goes_first():
+    meme_ids, _ = score_queue([meme(1, 10), meme(2, 1000), meme(3, 100)], now=NOW)
+
+    assert meme_ids == [2, 3, 1]
+
+
+def test_ties_in_id_order():
+    meme_ids, _ = score_queue([meme(3, 100), meme(1, 100), meme(2, 100)], now=NOW)
+
+    assert meme_ids == [1, 2, 3]
+
+
+def test_score_halves_every_half_life():
+    scores = scores_by_id([meme(1, 100), meme(2, 100, posted_when=72), meme(3, 100, added=NOW - timedelta(hours=144))],
+                          half_life_hours=72)
+
+    assert scores[2] == pytest.approx(scores[1] / 2)
+    assert scores[3] == pytest.approx(scores[1] / 4)
+
+
+def test_further_memes_of_an_author_are_penalized():
+    scores = scores_by_id([meme(1, 100, author='a'), meme(2, 100, author='a'), meme(3, 100, author='a'),
+                           meme(4, 100, author='b')], diversity_penalty=0.5)
+
+    assert scores[4] == pytest.approx(scores[1])
+    assert scores[2] == pytest.approx(scores[1] * 0.5)
+    assert scores[3] == pytest.approx(scores[1] * 0.25)
+
+
+def test_pinned_memes_go_first():
+    meme_ids, scores = score_queue([meme(1, 1000), meme(2, PINNED_RANK), meme(3, 10)], now=NOW,
+                                   pinned_rank=PINNED_RANK)
+
+    assert meme_ids == [2, 1, 3]
+    assert math.isinf(scores[0])
+
+
+def test_pinned_memes_dont_change_the_other_scores():
+    rows = [meme(1, 1000, comments=50), meme(2, 10, comments=5)]
+
+    without_pinned = scores_by_id(rows, pinned_rank=PINNED_RANK)
+    with_pinned = scores_by_id(rows + [meme(3, PINNED_RANK, comments=500)], pinned_rank=PINNED_RANK)
+
+    assert with_pinned[1] == pytest.approx(without_pinned[1])
+    assert with_pinned[2] == pytest.approx(without_pinned[2])
@@ -0,0 +1,158 @@
+from types import SimpleNamespace
+from http.client import RemoteDisconnected
+from telebot.apihelper import ApiTelegramException, ApiHTTPException
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+import pytest
+import requests
+import telegram_sender
+from telegram_sender import (PermanentSendError, RejectedMediaError, TelegramSender, TokenBucket, UncertainSendError,
+                             classify_error)
+
+
+class FakeClock:
+    # Stands in for the time module, sleeping only advances the clock
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(telegram_sender, 'time', clock)
+    return clock
+
+
+def refused_connection():
+    # What requests raises when it can't connect at all
+    reason = NewConnectionError(None, 'Failed to establish a new connection: [Errno 111] Connection refused')
+    return requests.ConnectionError(MaxRetryError(None, '/sendPhoto', reason))
+
+
+def aborted_connection():
+    # What requests raises when the connection drops after the request was sent
+    return requests.ConnectionError(
+        ProtocolError('Connection aborted.', RemoteDisconnected('Remote end closed connection without response'))
+    )
+
+
+def telegram_error(code, description, **parameters):
+    result_json = {'error_code': code, 'description': description}
+    if parameters:
+        result_json['parameters'] = parameters
+    return ApiTelegramException('send_photo', None, result_json)
+
+
+def test_token_bucket_allows_a_burst_then_the_rate(clock):
+    bucket = TokenBucket(rate=2, capacity=3)
+
+    for _ in range(3):
+        bucket.acquire()
+    assert clock.sleeps == []
+
+    bucket.acquire()
+    assert clock.sleeps == [pytest.approx(0.5)]
+
+
+def test_token_bucket_refills_up_to_capacity(clock):
+    bucket = TokenBucket(rate=1, capacity=2)
+    bucket.acquire()
+    bucket.acquire()
+
+    clock.now += 60
+    for _ in range(2):
+        bucket.acquire()
+    assert clock.sleeps == []
+
+    bucket.acquire()
+    assert clock.sleeps == [pytest.approx(1)]
+
+
+def test_token_bucket_pause(clock):
+    bucket = TokenBucket(rate=10, capacity=10)
+    bucket.pause(30)
+    bucket.acquire()
+
+    assert sum(clock.sleeps) == pytest.approx(30)
+
+
+@pytest.mark.parametrize('error, expected', [
+    (telegram_error(429, 'Too Many Requests: retry after 5', retry_after=5), (True, 5)),
+    (telegram_error(502, 'Bad Gateway'), (True, None)),
+    (refused_connection(), (True, None)),
+    (requests.ConnectTimeout('connect timed out'), (True, None)),
+    (ValueError('not a send error'), (False, None)),
+])
+def test_classify_retryable_errors(error, expected):
+    assert classify_error(error) == expected
+
+
+@pytest.mark.parametrize('error, raised', [
+    (telegram_error(400, 'Bad Request: wrong file identifier/HTTP URL specified'), RejectedMediaError),
+    (telegram_error(413, 'Request Entity Too Large'), RejectedMediaError),
+    (telegram_error(400, 'Bad Request: chat not found'), PermanentSendError),
+    (telegram_error(403, 'Forbidden: bot was kicked from the channel chat'), PermanentSendError),
+    (ApiHTTPException('send_photo', SimpleNamespace(status_code=413, reason='Too Large', text='')), RejectedMediaError),
+    (requests.ReadTimeout('read timed out'), UncertainSendError),
+    (aborted_connection(), UncertainSendError),
+    (requests.ConnectionError(ConnectionResetError(104, 'Connection reset by peer')), UncertainSendError),
+])
+def test_classify_permanent_and_uncertain_errors(error, raised):
+    with pytest.raises(raised) as info:
+        classify_error(error)
+
+    # Errors about the chat are not blamed on the media
+    if raised is PermanentSendError:
+        assert not isinstance(info.value, RejectedMediaError)
+
+
+class ScriptedBot:
+    # Raises the given errors in turn, then succeeds
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'message'
+
+
+def test_sender_retries_failed_connections(clock):
+    bot = ScriptedBot(refused_connection(), requests.ConnectTimeout('connect timed out'),
+                      telegram_error(502, 'Bad Gateway'))
+
+    assert TelegramSender(bot).send_photo(1, 'photo') == 'message'
+    assert bot.calls == 4
+
+
+@pytest.mark.parametrize('error', [requests.ReadTimeout('read timed out'), aborted_connection()])
+def test_sender_does_not_resend_when_the_reply_was_lost(clock, error):
+    bot = ScriptedBot(error)
+
+    with pytest.raises(UncertainSendError):
+        TelegramSender(bot).send_photo(1, 'photo')
+    assert bot.calls == 1
+
+
+def test_sender_gives_up_after_max_attempts(clock):
+    bot = ScriptedBot(*[telegram_error(502, 'Bad Gateway')] * 3)
+
+    with pytest.raises(ApiTelegramException):
+        TelegramSender(bot, max_attempts=3).send_photo(1, 'photo')
+    assert bot.calls == 3
+
+
+def test_sender_waits_for_retry_after(clock):
+    bot = ScriptedBot(telegram_error(429, 'Too Many Requests: retry after 7', retry_after=7))
+
+    assert TelegramSender(bot).send_photo(1, 'photo') == 'message'
+    assert sum(clock.sleeps) >= 7
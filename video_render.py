@@ -0,0 +1,381 @@
+from PIL import Image as PILImage
+from PIL import Image, ImageDraw, ImageFont
+from downloads import file_sha256
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import uuid
+
+# Rendering only needs Pillow and ffmpeg and no database, Firebase or bot state, so it
+# can run in the render worker processes
+
+OUTPUT_DIRECTORY = 'output_videos/'
+
+# Static overlay assets; their resized versions only depend on the background video size
+ICON_PATH = 'icons8-telegram-50.png'
+FONT_PATH = 'mechanical.otf'
+CAPTION_TEXT = 'coode_review'
+ASSETS_DIRECTORY = os.path.join(OUTPUT_DIRECTORY, 'assets')
+
+# Overlay assets by (video width, video height, text, font), and ffprobe results by video file
+overlay_assets = {}
+video_probes = {}
+
+# Named x264 encoder settings, trading encoding speed against output size
+ENCODER_PROFILES = {
+    'fast': {'preset': 'veryfast', 'crf': 26},
+    'balanced': {'preset': 'medium', 'crf': 23},
+    'small': {'preset': 'slow', 'crf': 28},
+}
+
+# Software encoders that understand the x264 style -preset and -crf options
+SOFTWARE_CODECS = ('libx264', 'libx265')
+
+# Full frame overlay templates, one per meme and video size, kept for a week for reuse
+FRAMES_DIRECTORY = os.path.join(OUTPUT_DIRECTORY, 'frames')
+FRAME_MAX_AGE = 7 * 24 * 3600
+
+
+def preprocess_image(photo_path, output_path, video_width, target_width_percentage):
+    with PILImage.open(photo_path) as img:
+        original_width, original_height = img.size
+        target_width = int(video_width * target_width_percentage)
+        aspect_ratio = original_height / original_width
+        target_height = int(target_width * aspect_ratio)
+        resized_img = img.resize((target_width, target_height), PILImage.LANCZOS)
+        resized_img.save(output_path)
+        return target_width, target_height
+
+def overlay_layout(video_width, video_height, image_width, image_height, assets):
+    # Meme centered with the caption badge below it; returns the meme and badge positions
+    image_x = (video_width - image_width) // 2
+    image_y = (video_height - image_height - assets['text_height'] - 20) // 2
+    text_y = image_y + image_height + 20
+    return image_x, image_y, assets['badge_x'], text_y - assets['text_offset_y']
+
+
+def composite_clipped(frame, image, x, y):
+    # Alpha composite image onto frame at (x, y), cropping whatever falls outside of it
+    left, top = max(0, -x), max(0, -y)
+    right = min(image.width, frame.width - x)
+    bottom = min(image.height, frame.height - y)
+
+    if right > left and bottom > top:
+        frame.alpha_composite(image.crop((left, top, right, bottom)), (x + left, y + top))
+
+
+def build_overlay_frame(meme_path, video_width, video_height, assets, frames_directory=FRAMES_DIRECTORY):
+    # The meme, icon and caption drawn once onto a transparent frame of the video size, so
+    # ffmpeg needs a single overlay. Frames are reused when the same meme is rendered again
+    badge_name = os.path.splitext(os.path.basename(assets['badge_path']))[0]
+    frame_path = os.path.join(frames_directory, f"frame_{file_sha256(meme_path)[:16]}_{badge_name}.png")
+
+    if os.path.exists(frame_path):
+        os.utime(frame_path)
+        return frame_path
+
+    os.makedirs(frames_directory, exist_ok=True)
+
+    with PILImage.open(meme_path) as img:
+        image_width = int(video_width * 0.9)
+        image_height = int(image_width * img.height / img.width)
+        meme = img.convert('RGBA').resize((image_width, image_height), PILImage.LANCZOS)
+
+    image_x, image_y, badge_x, badge_y = overlay_layout(video_width, video_height, image_width, image_height, assets)
+
+    frame = Image.new('RGBA', (video_width, video_height), (0, 0, 0, 0))
+    composite_clipped(frame, meme, image_x, image_y)
+
+    with PILImage.open(assets['badge_path']) as badge:
+        composite_clipped(frame, badge.convert('RGBA'), badge_x, badge_y)
+
+    write_atomically(frame_path, frame.save)
+    prune_overlay_frames(frames_directory)
+    return frame_path
+
+
+def prune_overlay_frames(frames_directory, max_age=FRAME_MAX_AGE):
+    now = time.time()
+    for entry in os.scandir(frames_directory):
+        try:
+            if now - entry.stat().st_mtime > max_age:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+def probe_video(video_path):
+    # Background videos come from the content addressed media cache, where a new blob
+    # generation gets a new file, so the file path is a safe memoization key
+    if video_path in video_probes:
+        return video_probes[video_path]
+
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height,duration', '-of',
+         'csv=p=0', video_path],
+        capture_output=True, text=True, check=True)
+    video_info = result.stdout.strip().split(',')
+    video_width = int(video_info[0])
+    video_height = int(video_info[1])
+    video_duration = float(video_info[2])
+
+    video_probes[video_path] = (video_width, video_height, video_duration)
+    return video_probes[video_path]
+
+
+def get_overlay_assets(video_width, video_height, text=CAPTION_TEXT, font_path=FONT_PATH,
+                       assets_directory=ASSETS_DIRECTORY):
+    key = (video_width, video_height, text, font_path)
+    if key in overlay_assets:
+        return overlay_assets[key]
+
+    # Assets are also kept on disk, so other worker processes and restarts reuse them
+    assets_id = hashlib.sha1(f"{text}|{font_path}".encode()).hexdigest()[:12]
+    assets_name = f"{video_width}x{video_height}_{assets_id}"
+    metadata_path = os.path.join(assets_directory, f"overlay_{assets_name}.json")
+
+    try:
+        with open(metadata_path) as metadata_file:
+            assets = json.load(metadata_file)
+    except FileNotFoundError:
+        assets = build_overlay_assets(video_width, video_height, text, font_path, assets_directory, assets_name)
+
+        # The metadata is written last, so its presence means all assets are complete
+        write_atomically(metadata_path, lambda path: _write_json(path, assets))
+
+    overlay_assets[key] = assets
+    return assets
+
+
+def build_overlay_assets(video_width, video_height, text, font_path, assets_directory, assets_name):
+    logging.info(f"Building overlay assets for video size {video_width}x{video_height}")
+    os.makedirs(assets_directory, exist_ok=True)
+
+    icon_width = int(video_width * 0.06)
+    with PILImage.open(ICON_PATH) as icon_image:
+        icon_height = int(icon_width * icon_image.height / icon_image.width)
+        icon = icon_image.convert('RGBA').resize((icon_width, icon_height), PILImage.LANCZOS)
+
+    font_size = int(video_width * 0.05)
+
+    try:
+        font = ImageFont.truetype(font_path, font_size)
+    except IOError:
+        logging.warning("Specified font not found. Using default font.")
+        font = ImageFont.load_default()
+
+    text_bbox = ImageDraw.Draw(Image.new('RGBA', (1, 1))).textbbox((0, 0), text, font=font)
+    text_width = text_bbox[2] - text_bbox[0]
+    text_height = text_bbox[3] - text_bbox[1]
+    logging.info(f"Text dimensions: width={text_width}, height={text_height}")
+
+    # The icon and the caption are composited into a single badge image, so ffmpeg
+    # overlays them in one pass. The caption sits right of the icon and a bit lower
+    text_offset_x = int(video_width * 0.06 + 5)
+    text_offset_y = int(video_height * 0.01)
+    badge_size = (text_offset_x + text_bbox[2] + 1, max(icon_height, text_offset_y + font_size + 20))
+
+    badge = Image.new('RGBA', badge_size, (255, 255, 255, 0))
+    badge.alpha_composite(icon, (0, 0))
+    ImageDraw.Draw(badge).text((text_offset_x, text_offset_y), text, font=font, fill="white")
+
+    badge_path = os.path.join(assets_directory, f"badge_{assets_name}.png")
+    write_atomically(badge_path, badge.save)
+
+    return {
+        'badge_path': badge_path,
+        # The caption ends at 95% of the video width
+        'badge_x': int(video_width * 0.95 - text_width - text_offset_x),
+        'text_offset_y': text_offset_y,
+        'text_width': text_width,
+        'text_height': text_height,
+    }
+
+
+def encoder_arguments(profile='balanced', preset=None, threads=None, codec='libx264'):
+    settings = ENCODER_PROFILES[profile]
+    arguments = ['-codec:v', codec]
+
+    # Hardware encoders have their own presets and rate control; only an explicitly
+    # configured preset is passed to them
+    if codec in SOFTWARE_CODECS:
+        arguments += ['-preset', preset or settings['preset'], '-crf', str(settings['crf'])]
+    elif preset:
+        arguments += ['-preset', preset]
+
+    if threads:
+        arguments += ['-threads', str(threads)]
+
+    return arguments + ['-pix_fmt', 'yuv420p']
+
+
+def write_atomically(path, write):
+    # Concurrent builders in other processes never see a half written file
+    root, extension = os.path.splitext(path)
+    temp_path = f"{root}.{uuid.uuid4().hex}.tmp{extension}"
+    try:
+        write(temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _write_json(path, data):
+    with open(path, 'w') as file:
+        json.dump(data, file)
+
+
+def render_overlay_video(meme_path, video_path, output_directory=OUTPUT_DIRECTORY, video_info=None, encoder=None,
+                         overlay_mode='template'):
+    # A batch of one
+    return render_overlay_batch([meme_path], video_path, output_directory, video_info, encoder, overlay_mode)[0]
+
+
+def render_overlay_batch(meme_paths, video_path, output_directory=OUTPUT_DIRECTORY, video_info=None, encoder=None,
+                         overlay_mode='template'):
+    # Render one video per meme on the same background. The background is decoded once and
+    # split into a branch per meme, so ffmpeg starts and decodes once for the whole batch.
+    # Returns the output paths in the order of meme_paths, None for memes that failed
+    logging.info(f'Video generation started for {len(meme_paths)} memes')
+
+    # Check if ffprobe is available
+    if video_info is None and shutil.which('ffprobe') is None:
+        logging.error("ffprobe is not installed or not found in PATH.")
+        return [None] * len(meme_paths)
+
+    try:
+        video_width, video_height, video_duration = video_info or probe_video(video_path)
+        logging.info(f"Video dimensions: width={video_width}, height={video_height}")
+    except Exception as e:
+        logging.error(f"Error loading video: {e}")
+        return [None] * len(meme_paths)
+
+    os.makedirs(output_directory, exist_ok=True)
+
+    # Overlay frames are kept next to the videos they are rendered for
+    frames_directory = os.path.join(output_directory, 'frames')
+
+    # Every render works in its own temporary directory, so renders can run in parallel
+    # and nothing is left behind when they finish, successfully or not
+    with tempfile.TemporaryDirectory(prefix='render_', dir=output_directory) as workspace:
+        overlays = [_prepare_overlay(meme_path, workspace, index, video_width, video_height, overlay_mode,
+                                     frames_directory)
+                    for index, meme_path in enumerate(meme_paths)]
+        batch = [index for index, overlay in enumerate(overlays) if overlay]
+
+        outputs = [None] * len(meme_paths)
+        rendered = _run_ffmpeg(video_path, [overlays[index] for index in batch], workspace, encoder or {})
+
+        if rendered is None and len(batch) > 1:
+            # One bad input fails the whole command; render the memes one by one, so it
+            # only fails its own video
+            logging.warning(f"Batch render of {len(batch)} memes failed, rendering them one at a time.")
+            rendered = [(_run_ffmpeg(video_path, [overlays[index]], workspace, encoder or {}) or [None])[0]
+                        for index in batch]
+
+        for index, rendered_video_path in zip(batch, rendered or []):
+            if rendered_video_path:
+                # Move the finished video out of the workspace under a name no other render uses
+                _, video_extension = os.path.splitext(video_path)
+                outputs[index] = os.path.join(output_directory, f"result_{uuid.uuid4().hex}{video_extension}")
+                os.replace(rendered_video_path, outputs[index])
+
+        return outputs
+
+
+def _prepare_overlay(meme_path, workspace, index, video_width, video_height, overlay_mode, frames_directory):
+    # The ffmpeg inputs and the filter chain that put one meme onto the background. The
+    # chain reads the background from [{background}] and writes the video to [{output}]
+    try:
+        # The icon and caption badge only depends on the video size and is built once per size
+        assets = get_overlay_assets(video_width, video_height)
+
+        if overlay_mode == 'template':
+            # One full frame overlay holding the meme, icon and caption
+            frame_path = build_overlay_frame(meme_path, video_width, video_height, assets, frames_directory)
+            return {'inputs': [frame_path], 'filter': "[{background}][{0}]overlay=0:0[{output}]"}
+
+        # The meme is resized once here; the filter graph overlays it without scaling it again.
+        # PNG keeps the transparency of memes that have it
+        preprocessed_image_path = os.path.join(workspace, f'preprocessed_overlay_image_{index}.png')
+        image_width, image_height = preprocess_image(meme_path, preprocessed_image_path, video_width, 0.9)
+        logging.info(f"Preprocessed image dimensions: width={image_width}, height={image_height}")
+
+        image_x, image_y, badge_x, badge_y = overlay_layout(video_width, video_height, image_width, image_height,
+                                                            assets)
+        return {
+            'inputs': [preprocessed_image_path, assets['badge_path']],
+            'filter': f"[{{background}}][{{0}}]overlay={image_x}:{image_y}[{{output}}_meme];"
+                      f"[{{output}}_meme][{{1}}]overlay={badge_x}:{badge_y}[{{output}}]",
+        }
+
+    except Exception as e:
+        logging.error(f"Error preparing the overlay of {meme_path}: {e}")
+        return None
+
+
+def _run_ffmpeg(video_path, overlays, workspace, encoder):
+    # One ffmpeg command with an output file per overlay. Returns the paths of the
+    # rendered videos, or None if the command failed
+    _, video_extension = os.path.splitext(video_path)
+
+    inputs = ['-i', video_path]
+    filters = []
+    outputs = []
+    rendered_video_paths = []
+
+    backgrounds = [f'bg{index}' for index in range(len(overlays))]
+    if len(overlays) > 1:
+        filters.append(f"[0:v]split={len(overlays)}" + ''.join(f'[{label}]' for label in backgrounds))
+    else:
+        backgrounds = ['0:v']
+
+    input_count = 1
+    for index, (overlay, background) in enumerate(zip(overlays, backgrounds)):
+        input_labels = [str(input_count + offset) for offset in range(len(overlay['inputs']))]
+        input_count += len(overlay['inputs'])
+        for path in overlay['inputs']:
+            inputs += ['-i', path]
+
+        filters.append(overlay['filter'].format(*input_labels, background=background, output=f'video{index}'))
+
+        rendered_video_path = os.path.join(workspace, f"result_{index}{video_extension}")
+        rendered_video_paths.append(rendered_video_path)
+
+        # Output options apply to the file that follows them, so each output gets its own
+        outputs += [
+            '-map', f'[video{index}]', '-map', '0:a?',
+            *encoder_arguments(**encoder),
+            '-codec:a', 'copy', '-map_metadata', '-1', rendered_video_path
+        ]
+
+    ffmpeg_command = ['ffmpeg', '-nostdin', '-y', *inputs, '-filter_complex', ';'.join(filters), *outputs]
+
+    logging.info(f"Running ffmpeg command: {' '.join(ffmpeg_command)}")
+
+    started_at = time.monotonic()
+
+    try:
+        result = subprocess.run(ffmpeg_command, capture_output=True, text=True, check=True)
+        logging.info("Video created successfully!")
+        logging.debug("ffmpeg stdout: %s", result.stdout)
+        logging.debug("ffmpeg stderr: %s", result.stderr)
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Error saving video: {e}")
+        logging.debug("ffmpeg stdout: %s", e.stdout)
+        logging.debug("ffmpeg stderr: %s", e.stderr)
+        return None
+
+    # Report encoding time and size, to tune the encoder profile and batch size for the hardware
+    elapsed = time.monotonic() - started_at
+    output_size = sum(os.path.getsize(path) for path in rendered_video_paths)
+    logging.info(f"Rendered {len(rendered_video_paths)} videos in {elapsed:.2f}s, {output_size} bytes "
+                 f"(profile {encoder.get('profile', 'balanced')})")
+
+    return rendered_video_paths